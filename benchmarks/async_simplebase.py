@@ -0,0 +1,61 @@
+"""p50/p99 latency of AsyncSimpleBase under concurrent coroutine load"""
+
+import asyncio
+import os
+import tempfile
+import time
+
+from kotazutils.asyncstorage import AsyncSimpleBase
+from kotazutils.storage import ColumnAttribute
+
+COROUTINES = 200
+OPERATIONS = 50
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+async def worker(table, number, inserts, reads):
+    for i in range(OPERATIONS):
+        start = time.perf_counter()
+        await table.insert({"name": "user{}-{}".format(number, i), "age": i})
+        inserts.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        await table.get(age=i, limit=10)
+        reads.append(time.perf_counter() - start)
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as directory:
+        async with AsyncSimpleBase(os.path.join(directory, "test.db")) as base:
+            table = await base.create_table(
+                "users",
+                [
+                    ColumnAttribute("name", "TEXT"),
+                    ColumnAttribute("age", "INTEGER", index=True),
+                ],
+            )
+            inserts, reads = [], []
+            start = time.perf_counter()
+            await asyncio.gather(
+                *(worker(table, number, inserts, reads) for number in range(COROUTINES))
+            )
+            total = time.perf_counter() - start
+
+    print(
+        "{} coroutines x {} insert+get, {:.0f} ops/s".format(
+            COROUTINES, OPERATIONS, 2 * COROUTINES * OPERATIONS / total
+        )
+    )
+    for name, latencies in [("insert", inserts), ("get", reads)]:
+        print(
+            "{:<8} p50 {:>8.2f} ms   p99 {:>8.2f} ms".format(
+                name, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000
+            )
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
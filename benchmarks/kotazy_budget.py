@@ -0,0 +1,77 @@
+"""Cost of execution budgets: the same scripts without limits and with every limit set"""
+
+import time
+
+from kotazutils.kotazy import KotazyBudgetExceeded, KotazyPool, KotazyRunner
+
+REPEATS = 20000
+SCRIPTS = {
+    "builtins": "{rep(%d, {set(a, 1); set(b, a); set(c, ret(a, b)); ret(c)})}",
+    "calls": "{def(pass, a, b, {ret(b)}); rep(%d, {set(x, pass(1, pass(2, 3)))})}",
+    "recursion": "{def(down, n, {cnd(n, {down(dec(n))})}); rep(%d, {down(8)})}",
+}
+LIMITS = {"steps": 10**9, "timeout": 3600, "depth": 1000, "size": 10**6}
+
+
+def rep(_proc, count, block):
+    for _ in range(int(_proc.ast_load(count))):
+        _proc.ast_load(block)
+
+
+def cnd(_proc, value, block):
+    if _proc.ast_load(value):
+        return _proc.ast_load(block)
+
+
+def dec(_proc, value):
+    return _proc.ast_load(value) - 1
+
+
+def measure(runner, code, limits):
+    best = None
+    for _ in range(5):
+        start = time.perf_counter()
+        runner.run(code, **limits)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best / REPEATS * 1e6
+
+
+def main():
+    runner = KotazyRunner()
+    runner.processor.install_environments({"rep": rep, "cnd": cnd, "dec": dec})
+    print("{:<12} {:>12} {:>12}".format("script", "no limits", "all limits"))
+    for name, script in SCRIPTS.items():
+        code = script % REPEATS
+        free = measure(runner, code, {})
+        limited = measure(runner, code, LIMITS)
+        print(
+            "{:<12} {:>9.2f} us {:>9.2f} us  ({:+.1f}%)".format(
+                name, free, limited, (limited / free - 1) * 100
+            )
+        )
+
+    # a runaway script is stopped by the soft deadline, a stuck C call by the pool
+    start = time.perf_counter()
+    try:
+        runner.run("{rep(1000000000, {ret(1)})}", timeout=0.1)
+    except KotazyBudgetExceeded as e:
+        print(
+            "soft {:<24} after {:.3f} s".format(
+                str(e.budget), time.perf_counter() - start
+            )
+        )
+    with KotazyPool(1) as pool:
+        start = time.perf_counter()
+        try:
+            pool.run('{clc("9 ** 9 ** 9")}', timeout=0.1)
+        except KotazyBudgetExceeded as e:
+            print(
+                "hard {:<24} after {:.3f} s".format(
+                    str(e.budget), time.perf_counter() - start
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
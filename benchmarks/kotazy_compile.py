@@ -0,0 +1,51 @@
+"""Interpreted (KotazyProcessor.run) against compiled (KotazyRunner.execute) Kotazy scripts"""
+
+import time
+
+from kotazutils.kotazy import KotazyRunner
+
+REPEATS = 20000
+SCRIPTS = {
+    "set/ret": """{rep(%d, {
+        set(a, 1.5); set(b, "text"); set(c, a); set(d, ret(c)); set(e, ret(a, b, c))
+    })}""",
+    "calls": """{
+        def(f, {ret(1)}); def(g, {f(); ret(f())});
+        rep(%d, {g(); g(); ret(g())})
+    }""",
+    "nested blocks": """{rep(%d, {set(a, {set(b, {ret(1)}); ret(b)}); ret(a)})}""",
+}
+
+
+def rep(_proc, count, block):
+    for _ in range(int(_proc.ast_load(count))):
+        _proc.ast_load(block)
+
+
+def measure(runner, source, compiled):
+    runner.processor.reset_environment()
+    tree = runner.transform(runner.parse(source))
+    start = time.perf_counter()
+    if compiled:
+        runner.execute(tree)
+    else:
+        runner.processor.run(tree)
+    return time.perf_counter() - start
+
+
+def main():
+    runner = KotazyRunner()
+    runner.processor.install_environments({"rep": rep})
+    for name, script in SCRIPTS.items():
+        source = script % REPEATS
+        interpreted = measure(runner, source, False)
+        compiled = measure(runner, source, True)
+        print(
+            "{:<14} interpreted {:>8.1f} ms compiled {:>8.1f} ms {:>6.1f}x".format(
+                name, interpreted * 1e3, compiled * 1e3, interpreted / compiled
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""Parse throughput and KotazyRunner construction time: Earley parser per runner against
+the shared LALR parser with an embedded transformer, and the runner's source cache"""
+
+import time
+
+from lark import Lark
+
+from kotazutils import kotazy
+from kotazutils.kotazy import KotazyRunner, KotazyTransformer
+
+SNIPPET = (
+    'set(a, 1.5); out("text", a, -2); def(f, {set(b, {ret(a)}); ret(b, "x")}); '
+    "f(); /* comment */ set(c, f())"
+)
+SOURCE = "{" + "; ".join([SNIPPET] * 1000) + "}"
+SHORT = '{set(a, 1); set(b, ret(a)); ret(b, "x")}'
+
+
+def timed(function, number=1):
+    start = time.perf_counter()
+    for _ in range(number):
+        result = function()
+    return (time.perf_counter() - start) / number, result
+
+
+def main():
+    size = len(SOURCE.encode()) / 1024
+
+    seconds, earley = timed(lambda: Lark(kotazy.kotazy_grammar, start="codeblock"))
+    print("construct earley parser   {:>10.1f} ms".format(seconds * 1e3))
+    kotazy.kotazy_parser.cache_clear()
+    seconds, _ = timed(KotazyRunner)
+    print("construct first runner    {:>10.1f} ms".format(seconds * 1e3))
+    seconds, runner = timed(KotazyRunner, 100)
+    print("construct next runners    {:>10.3f} ms".format(seconds * 1e3))
+
+    transformer = KotazyTransformer()
+    seconds, before = timed(lambda: transformer.transform(earley.parse(SOURCE)))
+    print("parse earley + transform  {:>10.0f} KB/s".format(size / seconds))
+    seconds, after = timed(lambda: runner.parse(SOURCE), 5)
+    print("parse lalr embedded       {:>10.0f} KB/s".format(size / seconds))
+    assert before == after
+
+    runner.cache_size = 0
+    seconds, _ = timed(lambda: runner.run(SHORT), 2000)
+    print("run uncached              {:>10.0f} runs/s".format(1 / seconds))
+    runner.cache_size = 256
+    seconds, _ = timed(lambda: runner.run(SHORT), 2000)
+    print("run cached                {:>10.0f} runs/s".format(1 / seconds))
+
+
+if __name__ == "__main__":
+    main()
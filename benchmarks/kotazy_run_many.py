@@ -0,0 +1,60 @@
+"""Throughput of KotazyRunner.run_many: one run at a time against the process pool"""
+
+import os
+import time
+
+from kotazutils.kotazy import KotazyRunner
+
+SCRIPTS = 4000
+UNIQUE = 1000
+SCRIPT = (
+    '{def(f, n, {ret(ecl("n * %d + 1"))}); set(s, 0); rep(%d, {set(s, f(s))}); ret(s)}'
+)
+
+
+def rep(_proc, count, block):
+    for _ in range(int(_proc.ast_load(count))):
+        _proc.ast_load(block)
+
+
+def setup():
+    runner = KotazyRunner()
+    runner.processor.install_environments({"rep": rep})
+    return runner
+
+
+def report(name, seconds, base):
+    print(
+        "{:<16} {:>8.0f} scripts/s {:>6.2f}x".format(
+            name, SCRIPTS / seconds, base / seconds if base else 1.0
+        )
+    )
+
+
+def main():
+    scripts = [SCRIPT % (i % UNIQUE, 20 + i % UNIQUE % 7) for i in range(SCRIPTS)]
+    runner = setup()
+    print("{} scripts, {} unique, {} cores".format(SCRIPTS, UNIQUE, os.cpu_count()))
+
+    start = time.perf_counter()
+    for code in scripts:
+        runner.processor.reset_environment()
+        runner.run(code)
+    base = time.perf_counter() - start
+    report("run, one by one", base, None)
+
+    start = time.perf_counter()
+    serial = runner.run_many(scripts, workers=0)
+    report("run_many serial", time.perf_counter() - start, base)
+
+    for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+        runner.get_pool(workers, setup)  # processes start outside of the measurement
+        start = time.perf_counter()
+        parallel = runner.run_many(scripts, workers=workers, setup=setup)
+        report("workers={}".format(workers), time.perf_counter() - start, base)
+        assert parallel == serial
+    runner.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""Variable-heavy Kotazy scripts: globals in the environment against locals in frame slots"""
+
+import time
+
+from kotazutils.kotazy import KotazyRunner
+
+REPEATS = 20000
+BODY = "set(a, 1); set(b, a); set(c, b); set(d, ret(a, b, c)); set(a, d); ret(c)"
+SCRIPTS = {
+    "globals": "{rep(%d, {" + BODY + "})}",
+    "locals": "{def(work, n, {rep(n, {" + BODY + "})}); work(%d)}",
+    "closure": "{def(work, n, {set(a, 1); def(inner, {"
+    + BODY
+    + "}); rep(n, {inner()})}); work(%d)}",
+    "parameters": "{def(pass, a, b, c, {ret(c)}); rep(%d, {set(x, pass(1, 2, 3))})}",
+}
+
+
+def rep(_proc, count, block):
+    for _ in range(int(_proc.ast_load(count))):
+        _proc.ast_load(block)
+
+
+def main():
+    runner = KotazyRunner()
+    runner.processor.install_environments({"rep": rep})
+    for name, script in SCRIPTS.items():
+        tree = runner.transform(runner.parse(script % REPEATS))
+        start = time.perf_counter()
+        runner.execute(tree)
+        seconds = time.perf_counter() - start
+        print(
+            "{:<12} {:>8.1f} ms {:>8.2f} us/iteration".format(
+                name, seconds * 1e3, seconds / REPEATS * 1e6
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Cost of reading and mutating data through Observer, before and after the slot-based proxies
+
+"before" is `Observer` of the baseline commit, loaded from git (or from the file given as the
+first argument), it builds a new Observer on every access. Both run the same cases.
+
+    python benchmarks/observer.py [old_storage.py]
+"""
+
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from kotazutils.storage import Observer
+
+BASELINE = "0803ca5"
+NUMBER = 100000
+
+
+def baseline_observer(directory):
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    else:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        path = os.path.join(directory, "old_storage.py")
+        with open(path, "wb") as f:
+            f.write(
+                subprocess.check_output(
+                    ["git", "show", BASELINE + ":kotazutils/storage.py"], cwd=root
+                )
+            )
+    spec = importlib.util.spec_from_file_location("old_storage", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Observer
+
+
+def cases(observer):
+    class Holder(object):
+        data = observer({}, callback=lambda observer, instance, value: None)
+
+    holder = Holder()
+    holder.data = {"users": {"alex": {"age": 25, "tags": []}}}
+    return {
+        "attribute get": lambda: holder.data,
+        "nested get": lambda: holder.data["users"]["alex"]["age"],
+        "nested set": lambda: holder.data["users"]["alex"].__setitem__("age", 26),
+        "nested append": lambda: holder.data["users"]["alex"]["tags"].append(1),
+    }
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        before = cases(baseline_observer(directory))
+    after = cases(Observer)
+    print("{:<16} {:>10} {:>10} {:>8}".format("us", "before", "after", "speedup"))
+    for name in after:
+        old = timeit.timeit(before[name], number=NUMBER) / NUMBER * 1e6
+        new = timeit.timeit(after[name], number=NUMBER) / NUMBER * 1e6
+        print("{:<16} {:>10.3f} {:>10.3f} {:>7.1f}x".format(name, old, new, old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Rows/sec of Table.insert against Table.insert_many and of Table.get against Table.iter"""
+
+import os
+import tempfile
+import time
+import tracemalloc
+
+from kotazutils.storage import ColumnAttribute, SimpleBase
+
+ROWS = 200000
+
+
+def rows():
+    for i in range(ROWS):
+        yield {"name": "user{}".format(i), "age": i % 90, "rate": i / 7}
+
+
+def table(directory, name):
+    base = SimpleBase(os.path.join(directory, name + ".db"))
+    return base, base.create_table(
+        "users",
+        [
+            ColumnAttribute("name", "TEXT"),
+            ColumnAttribute("age", "INTEGER"),
+            ColumnAttribute("rate", "REAL"),
+        ],
+    )
+
+
+def report(name, seconds, peak=None):
+    line = "{:<26} {:>12.0f} rows/s".format(name, ROWS / seconds)
+    if peak is not None:
+        line += " {:>10.1f} MB peak".format(peak / 2**20)
+    print(line)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        base, users = table(directory, "insert")
+        start = time.perf_counter()
+        with base.transaction():
+            for row in rows():
+                users.insert(row)
+        report("insert in a transaction", time.perf_counter() - start)
+
+        base, users = table(directory, "insert_many")
+        start = time.perf_counter()
+        users.insert_many(rows())
+        report("insert_many", time.perf_counter() - start)
+
+        for name, fetch in [("get", users.get), ("iter", users.iter)]:
+            tracemalloc.start()
+            start = time.perf_counter()
+            count = sum(1 for _ in fetch())
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            assert count == ROWS
+            report(name, seconds, peak)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""How long writers pause while a backup of SimpleStorage or SimpleBase is taken"""
+
+import os
+import tempfile
+import threading
+import time
+
+from kotazutils.storage import (
+    ColumnAttribute,
+    JournalBackend,
+    SimpleBase,
+    SimpleStorage,
+)
+
+RECORDS = 200000
+
+
+def writer(write, stop, latencies):
+    i = 0
+    while not stop.is_set():
+        start = time.perf_counter()
+        write(i)
+        latencies.append(time.perf_counter() - start)
+        i += 1
+
+
+def measure(name, write, backup):
+    """Runs the writer alone and then during the backup, prints its worst latencies"""
+    for label, action in (("no backup", None), ("backup", backup)):
+        stop, latencies = threading.Event(), []
+        thread = threading.Thread(target=writer, args=(write, stop, latencies))
+        thread.start()
+        start = time.perf_counter()
+        if action is None:
+            time.sleep(0.5)
+        else:
+            action()
+        seconds = time.perf_counter() - start
+        stop.set()
+        thread.join()
+        latencies.sort()
+        print(
+            "{:<28} {:<9} {:>8.1f} ms {:>7} writes p99 {:>7.2f} ms max {:>7.2f} ms".format(
+                name,
+                label,
+                seconds * 1e3,
+                len(latencies),
+                latencies[int(len(latencies) * 0.99)] * 1e3,
+                latencies[-1] * 1e3,
+            )
+        )
+
+
+def simple_storage(directory):
+    path = os.path.join(directory, "storage.json")
+    backend = JournalBackend(path, fsync="never", compact_every=0, serializer="json")
+    storage = SimpleStorage(path, backend=backend)
+    storage.table_add("users", {"login": "", "age": 0})
+    storage.index_create("users", "login")
+    storage.record_add_many(
+        "users", ({"login": str(i), "age": i % 90} for i in range(RECORDS))
+    )
+
+    def write(i):
+        storage.record_update("users", ["login", str(i % RECORDS)], age=i)
+
+    write(0)  # builds the index
+    start = time.perf_counter()
+    id, _ = storage.snapshot()
+    print("snapshot() copy {:>19.2f} ms".format((time.perf_counter() - start) * 1e3))
+    measure(
+        "SimpleStorage full",
+        write,
+        lambda: storage.backup(os.path.join(directory, "full.log")),
+    )
+    id = storage.backup(os.path.join(directory, "full.log"))
+    time.sleep(0.2)
+    measure(
+        "SimpleStorage incremental",
+        write,
+        lambda: storage.backup(os.path.join(directory, "1.log"), since=id),
+    )
+    storage.close()
+
+
+def simple_base(directory):
+    base = SimpleBase(os.path.join(directory, "base.db"), "wal")
+    table = base.create_table(
+        "users", [ColumnAttribute("login", "TEXT"), ColumnAttribute("age", "INTEGER")]
+    )
+    table.insert_many({"login": str(i), "age": i % 90} for i in range(RECORDS))
+
+    def write(i):
+        table.insert({"login": "new", "age": i})
+
+    for pages in (256, -1):
+        measure(
+            "SimpleBase pages={}".format(pages),
+            write,
+            lambda: base.snapshot(os.path.join(directory, "backup.db"), pages=pages),
+        )
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        simple_storage(directory)
+        simple_base(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Cold start time and memory of ColumnarStorage against SimpleStorage
+
+Every case runs in a fresh interpreter: open the file, run one lookup, report the
+time and the RSS growth of the process (Linux only, read from /proc).
+"""
+
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from kotazutils.columnar import ColumnarStorage, columnar_save
+from kotazutils.storage import SimpleStorage
+
+ROWS = 100000
+
+
+def synthetic_data(rows):
+    random.seed(0)
+    cities = ["Moscow", "Kazan", "Omsk", "Tomsk", "Sochi"]
+    return {
+        "users": {
+            "__DEFAULT__": {"login": "", "age": 0, "city": "", "rate": 0.0},
+            "__DATA__": [
+                {
+                    "login": "user{}".format(i),
+                    "age": random.randint(18, 90),
+                    "city": random.choice(cities),
+                    "rate": random.random() * 5,
+                }
+                for i in range(rows)
+            ],
+        }
+    }
+
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def measure(kind, path):
+    before = rss()
+    start = time.perf_counter()
+    if kind == "columnar":
+        storage = ColumnarStorage(path)
+    else:
+        storage = SimpleStorage(path)
+    opened = time.perf_counter() - start
+    record = storage.record_get("users", ["login", "user{}".format(ROWS // 2)])
+    total = time.perf_counter() - start
+    assert record is not None
+    growth = rss() - before
+    print(
+        "{:<10} {:>10.3f} {:>12.3f} {:>10.1f}".format(
+            kind, opened, total, growth / 2**20
+        )
+    )
+
+
+def main():
+    data = synthetic_data(ROWS)
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {
+            "yaml": os.path.join(directory, "storage.yml"),
+            "json": os.path.join(directory, "storage.json"),
+            "columnar": os.path.join(directory, "storage.col"),
+        }
+        for kind in ["yaml", "json"]:
+            storage = SimpleStorage(paths[kind], serializer=kind)
+            storage.data = data
+            storage.save()
+        columnar_save(paths["columnar"], data)
+
+        print("{} rows".format(ROWS))
+        print(
+            "{:<10} {:>10} {:>12} {:>10}".format(
+                "format", "open, s", "lookup, s", "RSS, MB"
+            )
+        )
+        for kind, path in paths.items():
+            subprocess.run([sys.executable, __file__, kind, path], check=True)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        measure(*sys.argv[1:])
+    else:
+        main()
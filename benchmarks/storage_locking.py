@@ -0,0 +1,67 @@
+"""Throughput of processes incrementing one counter in a locked SimpleStorage, and the cost of stale()"""
+
+import multiprocessing
+import os
+import tempfile
+import time
+import timeit
+
+from kotazutils.storage import JournalBackend, SimpleStorage
+
+INCREMENTS = 200
+
+
+def open_storage(path, journal):
+    backend = JournalBackend(path, fsync="never") if journal else None
+    return SimpleStorage(path, backend=backend, lock=True)
+
+
+def worker(path, journal):
+    storage = open_storage(path, journal)
+    for _ in range(INCREMENTS):
+        with storage.transaction():
+            value = storage.record_get("counter", ["key", "hits"])["value"]
+            storage.record_update("counter", ["key", "hits"], value=value + 1)
+    storage.close()
+
+
+def run(directory, processes, journal):
+    path = os.path.join(directory, "{}-{}.yml".format(processes, journal))
+    storage = open_storage(path, journal)
+    storage.table_add("counter", {"key": "", "value": 0})
+    storage.record_add("counter", key="hits")
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=worker, args=(path, journal)) for _ in range(processes)
+    ]
+    start = time.perf_counter()
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+    seconds = time.perf_counter() - start
+    storage.refresh()
+    value = storage.record_get("counter", ["key", "hits"])["value"]
+    assert value == processes * INCREMENTS, "lost updates: {}".format(value)
+    print(
+        "{:<9} {:>2} processes {:>10.0f} transactions/s".format(
+            "journal" if journal else "snapshot",
+            processes,
+            processes * INCREMENTS / seconds,
+        )
+    )
+    return storage
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        for journal in (False, True):
+            for processes in (1, 2, 4, 8):
+                storage = run(directory, processes, journal)
+        number = 100000
+        seconds = timeit.timeit(storage.stale, number=number)
+        print("stale() {:>27.2f} us".format(seconds / number * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Records/sec of StorageManager inserts into a 10 column table, before and after compiled tables
+
+"baseline" is `StorageTable.insert` of the baseline commit, loaded from git (or from the file
+given as the first argument). It rewrites the whole YAML file and prints the data on every
+insert, so it slows down as the table grows and all paths are timed on the same `BASELINE_ROWS`
+records. Its output goes to /dev/null, "no print" times it with `print` replaced by a no-op.
+
+    python benchmarks/storage_manager_insert.py [old_storage.py]
+"""
+
+import contextlib
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from kotazutils.storage import StorageManager
+
+BASELINE = "0803ca5"
+BASELINE_ROWS = 100
+ROWS = 20000
+COLUMNS = [
+    ("id", "INT", ["UNIQUE"]),
+    ("login", "STR", ["UNIQUE", "LIMIT 1 32"]),
+    ("age", "INT", ["LIMIT 0 150"]),
+    ("rate", "FLOAT", ["LIMIT 0 5"]),
+    ("active", "BOOL", []),
+    ("city", "STR", []),
+    ("tags", "LIST", []),
+    ("born", "DATE", []),
+    ("seen", "TIMESTAMP", []),
+    ("extra", "ANY", []),
+]
+
+
+def records(count, offset=0):
+    for i in range(offset, offset + count):
+        yield {
+            "id": i,
+            "login": "user{}".format(i),
+            "age": i % 90,
+            "rate": (i % 50) / 10,
+            "active": i % 2 == 0,
+            "city": "Moscow",
+            "tags": ["a", "b"],
+            "born": "2000-01-02",
+            "seen": 1700000000.0 + i,
+            "extra": None,
+        }
+
+
+def baseline_module(directory):
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    else:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        path = os.path.join(directory, "old_storage.py")
+        with open(path, "wb") as f:
+            f.write(
+                subprocess.check_output(
+                    ["git", "show", BASELINE + ":kotazutils/storage.py"], cwd=root
+                )
+            )
+    spec = importlib.util.spec_from_file_location("old_storage", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def table(module, path, **options):
+    storage = module.StorageManager(path, **options)
+    return storage.table_add(
+        "users", [module.StorageColumn(*column) for column in COLUMNS]
+    )
+
+
+def seconds(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def inserts(table, count):
+    def run():
+        for record in records(count):
+            table.insert(**record)
+
+    return run
+
+
+def report(name, count, elapsed, baseline=None):
+    line = "{:<28} {:>10.0f} records/s".format(name, count / elapsed)
+    if baseline is not None:
+        line += " {:>8.1f}x baseline".format(baseline / elapsed)
+    print(line)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        old = baseline_module(directory)
+        cwd = os.getcwd()
+        # the baseline writes to the file "t" in the working directory
+        os.chdir(directory)
+        try:
+            with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+                baseline = seconds(inserts(table(old, "old.yml"), BASELINE_ROWS))
+            old.print = lambda *args, **kwargs: None
+            quiet = seconds(inserts(table(old, "quiet.yml"), BASELINE_ROWS))
+        finally:
+            os.chdir(cwd)
+        # ratios are against the faster "no print" baseline
+        report("baseline insert", BASELINE_ROWS, baseline, quiet)
+        report("baseline insert, no print", BASELINE_ROWS, quiet, quiet)
+
+        current = sys.modules[StorageManager.__module__]
+        path = os.path.join(directory, "{}.yml").format
+        cases = {
+            "insert": inserts(table(current, path("insert")), BASELINE_ROWS),
+            "insert, fsync every 100": inserts(
+                table(current, path("batched"), fsync=100), BASELINE_ROWS
+            ),
+            "insert_many": lambda: table(current, path("many")).insert_many(
+                records(BASELINE_ROWS)
+            ),
+        }
+        for name, case in cases.items():
+            report(name, BASELINE_ROWS, seconds(case), quiet)
+
+        # the new path at a size the baseline can not reach in reasonable time
+        large = table(current, path("large"))
+        report(
+            "insert_many, {} records".format(ROWS),
+            ROWS,
+            seconds(lambda: large.insert_many(records(ROWS))),
+        )
+
+
+if __name__ == "__main__":
+    main()
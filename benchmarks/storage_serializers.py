@@ -0,0 +1,60 @@
+"""Load/save throughput and file size of SimpleStorage serializers on synthetic tables"""
+
+import os
+import random
+import tempfile
+import time
+
+from kotazutils.storage import SimpleStorage, serializers
+
+ROWS = 50000
+
+
+def synthetic_data(rows):
+    random.seed(0)
+    cities = ["Moscow", "Kazan", "Omsk", "Tomsk", "Sochi"]
+    return {
+        "users": {
+            "__DEFAULT__": {"login": "", "age": 0, "city": "", "rate": 0.0},
+            "__DATA__": [
+                {
+                    "login": "user{}".format(i),
+                    "age": random.randint(18, 90),
+                    "city": random.choice(cities),
+                    "rate": random.random() * 5,
+                }
+                for i in range(rows)
+            ],
+        }
+    }
+
+
+def main():
+    data = synthetic_data(ROWS)
+    print("{} rows".format(ROWS))
+    print(
+        "{:<8} {:>10} {:>10} {:>12}".format("format", "save, s", "load, s", "size, KB")
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        for name in serializers:
+            path = os.path.join(directory, "storage." + name)
+            storage = SimpleStorage(path, serializer=name)
+            storage.data = data
+
+            start = time.perf_counter()
+            storage.save()
+            saved = time.perf_counter() - start
+
+            start = time.perf_counter()
+            storage.load()
+            loaded = time.perf_counter() - start
+
+            assert storage.data == data
+            size = os.path.getsize(path) / 1024
+            print(
+                "{:<8} {:>10.3f} {:>10.3f} {:>12.0f}".format(name, saved, loaded, size)
+            )
+
+
+if __name__ == "__main__":
+    main()
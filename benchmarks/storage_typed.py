@@ -0,0 +1,48 @@
+"""Memory held by 1M records of a SimpleStorage table kept as dicts and as typed rows"""
+
+import gc
+import os
+import tempfile
+import time
+import tracemalloc
+
+from kotazutils.storage import JournalBackend, SimpleStorage
+
+ROWS = 1000000
+DEFAULT = {"login": "", "age": 0, "rate": 0.0, "city": "", "active": False}
+
+
+def rows():
+    for i in range(ROWS):
+        yield {"login": "user{}".format(i), "age": i % 90, "rate": i / 7}
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        for typed in (False, True):
+            path = os.path.join(directory, "typed{}.yml".format(typed))
+            backend = JournalBackend(path, fsync="never", compact_every=0)
+            storage = SimpleStorage(path, backend=backend, typed=typed)
+            storage.table_add("users", DEFAULT)
+            gc.collect()
+            tracemalloc.start()
+            start = time.perf_counter()
+            storage.record_add_many("users", rows())
+            seconds = time.perf_counter() - start
+            gc.collect()
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print(
+                "{:<6} {:>8.1f} MB {:>6.0f} bytes/record {:>10.0f} records/s".format(
+                    "typed" if typed else "dict",
+                    size / 2**20,
+                    size / ROWS,
+                    ROWS / seconds,
+                )
+            )
+            storage.close()
+            del storage
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import asyncio
+import functools
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .storage import SimpleBase
+
+
+class AsyncSimpleBase:
+    """asyncio front end for `SimpleBase`.
+
+    Writes go to a dedicated writer thread which takes every request queued at the moment and
+    runs them in one transaction, each in its own savepoint, so concurrent inserts are
+    coalesced and a failing request does not undo the others. Reads run on a pool of
+    reader threads, each with its own connection (the "wal" profile lets them read while the
+    writer writes). At most `max_pending` writes may wait for the writer, later ones wait in
+    their coroutine.
+
+    >>> base = AsyncSimpleBase("test.db")
+    >>> table = await base.create_table("test", [ColumnAttribute("name", "TEXT")])
+    >>> await table.insert({"name": "Alex"})
+    >>> await table.get(name="Alex")
+    """
+
+    def __init__(
+        self,
+        name,
+        profile="wal",
+        readers=4,
+        max_pending=1000,
+        batch_size=1000,
+        **pragmas
+    ):
+        self.base = SimpleBase(name, profile, **pragmas)
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.readers = ThreadPoolExecutor(
+            readers, thread_name_prefix="simplebase-reader"
+        )
+        self.requests = queue.Queue()
+        self.semaphore = None
+        self.writer = threading.Thread(
+            target=self._write_loop, name="simplebase-writer", daemon=True
+        )
+        self.writer.start()
+
+    def _write_loop(self):
+        base = self.base
+        while True:
+            batch = [self.requests.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            # requests whose coroutine was cancelled while queued are not run
+            batch = [
+                request
+                for request in batch
+                if request is not None and request[1].set_running_or_notify_cancel()
+            ]
+            results = []
+            try:
+                with base.transaction():
+                    for function, _ in batch:
+                        # a failing request rolls back to its savepoint, the others are kept
+                        try:
+                            with base.transaction():
+                                results.append((function(), None))
+                        except Exception as e:
+                            results.append((None, e))
+            except Exception as e:
+                # the commit failed, nothing of the batch is stored
+                results = [(None, e)] * len(batch)
+            for (_, future), (result, error) in zip(batch, results):
+                # one undeliverable result must not stop the writer
+                try:
+                    if error is None:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(error)
+                except Exception:
+                    pass
+            if stop:
+                break
+
+    async def write(self, function, *args, **kwargs):
+        """Runs the function on the writer thread inside a transaction"""
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_pending)
+        async with self.semaphore:
+            future = Future()
+            self.requests.put((functools.partial(function, *args, **kwargs), future))
+            return await asyncio.wrap_future(future)
+
+    async def read(self, function, *args, **kwargs):
+        """Runs the function on a reader thread"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.readers, functools.partial(function, *args, **kwargs)
+        )
+
+    async def create_table(self, table_name, columns):
+        return AsyncTable(
+            self, await self.write(self.base.create_table, table_name, columns)
+        )
+
+    def close(self):
+        self.requests.put(None)
+        self.writer.join()
+        self.readers.shutdown()
+        self.base.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+
+class AsyncTable:
+    """Awaitable mirror of `Table`"""
+
+    def __init__(self, base, table):
+        self.base = base
+        self.table = table
+        self.name = table.name
+
+    async def insert(self, *data):
+        return await self.base.write(self.table.insert, *data)
+
+    async def insert_many(self, rows, chunk_size=1000):
+        return await self.base.write(self.table.insert_many, list(rows), chunk_size)
+
+    async def get(self, order=None, limit=None, offset=None, desc=True, **filters):
+        return await self.base.read(
+            self.table.get, order, limit, offset, desc, **filters
+        )
+
+    async def explain(self, order=None, limit=None, offset=None, desc=True, **filters):
+        return await self.base.read(
+            self.table.explain, order, limit, offset, desc, **filters
+        )
@@ -0,0 +1,306 @@
+import mmap
+import pickle
+import struct
+import sys
+from array import array
+
+import ujson
+
+from .storage import atomic_write
+
+MAGIC = b"KCOL1\n"
+HEADER = struct.Struct("<Q")
+
+# kind -> memoryview format of fixed width columns
+FORMATS = {"int": "q", "float": "d", "bool": "B"}
+
+
+def _column_kind(values):
+    kinds = {type(value) for value in values}
+    if kinds == {int} and -(2**63) <= min(values) and max(values) < 2**63:
+        return "int"
+    if kinds == {float}:
+        return "float"
+    if kinds == {bool}:
+        return "bool"
+    if kinds == {str}:
+        return "str"
+    return "obj"
+
+
+def _column_encode(kind, values):
+    """Returns (fixed width part, heap) of the column"""
+    if kind == "int":
+        return array("q", values).tobytes(), b""
+    if kind == "float":
+        return array("d", values).tobytes(), b""
+    if kind == "bool":
+        return bytes(values), b""
+    if kind == "str":
+        items = [value.encode() for value in values]
+    else:
+        items = [
+            pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL) for value in values
+        ]
+    offsets = array("Q", [0])
+    position = 0
+    for item in items:
+        position += len(item)
+        offsets.append(position)
+    return offsets.tobytes(), b"".join(items)
+
+
+def columnar_save(name, data):
+    """Writes `SimpleStorage` data in the columnar format read by `ColumnarStorage`
+
+    Every field of a table is stored as a separate column: ints, floats and bools as plain arrays,
+    strings and other values as an offsets array plus a heap of encoded values.
+    Tombstones of removed records are kept in the "alive" column, so record ids do not change.
+
+    >>> columnar_save("data.col", storage.data)
+    """
+    sections = []
+    position = 0
+
+    def section(content):
+        nonlocal position
+        offset = position
+        sections.append(content)
+        position += len(content)
+        padding = -len(content) % 8
+        if padding:
+            sections.append(b"\0" * padding)
+            position += padding
+        return [offset, len(content)]
+
+    header = {"byteorder": sys.byteorder, "tables": {}}
+    for name_, table in data.items():
+        records = table["__DATA__"]
+        default = table["__DEFAULT__"]
+        alive = [record is not None for record in records]
+        columns = {}
+        for field in default:
+            values = [
+                record.get(field) if record is not None else default[field]
+                for record in records
+            ]
+            kind = _column_kind(values) if values else "obj"
+            fixed, heap = _column_encode(kind, values)
+            columns[field] = {
+                "kind": kind,
+                "fixed": section(fixed),
+                "heap": section(heap),
+            }
+        header["tables"][name_] = {
+            "default": default,
+            "indexes": table.get("__INDEXES__", []),
+            "rows": len(records),
+            "alive": section(bytes(alive)),
+            "columns": columns,
+        }
+    encoded = ujson.dumps(header).encode()
+    prefix = MAGIC + HEADER.pack(len(encoded)) + encoded
+    prefix += b"\0" * (-len(prefix) % 8)
+    atomic_write(name, prefix + b"".join(sections))
+
+
+class ColumnarColumn:
+    """Single column of a mapped file, values are decoded only when accessed"""
+
+    def __init__(self, buffer, kind, fixed, heap):
+        self.kind = kind
+        fixed = buffer[fixed[0] : fixed[0] + fixed[1]]
+        self.heap = buffer[heap[0] : heap[0] + heap[1]]
+        if kind in FORMATS:
+            self.values = fixed.cast(FORMATS[kind])
+        else:
+            self.values = None
+            self.offsets = fixed.cast("Q")
+
+    def __getitem__(self, id):
+        if self.kind == "int" or self.kind == "float":
+            return self.values[id]
+        if self.kind == "bool":
+            return bool(self.values[id])
+        item = self.heap[self.offsets[id] : self.offsets[id + 1]]
+        if self.kind == "str":
+            return str(item, "utf-8")
+        return pickle.loads(item)
+
+    def matches(self, value, ids):
+        """Yields ids where the column equals the value. Strings are compared without decoding"""
+        if self.kind == "str":
+            if not isinstance(value, str):
+                return
+            value = value.encode()
+            heap, offsets = self.heap, self.offsets
+            for id in ids:
+                if heap[offsets[id] : offsets[id + 1]] == value:
+                    yield id
+        elif self.values is not None:
+            values = self.values
+            for id in ids:
+                if values[id] == value:
+                    yield id
+        else:
+            for id in ids:
+                if self[id] == value:
+                    yield id
+
+    def release(self):
+        if self.values is not None:
+            self.values.release()
+        else:
+            self.offsets.release()
+        self.heap.release()
+
+
+class ColumnarStorage:
+    """Read-only storage over a file written by `columnar_save`.
+
+    The file is opened with `mmap`, so startup does not decode anything and memory holds only
+    the pages and columns actually touched. Mirrors the reading API of `SimpleStorage`.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.file = open(name, "rb")
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = memoryview(self.mmap)
+        self.columns = {}
+        self.alive = {}
+        self.indexes = {}
+        if self.buffer[: len(MAGIC)] != MAGIC:
+            self.close()
+            raise Exception("File '{}' is not a columnar storage".format(name))
+        start = len(MAGIC) + HEADER.size
+        (length,) = HEADER.unpack(self.buffer[len(MAGIC) : start])
+        header = ujson.loads(self.buffer[start : start + length].tobytes())
+        if header["byteorder"] != sys.byteorder:
+            self.close()
+            raise Exception("File '{}' was written on another platform".format(name))
+        self.tables = header["tables"]
+        self.data_start = start + length + (-(start + length) % 8)
+
+    def close(self):
+        for columns in self.columns.values():
+            for column in columns.values():
+                column.release()
+        for alive in self.alive.values():
+            alive.release()
+        self.columns, self.alive = {}, {}
+        self.buffer.release()
+        self.mmap.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _column(self, name, field):
+        columns = self.columns.setdefault(name, {})
+        if field not in columns:
+            if field not in self.tables[name]["columns"]:
+                raise Exception("Column '{}' does not exist".format(field))
+            info = self.tables[name]["columns"][field]
+            columns[field] = ColumnarColumn(
+                self.buffer[self.data_start :],
+                info["kind"],
+                info["fixed"],
+                info["heap"],
+            )
+        return columns[field]
+
+    def _alive(self, name):
+        if name not in self.alive:
+            offset, length = self.tables[name]["alive"]
+            start = self.data_start + offset
+            self.alive[name] = self.buffer[start : start + length]
+        return self.alive[name]
+
+    def table_exists(self, name):
+        return name in self.tables
+
+    def table_list(self):
+        return self.tables.keys()
+
+    def table_default_record(self, name):
+        if self.table_exists(name):
+            return self.tables[name]["default"]
+        else:
+            raise Exception("Table does not exist")
+
+    def table_columns(self, name):
+        return self.table_default_record(name).keys()
+
+    def table_indexes(self, name):
+        if self.table_exists(name):
+            return [tuple(fields) for fields in self.tables[name]["indexes"]]
+        else:
+            raise Exception("Table does not exist")
+
+    def _table_indexes(self, name):
+        """Builds the indexes of the table, as `SimpleStorage` does.
+
+        An index is dropped as soon as one of its values can not be hashed (lists, dicts),
+        lookups on its fields then scan the columns.
+        """
+        if name not in self.indexes:
+            alive = self._alive(name)
+            indexes = {}
+            for fields in self.table_indexes(name):
+                columns = [self._column(name, field) for field in fields]
+                index = {}
+                try:
+                    for id in range(self.tables[name]["rows"]):
+                        if alive[id]:
+                            key = tuple(column[id] for column in columns)
+                            index.setdefault(key, []).append(id)
+                except TypeError:
+                    continue
+                indexes[fields] = index
+            self.indexes[name] = indexes
+        return self.indexes[name]
+
+    def _where_ids(self, name, where):
+        if not self.table_exists(name):
+            raise Exception("Table does not exist")
+        alive = self._alive(name)
+        ids = (id for id in range(self.tables[name]["rows"]) if alive[id])
+        conditions = dict(where)
+        if conditions:
+            indexes = self._table_indexes(name)
+            for fields in sorted(indexes, key=len, reverse=True):
+                if all(field in conditions for field in fields):
+                    try:
+                        ids = indexes[fields].get(
+                            tuple(conditions[f] for f in fields), ()
+                        )
+                    except TypeError:
+                        continue
+                    break
+        for field, value in where:
+            ids = self._column(name, field).matches(value, ids)
+        return ids
+
+    def record_get_by_id(self, name, id):
+        """Returns the record, None if it was removed"""
+        if not self.table_exists(name):
+            raise Exception("Table does not exist")
+        if not self._alive(name)[id]:
+            return None
+        return {
+            field: self._column(name, field)[id] for field in self.table_columns(name)
+        }
+
+    def record_get(self, name, *where):
+        id = self.record_get_id(name, *where)
+        return None if id is None else self.record_get_by_id(name, id)
+
+    def record_gets(self, name, *where):
+        return [self.record_get_by_id(name, id) for id in self._where_ids(name, where)]
+
+    def record_get_id(self, name, *where):
+        return next(iter(self._where_ids(name, where)), None)
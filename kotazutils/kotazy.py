@@ -1,13 +1,18 @@
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import multiprocessing
+import os
+import pickle
+import queue
+import time
+import weakref
+
 from lark import *
 from .safeeval import EvalProcessor
 
-
-class KotazyParser:
-    """Парсер Котазиланга"""
-
-    def __init__(self):
-        """Инициализация парсера"""
-        self.grammar = """
+kotazy_grammar = """
         codeblock: "{" (call (";" call)*)? "}" 
         call: id "(" (param ("," param)*)? ")"
         param: number | string | id | call | codeblock
@@ -23,8 +28,30 @@ class KotazyParser:
         %ignore WS
         %ignore C_COMMENT
         """
-        start_block = "codeblock"
-        self.parser = Lark(self.grammar, start=start_block)
+
+
+@functools.lru_cache(maxsize=None)
+def kotazy_parser(transformer=None):
+    """LALR-парсер, общий для всего процесса. Грамматика кэшируется Lark на диске
+
+    С классом `transformer` дерево преобразуется прямо во время разбора.
+    """
+    return Lark(
+        kotazy_grammar,
+        start="codeblock",
+        parser="lalr",
+        transformer=transformer() if transformer is not None else None,
+        cache=True,
+    )
+
+
+class KotazyParser:
+    """Парсер Котазиланга"""
+
+    def __init__(self, transformer=None):
+        """Инициализация парсера"""
+        self.grammar = kotazy_grammar
+        self.parser = kotazy_parser(transformer)
 
     def parse(self, *args, **kwargs):
         """Парсит выражение"""
@@ -34,6 +61,12 @@ class KotazyParser:
 class KotazyTransformer(Transformer):
     """Преобразование Lark-конструкции в словарь-дерево"""
 
+    def transform(self, tree):
+        """Преобразует дерево, готовое словарь-дерево возвращается как есть"""
+        if isinstance(tree, dict):
+            return tree
+        return super().transform(tree)
+
     def codeblock(self, d):
         """Работа с кодом '{...}'"""
         return {"type": "code", "calls": d}
@@ -63,6 +96,69 @@ class KotazyTransformer(Transformer):
         return {"type": "var", "val": str(n)}
 
 
+class KotazyBudgetExceeded(Exception):
+    """Выполнение прервано: превышено ограничение `budget` со значением `limit`"""
+
+    def __init__(self, budget, limit):
+        super().__init__(budget, limit)
+        self.budget = budget
+        self.limit = limit
+
+    def __str__(self):
+        return "kotazy budget exceeded: {} (limit {})".format(self.budget, self.limit)
+
+
+class KotazyBudget:
+    """Ограничения одного запуска: шаги, время, глубина вызовов и размер значений
+
+    Шаг - вызов функции или узел, выполненный функцией среды (тело цикла);
+    встроенные out, set, ret и def, которые компилятор выполняет на месте, шагами не
+    считаются. Процессор уменьшает счетчик `ticks` и только когда порция шагов
+    закончилась, вызывает `tick`, который сверяет число шагов и время. Поэтому
+    долгая операция внутри одного вызова по времени не прерывается - для жесткого
+    ограничения есть `KotazyPool`.
+    """
+
+    # порция шагов без проверки времени; счетчик остается малым целым, это быстрее
+    unlimited = 2**30 - 1
+    check_every = 1000
+    # значения, длина которых ограничена `size`
+    sized = frozenset((str, bytes, list, tuple, dict, set))
+
+    def __init__(self, steps=None, timeout=None, depth=None, size=None):
+        """Инициализация ограничений, None - без ограничения"""
+        self.steps = steps
+        self.timeout = timeout
+        self.depth = depth
+        self.size = size
+        self.deadline = None
+        self.used = 0
+        self.chunk = 0
+
+    def start(self):
+        """Начало отсчета, возвращает число шагов до первой проверки"""
+        self.used = 0
+        if self.timeout is not None:
+            self.deadline = time.monotonic() + self.timeout
+        return self.refill()
+
+    def refill(self):
+        """Следующая порция шагов"""
+        self.chunk = self.unlimited if self.deadline is None else self.check_every
+        if self.steps is not None:
+            self.chunk = min(self.chunk, self.steps - self.used)
+        return self.chunk
+
+    def tick(self):
+        """Проверка после окончания порции, возвращает следующую порцию"""
+        self.used += self.chunk + 1
+        if self.steps is not None and self.used > self.steps:
+            raise KotazyBudgetExceeded("steps", self.steps)
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise KotazyBudgetExceeded("timeout", self.timeout)
+        return self.refill()
+
+
 class KotazyFunc:
     """Функция с измененным выводом в консоль"""
 
@@ -82,18 +178,91 @@ class KotazyFunc:
 
 
 class KotazyEnvironment(dict):
-    """Переопределение вывода в консоль"""
+    """Переопределение вывода в консоль: функции читаются обернутыми в `KotazyFunc`
+
+    Обертка создается один раз на имя, остальные значения возвращаются как есть.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.functions = {}
 
     def __getitem__(self, key):
-        # print(key)
         item = dict.__getitem__(self, key)
-        if isinstance(item, dict):
-            return KotazyEnvironment(item)
-        elif isinstance(item, list):
-            return [KotazyEnvironment(i) for i in item if isinstance(i, dict)]
-        elif callable(item):
-            return KotazyFunc(key, item)
-        return dict.__getitem__(self, key)
+        if callable(item):
+            wrapped = self.functions.get(key)
+            if wrapped is None or wrapped.function is not item:
+                wrapped = self.functions[key] = KotazyFunc(key, item)
+            return wrapped
+        return item
+
+
+class KotazyScope:
+    """Область видимости функции: номера локальных переменных в кадре
+
+    Кадр - список `[кадр внешней функции, область, значение, ...]`, поэтому
+    переменные начинаются с номера 2.
+    Общая область (`shared`) своих переменных не имеет: присваивания в ней пишут
+    туда же, откуда читаются, - во внешнюю функцию или в среду.
+    """
+
+    def __init__(self, parent, names, shared=False):
+        """Инициализация области"""
+        self.parent = parent
+        self.slots = {name: i for i, name in enumerate(names, 2)}
+        self.shared = shared
+
+    def resolve(self, name: str):
+        """Возвращает (глубина, номер) переменной или None для глобальной"""
+        scope, depth = self, 0
+        while scope is not None:
+            if name in scope.slots:
+                return depth, scope.slots[name]
+            scope, depth = scope.parent, depth + 1
+        return None
+
+
+class KotazyFunction:
+    """Функция, определенная через `def`: тело выполняется в собственном кадре"""
+
+    __slots__ = ("name", "processor", "scope", "body", "parent", "arity", "padding")
+
+    def __init__(self, name, processor, scope, body, parent, arity):
+        """Инициализация функции"""
+        self.name = name
+        self.processor = processor
+        self.scope = scope
+        self.body = body
+        self.parent = parent
+        self.arity = arity
+        self.padding = [None] * (len(scope.slots) - arity)
+
+    def invoke(self, values: list):
+        """Вызов с вычисленными аргументами"""
+        if len(values) != self.arity:
+            raise Exception(
+                "function {} takes {} arguments, got {}".format(
+                    self.name, self.arity, len(values)
+                )
+            )
+        frame = [self.parent, self.scope, *values, *self.padding]
+        processor = self.processor
+        depth = processor.depth + 1
+        if depth > processor.max_depth:
+            raise KotazyBudgetExceeded("depth", processor.max_depth)
+        saved = processor.frame
+        processor.frame, processor.depth = frame, depth
+        try:
+            return self.body(frame)
+        finally:
+            processor.frame, processor.depth = saved, depth - 1
+
+    def __call__(self, *params):
+        """Вызов с деревьями параметров, как у функций среды"""
+        return self.invoke([self.processor.ast_load(param) for param in params])
+
+    def __repr__(self):
+        return "<function {}>".format(self.name)
 
 
 class KotazyProcessor:
@@ -107,22 +276,82 @@ class KotazyProcessor:
             "ret": lambda *v: self.ast_load_list(v)
             if len(v) > 1
             else self.ast_load(v[0]),
-            "def": lambda n, c: self.ast_define(n, c),
+            "def": lambda n, *c: self.ast_define(n, *c),
             "lse": lambda: print(list(self.environment.keys())), # list system environment
             "fle": lambda: print(self.environment), # full list environment
         }
+        self.frame = None
+        # состояние ограничений, см. `limit`
+        self.budget = None
+        self.ticks = KotazyBudget.unlimited
+        self.depth = 0
+        self.max_depth = KotazyBudget.unlimited
+        self.max_size = None
         self.reset_environment()
+        self.compiler = KotazyCompiler(self)
 
     def reset_environment(self):
         """Сброс среды выполнения"""
-
-        self.environment = KotazyEnvironment(self.default_environment)
+        # среда очищается на месте: скомпилированный код держит ссылку на нее
+        if not hasattr(self, "environment"):
+            self.environment = KotazyEnvironment()
+        self.environment.clear()
+        self.environment.update(self.default_environment)
+        self.frame = None
 
     def install_environments(self, data: dict):
         """Изменяет текущую среду и среду по умолчанию"""
         self.environment.update(data)
         self.default_environment.update(data)
 
+    @contextlib.contextmanager
+    def limit(self, budget: KotazyBudget):
+        """Ограничивает выполнение внутри блока with бюджетом"""
+        saved = self.budget, self.ticks, self.depth, self.max_depth, self.max_size
+        self.budget = budget
+        self.ticks = budget.start()
+        self.depth = 0
+        if budget.depth is not None:
+            self.max_depth = budget.depth
+        self.max_size = budget.size
+        try:
+            yield budget
+        except RecursionError:
+            if budget.depth is None:
+                raise
+            raise KotazyBudgetExceeded("depth", budget.depth) from None
+        finally:
+            self.budget, self.ticks, self.depth, self.max_depth, self.max_size = saved
+
+    def tick(self):
+        """Порция шагов закончилась: проверка бюджета"""
+        if self.budget is None:
+            self.ticks = KotazyBudget.unlimited
+        else:
+            self.ticks = self.budget.tick()
+
+    def check_size(self, size: int):
+        """Проверка длины строки или списка"""
+        if self.max_size is not None and size > self.max_size:
+            raise KotazyBudgetExceeded("size", self.max_size)
+
+    def check_value(self, value):
+        """Проверка размера значения, возвращает значение"""
+        if type(value) in KotazyBudget.sized:
+            self.check_size(len(value))
+        return value
+
+    def variables(self):
+        """Переменные, видимые из текущего кадра: локальные поверх глобальных"""
+        maps = []
+        frame = self.frame
+        while frame is not None:
+            maps.append({name: frame[i] for name, i in frame[1].slots.items()})
+            frame = frame[0]
+        if not maps:
+            return self.environment
+        return collections.ChainMap(*maps, self.environment)
+
     def ast_save(self, name: dict, value: dict):
         """Сохранение значения в среду выполнения"""
         if name["type"] == "var":
@@ -132,6 +361,11 @@ class KotazyProcessor:
 
     def ast_load(self, obj: dict):
         """Загрузка объекта из среды выполнения"""
+        key = obj.get("key")
+        if key is not None:
+            compiled = self.compiler.code.get(id(key))
+            if compiled is not None:
+                return compiled()
         if obj["type"] in ["number", "string"]:
             return obj["val"]
         elif obj["type"] == "var":
@@ -141,10 +375,11 @@ class KotazyProcessor:
         elif obj["type"] == "call":
             return self.ast_run_calls([obj])
 
-    def ast_define(self, name: dict, code: dict):
-        """Определение функции"""
-        if name["type"] == "var":
-            self.environment[name["val"]] = lambda: self.run(code)
+    def ast_define(self, name: dict, *params: dict):
+        """Определение функции: def(name, param, ..., {code})"""
+        if name["type"] == "var" and params:
+            *params, code = params
+            self.compiler.compile_function(name, params, code, None)(self.frame)
 
     def ast_load_list(self, items: list):
         """Загрузка списка объектов из среды выполнения"""
@@ -154,27 +389,344 @@ class KotazyProcessor:
         """Выполнение кода"""
         for call in calls:
             func_obj = self.environment[call["name"]]
-            func_args = func_obj.function.__code__.co_varnames
+            code = getattr(func_obj.function, "__code__", None)
+            func_args = code.co_varnames if code is not None else ()
 
+            self.ticks -= 1
+            if self.ticks < 0:
+                self.tick()
             value = func_obj(
                 *call["params"], **({"_proc": self} if "_proc" in func_args else {})
             )
+            if self.max_size is not None:
+                self.check_value(value)
         return value
 
     def run(self, tree: dict):
         """Выполнение дерева"""
+        key = tree.get("key")
+        if key is not None:
+            compiled = self.compiler.code.get(id(key))
+            if compiled is not None:
+                return compiled()
         return self.ast_run_calls(tree["calls"])
 
 
+def kotazy_assigned(node: dict, names: list):
+    """Собирает имена, которым блок присваивает значения через set и def"""
+    if node["type"] == "code":
+        for call in node["calls"]:
+            kotazy_assigned(call, names)
+    elif node["type"] == "call":
+        params = node["params"]
+        if node["name"] in ("set", "def") and params and params[0]["type"] == "var":
+            if params[0]["val"] not in names:
+                names.append(params[0]["val"])
+        if node["name"] == "def":
+            # тело вложенной функции - отдельная область
+            params = params[:-1]
+        for param in params:
+            kotazy_assigned(param, names)
+    return names
+
+
+class KotazyNodeKey:
+    """Ключ узла дерева для таблиц скомпилированного кода"""
+
+    __slots__ = ("__weakref__",)
+
+
+class KotazyCompiler:
+    """Компиляция дерева в замыкания Python
+
+    Каждый узел компилируется один раз в функцию от кадра. Функция без аргументов,
+    выполняющая узел в текущем кадре процессора, хранится в таблице `code` компилятора
+    по ключу узла (`KotazyNodeKey` под ключом "key"), поэтому `ast_load` и `run`
+    процессора тоже выполняют готовый код, а одно дерево можно выполнять разными
+    процессорами. Запись удаляется из таблицы вместе с деревом.
+    Константы сворачиваются, вызовы `out`, `set`, `ret` и `def` выполняются напрямую,
+    пока имя указывает на встроенную функцию (проверка по идентичности).
+    Переменные функций, объявленных через `def`, разрешаются в номера ячеек кадра,
+    остальные берутся из среды.
+    """
+
+    def __init__(self, processor):
+        """Инициализация компилятора"""
+        self.processor = processor
+        defaults = processor.default_environment
+        self.builtins = {
+            defaults["out"]: self.compile_out,
+            defaults["set"]: self.compile_set,
+            defaults["ret"]: self.compile_ret,
+            defaults["def"]: self.compile_def,
+        }
+        self.proc_cache = {}
+        self.code = {}
+
+    def compile(self, node: dict):
+        """Компилирует дерево в функцию без аргументов"""
+        key = node.get("key")
+        compiled = self.code.get(id(key)) if key is not None else None
+        if compiled is None:
+            self.compile_node(node, None)
+            compiled = self.code[id(node["key"])]
+        return compiled
+
+    @staticmethod
+    def forget(compiler, ident: int):
+        """Удаляет код узла, когда дерево больше не используется"""
+        compiler = compiler()
+        if compiler is not None:
+            compiler.code.pop(ident, None)
+
+    def compile_node(self, node: dict, scope):
+        """Компиляция узла по его типу в функцию от кадра"""
+        if node["type"] in ("number", "string"):
+            value = node["val"]
+            code = lambda frame: value
+        elif node["type"] == "var":
+            code = self.compile_load(node["val"], scope)
+        elif node["type"] == "code":
+            code = self.compile_block(node, scope)
+        elif node["type"] == "call":
+            code = self.compile_call(node, scope)
+        else:
+            raise Exception("invalid node type: ", node)
+        processor = self.processor
+
+        def compiled():
+            # узел, выполняемый функцией среды (например, тело цикла), - шаг бюджета
+            processor.ticks -= 1
+            if processor.ticks < 0:
+                processor.tick()
+            return code(processor.frame)
+
+        key = node.get("key")
+        if key is None:
+            key = node["key"] = KotazyNodeKey()
+        if id(key) not in self.code:
+            weakref.finalize(key, self.forget, weakref.ref(self), id(key))
+        self.code[id(key)] = compiled
+        return code
+
+    def compile_load(self, name: str, scope):
+        """Чтение переменной: из ячейки кадра или из среды"""
+        location = scope.resolve(name) if scope is not None else None
+        if location is None:
+            environment = self.processor.environment
+            return lambda frame: environment[name]
+        depth, slot = location
+        if depth == 0:
+            return lambda frame: frame[slot]
+        elif depth == 1:
+            return lambda frame: frame[0][slot]
+
+        def load(frame):
+            for _ in range(depth):
+                frame = frame[0]
+            return frame[slot]
+
+        return load
+
+    def compile_store(self, name: str, scope):
+        """Запись переменной: в ячейку кадра или в среду"""
+        location = None
+        if scope is not None and scope.shared:
+            location = scope.resolve(name)
+        elif scope is not None and name in scope.slots:
+            location = 0, scope.slots[name]
+        if location is not None:
+            depth, slot = location
+            if depth == 0:
+
+                def store(frame, value):
+                    frame[slot] = value
+
+            else:
+
+                def store(frame, value):
+                    for _ in range(depth):
+                        frame = frame[0]
+                    frame[slot] = value
+
+            return store
+        environment = self.processor.environment
+
+        def store(frame, value):
+            environment[name] = value
+
+        return store
+
+    def compile_block(self, node: dict, scope):
+        """Компиляция блока '{...}'"""
+        calls = [self.compile_node(call, scope) for call in node["calls"]]
+        if len(calls) == 1:
+            return calls[0]
+
+        def block(frame):
+            value = None
+            for call in calls:
+                value = call(frame)
+            return value
+
+        return block
+
+    def compile_call(self, node: dict, scope):
+        """Компиляция вызова: встроенные функции напрямую, остальные через среду"""
+        name, params = node["name"], node["params"]
+        target = None
+        if scope is None or scope.resolve(name) is None:
+            target = dict.get(self.processor.environment, name)
+        if target is self.processor.default_environment["def"]:
+            # тело функции компилируется в своей области, а не как параметр
+            loads = None
+        else:
+            loads = [self.compile_node(param, scope) for param in params]
+        generic = self.compile_generic(name, params, loads, scope)
+        fast = None
+        if callable(target) and target in self.builtins:
+            fast = self.builtins[target](params, loads, scope)
+        if fast is None:
+            return generic
+        get = self.processor.environment.get
+
+        def call(frame):
+            if get(name) is target:
+                return fast(frame)
+            return generic(frame)
+
+        return call
+
+    def compile_generic(self, name: str, params: list, loads: list, scope):
+        """Вызов функции по имени
+
+        Функциям `def` передаются вычисленные аргументы, функциям среды - деревья
+        параметров, как в `ast_run_calls`.
+        """
+        if scope is None or scope.resolve(name) is None:
+            fetch, get = None, self.processor.environment.get
+        else:
+            fetch, get = self.compile_load(name, scope), None
+        params = tuple(params)
+        processor = self.processor
+        proc_cache = self.proc_cache
+        missing = object()
+        sized = KotazyBudget.sized
+
+        def call(frame):
+            nonlocal loads
+            processor.ticks -= 1
+            if processor.ticks < 0:
+                processor.tick()
+            if get is not None:
+                function = get(name, missing)
+                if function is missing:
+                    raise KeyError(name)
+            else:
+                function = fetch(frame)
+            if type(function) is KotazyFunc:
+                while type(function) is KotazyFunc:
+                    function = function.function
+            if type(function) is KotazyFunction:
+                if not params:
+                    return function.invoke(())
+                if loads is None:
+                    loads = [self.compile_node(param, scope) for param in params]
+                return function.invoke([load(frame) for load in loads])
+            code = getattr(function, "__code__", None)
+            proc = proc_cache.get(code)
+            if proc is None:
+                proc = proc_cache[code] = code is not None and (
+                    "_proc" in code.co_varnames
+                )
+            value = function(processor, *params) if proc else function(*params)
+            if (
+                processor.max_size is not None
+                and type(value) in sized
+                and len(value) > processor.max_size
+            ):
+                processor.check_size(len(value))
+            return value
+
+        return call
+
+    def compile_function(self, name: dict, params: list, code: dict, scope):
+        """Определение функции: тело компилируется в новой области видимости"""
+        for param in params:
+            if param["type"] != "var":
+                raise Exception("invalid parameter: ", param)
+        if params:
+            names = [param["val"] for param in params]
+            function_scope = KotazyScope(scope, kotazy_assigned(code, names))
+        else:
+            # функция без параметров присваивает переменные внешней области
+            function_scope = KotazyScope(scope, [], shared=True)
+        body = self.compile_node(code, function_scope)
+        store = self.compile_store(name["val"], scope)
+        processor, arity = self.processor, len(params)
+        function_name = name["val"]
+
+        def define(frame):
+            store(
+                frame,
+                KotazyFunction(
+                    function_name, processor, function_scope, body, frame, arity
+                ),
+            )
+
+        return define
+
+    def is_constant(self, node: dict):
+        """Является ли узел константой"""
+        return node["type"] in ("number", "string")
+
+    def compile_out(self, params: list, loads: list, scope):
+        """out(...) - вывод значений"""
+        if all(self.is_constant(param) for param in params):
+            values = tuple(param["val"] for param in params)
+            return lambda frame: print(*values)
+        return lambda frame: print(*[load(frame) for load in loads])
+
+    def compile_set(self, params: list, loads: list, scope):
+        """set(name, value) - сохранение значения"""
+        if len(params) != 2 or params[0]["type"] != "var":
+            return None
+        store, load = self.compile_store(params[0]["val"], scope), loads[1]
+        return lambda frame: store(frame, load(frame))
+
+    def compile_ret(self, params: list, loads: list, scope):
+        """ret(...) - возврат значения"""
+        if len(params) == 1:
+            return loads[0]
+        elif len(params) > 1:
+            return lambda frame: [load(frame) for load in loads]
+        return None
+
+    def compile_def(self, params: list, loads: list, scope):
+        """def(name, param, ..., {code}) - определение функции"""
+        if (
+            len(params) < 2
+            or params[0]["type"] != "var"
+            or params[-1]["type"] != "code"
+            or any(param["type"] != "var" for param in params[1:-1])
+        ):
+            return None
+        return self.compile_function(params[0], params[1:-1], params[-1], scope)
+
+
 class KotazyRunner:
     """Выполнение кода"""
 
-    def __init__(self):
+    def __init__(self, cache_size=256):
         """Инициализация универсального процессора"""
-        self.parser = KotazyParser()
+        self.parser = KotazyParser(KotazyTransformer)
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
         self.processor = KotazyProcessor()
+        self.compiler = self.processor.compiler
         self.transformer = KotazyTransformer()
         self.evaluator = EvalProcessor()
+        self.pool = None
         self.processor.install_environments(
             {
                 "clc": lambda s: self.evaluator.eval_expression(s["val"]) # calculate
@@ -186,7 +738,7 @@ class KotazyRunner:
                     else None
                 ),
                 "ecl": lambda s: self.evaluator.eval_expression( # evaluate calculate
-                    s["val"], self.processor.environment
+                    s["val"], self.processor.variables()
                 )
                 if s["type"] == "string"
                 else None,
@@ -201,15 +753,116 @@ class KotazyRunner:
         """Преобразует объект в дерево"""
         return self.transformer.transform(object)
 
-    def execute(self, tree: dict):
-        """Выполняет дерево"""
-        return self.processor.run(tree)
+    def compile(self, tree: dict):
+        """Компилирует дерево в функцию"""
+        return self.compiler.compile(tree)
+
+    def execute(self, tree: dict, steps=None, timeout=None, depth=None, size=None):
+        """Выполняет дерево
+
+        С ограничениями выполнение прерывается исключением `KotazyBudgetExceeded`:
+        `steps` - число шагов (см. `KotazyBudget`), `timeout` - секунды, `depth` -
+        глубина вызовов функций `def`, `size` - длина строк и списков.
+        """
+        if steps is None and timeout is None and depth is None and size is None:
+            return self.compile(tree)()
+        check_size = self.evaluator.check_size
+        if size is not None:
+            self.evaluator.check_size = self.processor.check_size
+        try:
+            with self.processor.limit(KotazyBudget(steps, timeout, depth, size)):
+                return self.compile(tree)()
+        finally:
+            self.evaluator.check_size = check_size
+
+    def load(self, code: str, tree=None):
+        """Возвращает дерево кода, повторный код берется из LRU-кэша
 
-    def run(self, code: str):
-        """Выполняет код"""
-        tree = self.parse(code)
-        tree = self.transform(tree)
-        return self.execute(tree)
+        Уже разобранное дерево `tree` кладется в кэш без повторного разбора.
+        """
+        cached = self.cache.get(code)
+        if cached is None:
+            if tree is None:
+                tree = self.transform(self.parse(code))
+            if self.cache_size:
+                self.cache[code] = tree
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            return tree
+        self.cache.move_to_end(code)
+        return cached
+
+    def run(self, code: str, **limits):
+        """Выполняет код, ограничения - как у `execute`"""
+        return self.execute(self.load(code), **limits)
+
+    def run_many(self, scripts, workers=None, setup=None, timeout=None, **limits):
+        """Выполняет много скриптов, возвращает результаты в том же порядке
+
+        Каждый скрипт выполняется в чистой среде, а его ошибка возвращается на его
+        месте вместо результата. Одинаковые скрипты разбираются один раз. При
+        `workers=0` скрипты выполняются в этом процессе, иначе в `KotazyPool` из
+        `workers` процессов (по числу ядер), который создается при первом вызове и
+        переиспользуется. Среду процессов готовит `setup`, см. `get_pool`.
+        """
+        scripts = list(scripts)
+        counts = collections.Counter(scripts)
+        results = {}
+        items = []
+        for code, count in counts.items():
+            try:
+                if workers == 0:
+                    tree = self.load(code)
+                else:
+                    # в процесс пула уходит чистое дерево, без скомпилированных функций
+                    tree = self.transform(self.parse(code))
+            except Exception as e:
+                results[code] = [(False, e)] * count
+            else:
+                items.append((code, tree, count))
+        if workers == 0:
+            for code, tree, count in items:
+                results[code] = [
+                    self.execute_clean(tree, timeout=timeout, **limits)
+                    for _ in range(count)
+                ]
+        elif items:
+            pool = self.get_pool(workers, setup)
+            for code, done in pool.map(items, timeout, **limits).items():
+                results[code] = done
+        for done in results.values():
+            done.reverse()
+        return [results[code].pop()[1] for code in scripts]
+
+    def execute_clean(self, tree: dict, **limits):
+        """Выполняет дерево в чистой среде, возвращает (успех, результат или ошибка)"""
+        self.processor.reset_environment()
+        try:
+            return True, self.execute(tree, **limits)
+        except Exception as e:
+            return False, e
+
+    def get_pool(self, workers=None, setup=None):
+        """Пул процессов для `run_many`
+
+        Процессы не копируют этот runner: `setup` - функция уровня модуля, которая
+        возвращает `KotazyRunner` с установленной средой и вызывается один раз в
+        каждом процессе. Без нее процессы используют обычный `KotazyRunner`.
+        """
+        workers = workers or os.cpu_count() or 1
+        if self.pool is not None and (
+            self.pool.workers != workers or self.pool.setup is not setup
+        ):
+            self.close()
+        if self.pool is None:
+            self.pool = KotazyPool(workers, setup)
+        return self.pool
+
+    def close(self):
+        """Остановка пула процессов"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
 
     def eval(self, expr: str):
         """Вычисляет выражение"""
@@ -218,15 +871,189 @@ class KotazyRunner:
     def set_parser(self, parser):
         """Установка парсера"""
         self.parser = parser
+        self.cache.clear()
 
     def set_transformer(self, transformer):
-        """Установка трансформера"""
+        """Установка трансформера
+
+        `KotazyTransformer` встроен в парсер, с другим трансформером парсер возвращает
+        дерево Lark, и его преобразует `transform`.
+        """
         self.transformer = transformer
+        self.parser = KotazyParser(
+            KotazyTransformer if type(transformer) is KotazyTransformer else None
+        )
+        self.cache.clear()
 
     def set_processor(self, processor):
         """Установка процессора"""
         self.processor = processor
+        self.compiler = processor.compiler
+        self.cache.clear()
 
     def set_evaluator(self, evaluator):
         """Установка вычислителя"""
         self.evaluator = evaluator
+
+
+def kotazy_worker(connection, setup):
+    """Цикл процесса `KotazyPool`: прогретый `KotazyRunner` выполняет присланный код"""
+    runner = setup() if setup is not None else KotazyRunner()
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        items, limits = task
+        results = []
+        for code, tree, count in items:
+            try:
+                tree = runner.load(code, tree)
+            except Exception as e:
+                results.extend([(False, e)] * count)
+                continue
+            results.extend(runner.execute_clean(tree, **limits) for _ in range(count))
+        try:
+            connection.send(results)
+        except Exception:
+            connection.send([kotazy_sendable(result) for result in results])
+
+
+def kotazy_sendable(result: tuple):
+    """Заменяет результат, который не сериализуется, ошибкой"""
+    try:
+        pickle.dumps(result)
+    except Exception as e:
+        return False, Exception("result can not be sent: {}".format(e))
+    return result
+
+
+class KotazyPool:
+    """Пул процессов с прогретыми `KotazyRunner`
+
+    Код выполняется в отдельном процессе, поэтому `timeout` жесткий: процесс
+    получает его как обычное ограничение, а если не ответил и через `grace` секунд,
+    он убивается и заменяется новым. `setup` возвращает `KotazyRunner` процесса и
+    передается в процесс через pickle.
+
+    Процессы запускаются через forkserver (или spawn, где его нет), а не fork:
+    замена процесса происходит из потоков `map`, а fork многопоточного процесса
+    может оставить потомка с захваченной блокировкой.
+    """
+
+    grace = 0.5
+    # частей на процесс в `map`: крупные части дешевле, мелкие лучше делятся
+    chunks_per_worker = 4
+
+    def __init__(self, workers=None, setup=None, context=None):
+        """Запуск процессов"""
+        self.setup = setup
+        if context is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = "forkserver" if "forkserver" in methods else "spawn"
+        self.context = multiprocessing.get_context(context)
+        self.idle = queue.Queue()
+        self.workers = workers or os.cpu_count() or 1
+        for _ in range(self.workers):
+            self.idle.put(self.spawn())
+
+    def spawn(self):
+        """Запускает процесс, возвращает (процесс, соединение)"""
+        connection, child = self.context.Pipe()
+        process = self.context.Process(
+            target=kotazy_worker, args=(child, self.setup), daemon=True
+        )
+        process.start()
+        child.close()
+        return process, connection
+
+    def execute(self, items: list, timeout=None, **limits):
+        """Выполняет [(код, дерево или None, повторы), ...] в одном процессе
+
+        Возвращает список (успех, результат или ошибка) по каждому выполнению. Если
+        процесс пришлось убить или он упал, части выполняются заново по одной, чтобы
+        ошибку получил только виновный скрипт.
+        """
+        total = sum(count for _, _, count in items)
+        process, connection = worker = self.idle.get()
+        try:
+            connection.send((items, dict(limits, timeout=timeout)))
+            wait = None if timeout is None else timeout * total + self.grace
+            if connection.poll(wait):
+                return connection.recv()
+            process.kill()
+            process.join()
+            worker = self.spawn()
+            error = KotazyBudgetExceeded("timeout", timeout)
+        except (EOFError, OSError):
+            process.join()
+            worker = self.spawn()
+            error = Exception(
+                "kotazy worker exited with code {}".format(process.exitcode)
+            )
+        finally:
+            self.idle.put(worker)
+        if total == 1:
+            return [(False, error)]
+        return [
+            result
+            for code, tree, count in items
+            for _ in range(count)
+            for result in self.execute([(code, tree, 1)], timeout, **limits)
+        ]
+
+    def run(self, code: str, timeout=None, **limits):
+        """Выполняет код в свободном процессе, ограничения - как у `KotazyRunner.run`"""
+        [(ok, value)] = self.execute([(code, None, 1)], timeout, **limits)
+        if not ok:
+            raise value
+        return value
+
+    def map(self, items: list, timeout=None, **limits):
+        """Выполняет [(код, дерево, повторы), ...] во всех процессах сразу
+
+        Возвращает {код: [(успех, результат или ошибка), ...]}.
+        """
+        total = sum(count for _, _, count in items)
+        size = -(-total // (self.workers * self.chunks_per_worker))
+        chunks, chunk, filled = [], [], 0
+        for code, tree, count in items:
+            while count:
+                part = min(count, size - filled)
+                chunk.append((code, tree, part))
+                count -= part
+                filled += part
+                if filled == size:
+                    chunks.append(chunk)
+                    chunk, filled = [], 0
+        if chunk:
+            chunks.append(chunk)
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            done = executor.map(
+                lambda chunk: self.execute(chunk, timeout, **limits), chunks
+            )
+            for chunk, chunk_results in zip(chunks, done):
+                position = 0
+                for code, _, count in chunk:
+                    results.setdefault(code, []).extend(
+                        chunk_results[position : position + count]
+                    )
+                    position += count
+        return results
+
+    def close(self):
+        """Остановка процессов"""
+        for _ in range(self.workers):
+            process, connection = self.idle.get()
+            connection.send(None)
+            process.join()
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -9,6 +9,8 @@ class EvalProcessor:
         """Инициализация процессора"""
         self.default_environment = {}
         self.environment = self.reset_environment()
+        # проверка длины строк и списков до того, как они созданы
+        self.check_size = None
         self.avaliable_operators = {
             ast.Add: op.add,
             ast.Sub: op.sub,
@@ -35,10 +37,11 @@ class EvalProcessor:
         if isinstance(node, ast.Num):
             return node.n
         elif isinstance(node, ast.BinOp):
-            return operators[type(node.op)](
-                self.node_eval(node.left, environment=environment),
-                self.node_eval(node.right, environment=environment),
-            )
+            left = self.node_eval(node.left, environment=environment)
+            right = self.node_eval(node.right, environment=environment)
+            if self.check_size is not None:
+                self.check_size(self.result_size(node.op, left, right))
+            return operators[type(node.op)](left, right)
         elif isinstance(node, ast.UnaryOp):
             return operators[type(node.op)](
                 self.node_eval(node.operand, environment=environment)
@@ -56,6 +59,20 @@ class EvalProcessor:
         else:
             raise Exception("invalid eval type: ", node)
 
+    @staticmethod
+    def result_size(operator, left, right):
+        """Длина строки или списка, которую даст операция, 0 для чисел"""
+        sized = (str, bytes, list, tuple)
+        if isinstance(operator, ast.Mult):
+            if isinstance(left, sized) and isinstance(right, int):
+                return len(left) * right
+            if isinstance(right, sized) and isinstance(left, int):
+                return len(right) * left
+        elif isinstance(operator, ast.Add):
+            if isinstance(left, sized) and isinstance(right, sized):
+                return len(left) + len(right)
+        return 0
+
     def eval_expression(self, expr: str, environment=None):
         """Вычисляет большое выражение"""
         if environment is None:
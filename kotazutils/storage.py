@@ -1,8 +1,25 @@
+import atexit
+import base64
+import bisect
+import collections
+import collections.abc
+import datetime
+import hashlib
+import heapq
+import itertools
+import os
+import pickle
 import shlex
+import tempfile
+import threading
+import types
 import ujson
+import uuid
+import weakref
 from audioop import add
 import sqlite3
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
+from operator import itemgetter
 import yaml
 
 try:
@@ -10,8 +27,12 @@ try:
 except ImportError:
     from yaml import Loader, Dumper
 
+try:
+    import fcntl
+except ImportError:  # Windows, locks then only serialize threads of one process
+    fcntl = None
+
 print = __import__("rich").print
-import weakref
 
 
 class Observer(object):
@@ -62,7 +83,15 @@ class Observer(object):
         ...         )
     """
 
-    def __init__(self, init_value=None, callback=None, **kwargs):
+    def __init__(
+        self,
+        init_value=None,
+        callback=None,
+        change_callback=None,
+        check_callback=None,
+        lock=None,
+        **kwargs,
+    ):
         """
         Args:
             init_value: initial value for data, if there is none
@@ -71,125 +100,531 @@ class Observer(object):
                     observer is an Observer object, with all additional data attached to it,
                     instance is an instance of the object, where the actual data lives,
                     value is the data itself.
+            change_callback: callback(observer, instance, change) receiving an `ObserverChange`
+                describing what exactly has changed
+            check_callback: callback(observer, instance, change) called before the change is made,
+                raising rejects it. `old` is None for method calls, their result is not known yet
+            lock: lock held while the data is changed and the callbacks run, so other threads
+                holding it see the data between changes
             **kwargs: additional arguments needed to make inheritance possible. See the example above, to get an
                 idea, how the proper inheritance should look like.
-                The main challenge here comes from the fact, that class constructor is used inside the class methods,
-                which is quite tricky, when you want to change the `__init__` function signature in derived classes.
         """
         self.init_value = init_value
         self.callback = callback
+        self.change_callback = change_callback
+        self.check_callback = check_callback
+        self.lock = nullcontext() if lock is None else lock
         self.kwargs = kwargs
         self.kwargs.update(
             {
                 "callback": callback,
+                "change_callback": change_callback,
+                "check_callback": check_callback,
+                "lock": lock,
             }
         )
+        self.name = None
+        self._owner_to_name_mapping = {}
 
-        self._value = None
-
-        self._instance_to_name_mapping = {}
-        self._instance = None
-
-        self._parent_observer = None
-
-        self._value_parent = None
-        self._value_index = None
-
-    @property
-    def value(self):
-        """Returns the content of attached data."""
-        return self._value
+    def __set_name__(self, owner, name):
+        self.name = name
 
     def _get_attr_name(self, instance):
         """To respect DRY methodology, we try to find out, what the original name of the descriptor is and
-        use it as instance variable to store actual data.
+        use it as instance variable to store actual data. Normally the name comes from `__set_name__`,
+        descriptors attached after the class creation are looked up once per class.
 
         Args:
             instance: instance of the object
 
         Returns: (str): attribute name, where `Observer` will store the data
         """
-        if instance in self._instance_to_name_mapping:
-            return self._instance_to_name_mapping[instance]
-        for attr_name, attr_value in instance.__class__.__dict__.items():
-            if attr_value is self:
-                self._instance_to_name_mapping[weakref.ref(instance)] = attr_name
-                return attr_name
+        if self.name is not None:
+            return self.name
+        owner = type(instance)
+        if owner not in self._owner_to_name_mapping:
+            for klass in owner.__mro__:
+                for attr_name, attr_value in klass.__dict__.items():
+                    if attr_value is self:
+                        self._owner_to_name_mapping[owner] = attr_name
+                        return attr_name
+        return self._owner_to_name_mapping[owner]
 
     def __get__(self, instance, owner):
+        if instance is None:
+            return self
         attr_name = self._get_attr_name(instance)
         attr_value = instance.__dict__.get(attr_name, self.init_value)
 
-        observer = self.__class__(**self.kwargs)
-        observer._value = attr_value
-        observer._instance = instance
-        return observer
+        # the proxy is reused until the attribute is replaced
+        proxy_name = "_observed_" + attr_name
+        proxy = instance.__dict__.get(proxy_name)
+        if proxy is None or proxy._value is not attr_value:
+            proxy = instance.__dict__[proxy_name] = ObservedValue(
+                self, instance, attr_value
+            )
+        return proxy
 
     def __set__(self, instance, value):
         attr_name = self._get_attr_name(instance)
-        instance.__dict__[attr_name] = value
-        self._value = value
-        self._instance = instance
-        self.divulge()
+        old = instance.__dict__.get(attr_name, self.init_value)
+        if isinstance(value, ObservedValue):
+            value = value._value
+            if value is old:
+                # `data += ...` was already reported by the proxy
+                return
+        change = ObserverChange((), "set", old, value)
+        with self.lock:
+            self.check(instance, change)
+            instance.__dict__[attr_name] = value
+            self.divulge(instance, value, change)
+
+    def check(self, instance, change):
+        """Lets `check_callback` reject the change before it is made"""
+        if self.check_callback:
+            self.check_callback(self, instance, change)
+
+    def divulge(self, instance, value, change=None):
+        """Divulges that data content has been change calling callback."""
+        if self.callback:
+            self.callback(self, instance, value)
+        if self.change_callback and change is not None:
+            self.change_callback(self, instance, change)
 
-    def __getitem__(self, key):
-        observer = self.__class__(**self.kwargs)
-        observer._value = self._value[key]
-        observer._parent_observer = self
-        observer._value_parent = self._value
-        observer._value_index = key
-        return observer
 
-    def __setitem__(self, key, value):
-        self._value[key] = value
-        self.divulge()
+ObserverChange = collections.namedtuple(
+    "ObserverChange", ["path", "operation", "old", "new"]
+)
+ObserverChange.__doc__ = """Single change of observed data.
+
+path: tuple of keys from the observed value to the changed item
+operation: "set" and "delete" change the item at `path`, other operations are methods
+    called on the container at `path` with the `new` list of arguments
+old: previous item for "set"/"delete", result of the method call otherwise
+"""
+
+
+class ObservedValue(object):
+    """Lightweight proxy to a value observed by `Observer` or to a nested item of it.
+
+    Proxies of nested items are cached per key and reused as long as the key still holds
+    the same object, so reading `data["a"]["b"]` in a loop does not allocate. The cache
+    entry is dropped when the item is removed or replaced.
+    Every mutation is reported with an `ObserverChange`.
+    """
+
+    __slots__ = ("_observer", "_instance", "_value", "_root", "_path", "_children")
+
+    mutators = frozenset(
+        ["append", "extend", "insert", "remove", "pop", "sort", "reverse"]  # list
+        + ["clear", "update", "popitem", "setdefault"]  # dict
+        + ["add", "discard", "difference_update", "intersection_update"]  # set
+        + ["symmetric_difference_update"]
+    )
+
+    def __init__(self, observer, instance, value, root=None, path=()):
+        self._observer = observer
+        self._instance = instance
+        self._value = value
+        self._root = root or self
+        self._path = path
+        self._children = None
 
-    def divulge(self):
+    @property
+    def value(self):
+        """Returns the content of attached data."""
+        return self._value
+
+    def divulge(self, change=None):
         """Divulges that data content has been change calling callback."""
         # we want to evoke the very first observer with complete set of data, not the nested one
-        if self._parent_observer:
-            self._parent_observer.divulge()
+        root = self._root
+        root._observer.divulge(root._instance, root._value, change)
+
+    def check(self, path, operation, old, new):
+        """Lets the observer reject a change before it is made"""
+        root = self._root
+        if root._observer.check_callback:
+            root._observer.check(
+                root._instance, ObserverChange(path, operation, old, new)
+            )
+
+    def _child(self, key, value):
+        return ObservedValue(
+            self._observer, self._instance, value, self._root, self._path + (key,)
+        )
+
+    def _forget(self, key=None):
+        # list indexes shift on removal, so only dict entries are dropped one by one
+        if self._children:
+            if key is not None and isinstance(self._value, dict):
+                self._children.pop(key, None)
+            else:
+                self._children = None
+
+    def __getitem__(self, key):
+        value = self._value[key]
+        children = self._children
+        if children is None:
+            children = self._children = {}
+        try:
+            child = children.get(key)
+        except TypeError:  # slices and other unhashable keys are not cached
+            return self._child(key, value)
+        if child is None or child._value is not value:
+            child = children[key] = self._child(key, value)
+        return child
+
+    def __setitem__(self, key, value):
+        with self._root._observer.lock:
+            try:
+                old = self._value[key]
+            except (KeyError, IndexError):
+                old = None
+            if isinstance(value, ObservedValue):
+                value = value._value
+                if value is old:
+                    # `data[key] += ...` was already reported by the proxy of the item
+                    return
+            self.check(self._path + (key,), "set", old, value)
+            self._value[key] = value
+            self._forget(key)
+            self.divulge(ObserverChange(self._path + (key,), "set", old, value))
+
+    def __delitem__(self, key):
+        with self._root._observer.lock:
+            old = self._value[key]
+            self.check(self._path + (key,), "delete", old, None)
+            del self._value[key]
+            self._forget(key)
+            self.divulge(ObserverChange(self._path + (key,), "delete", old, None))
+
+    def __iadd__(self, other):
+        value = self._value
+        if not hasattr(value, "__iadd__"):
+            # immutable values are replaced by the parent's __setitem__
+            return value + other
+        other = list(other) if isinstance(value, list) else other
+        with self._root._observer.lock:
+            self.check(self._path, "extend", None, [other])
+            value += other
+            self.divulge(ObserverChange(self._path, "extend", None, [other]))
+        return self
+
+    def _call(self, item, attr, args, kwargs):
+        if item == "setdefault":
+            key = args[0]
+            if key in self._value:
+                return attr(*args)
+            default = args[1] if len(args) > 1 else None
+            self.check(self._path + (key,), "set", None, default)
+            result = attr(*args)
+            self.divulge(ObserverChange(self._path + (key,), "set", None, result))
+            return result
+        if item in ("extend", "update") or item.endswith("_update"):
+            # iterators can be consumed only once, keep a copy for the change
+            args = [arg if isinstance(arg, (dict, list)) else list(arg) for arg in args]
+        if item == "update" and kwargs:
+            args, kwargs = [dict(*args, **kwargs)], {}
+        if item not in ("sort", "reverse"):
+            self.check(self._path, item, None, list(args))
+        result = attr(*args, **kwargs)
+        if item == "pop" and args:
+            self._forget(args[0])
+        elif item == "popitem":
+            self._forget(result[0])
+        elif item not in ("append", "extend", "add"):
+            self._forget()
+        if item in ("sort", "reverse"):
+            # sort keys can not be recorded, report the new order instead
+            change = ObserverChange(self._path, "set", None, self._value)
+        elif item == "popitem":
+            # report what was removed, so replaying the change removes the same item
+            change = ObserverChange(
+                self._path + (result[0],), "delete", result[1], None
+            )
+        elif item == "pop" and isinstance(self._value, (set, frozenset)):
+            change = ObserverChange(self._path, "remove", None, [result])
         else:
-            if self.callback:
-                self.callback(self, self._instance, self._value)
+            change = ObserverChange(self._path, item, result, list(args))
+        self.divulge(change)
+        return result
 
     def __getattr__(self, item):
         """Mock behaviour of data attach to `Observer`. If certain behaviour mutate attached data, additional
         wrapper comes into play, evoking attached callback.
         """
+        attr = getattr(self._value, item)
+        if item in self.mutators:
 
-        def observe(o, f):
             def wrapper(*args, **kwargs):
-                result = f(*args, **kwargs)
-                o.divulge()
-                return result
+                with self._root._observer.lock:
+                    return self._call(item, attr, args, kwargs)
 
             return wrapper
+        return attr
 
-        attr = getattr(self._value, item)
+    def __len__(self):
+        return len(self._value)
 
-        if item in (
-            ["append", "extend", "insert", "remove", "pop", "sort", "reverse"]
-            + ["clear", "pop", "update"]  # list methods  # dict methods
-        ):
-            return observe(self, attr)
-        return attr
+    def __iter__(self):
+        return iter(self._value)
+
+    def __contains__(self, item):
+        return item in self._value
+
+    def __repr__(self):
+        return "<ObservedValue {!r}>".format(self._value)
+
+
+def observer_apply(data, entry):
+    """Replays a change recorded from `ObserverChange` as `[path, operation, new]` on the data"""
+    path, operation, new = entry
+    target = data
+    if operation in ("set", "delete"):
+        *path, key = path
+    for step in path:
+        target = target[step]
+    if operation == "set":
+        target[key] = new
+    elif operation == "delete":
+        del target[key]
+    else:
+        getattr(target, operation)(*new)
+
+
+class Serializer:
+    """Converts storage data to bytes and back"""
+
+    name = "SERIALIZER"
+
+    def dumps(self, data):
+        raise NotImplementedError
+
+    def loads(self, content):
+        raise NotImplementedError
 
+    def detect(self, content):
+        """Checks if the content looks like this format"""
+        return False
+
+
+class YamlSerializer(Serializer):
+    name = "yaml"
+
+    def dumps(self, data):
+        return yaml.dump(data, Dumper=Dumper).encode()
+
+    def loads(self, content):
+        return yaml.load(content, Loader=Loader)
+
+    def detect(self, content):
+        return True
+
+
+class JsonSerializer(Serializer):
+    name = "json"
+
+    def dumps(self, data):
+        return ujson.dumps(data).encode()
+
+    def loads(self, content):
+        return ujson.loads(content)
+
+    def detect(self, content):
+        return content.lstrip()[:1] in (b"{", b"[")
+
+
+class PickleSerializer(Serializer):
+    name = "pickle"
+    protocol = min(5, pickle.HIGHEST_PROTOCOL)
+
+    def dumps(self, data):
+        return pickle.dumps(data, protocol=self.protocol)
+
+    def loads(self, content):
+        return pickle.loads(content)
+
+    def detect(self, content):
+        return content[:1] == b"\x80"
+
+
+serializers = {
+    serializer.name: serializer
+    for serializer in (PickleSerializer(), JsonSerializer(), YamlSerializer())
+}
+
+
+def serializer_get(serializer):
+    """Returns a serializer by name, serializer objects are returned as is"""
+    if isinstance(serializer, Serializer):
+        return serializer
+    if serializer not in serializers:
+        raise Exception("Serializer '{}' does not exist".format(serializer))
+    return serializers[serializer]
+
+
+def serializer_loads(content):
+    """Detects the format of the content and loads it. YAML is the fallback format"""
+    for serializer in serializers.values():
+        if serializer.detect(content):
+            try:
+                return serializer.loads(content)
+            except ValueError:
+                if serializer.name == "json":
+                    # flow style YAML looks like JSON
+                    continue
+                raise
+
+
+def storage_convert(source, target, serializer):
+    """Rewrites a storage file in another format
+
+    >>> storage_convert("data.yml", "data.json", "json")
+    """
+    with open(source, "rb") as f:
+        data = serializer_loads(f.read())
+    atomic_write(target, serializer_get(serializer).dumps(data))
+
+
+class DebouncedWriter:
+    """Coalesces change notifications into fewer writes.
+
+    `notify` only remembers the latest value. It is written `delay` seconds after the first
+    unsaved change (on a background timer), as soon as `max_pending` changes accumulate,
+    on `flush()` or at interpreter exit until `close()`. The value is written under `lock`,
+    pass the lock its owner holds while changing it, so the timer thread never sees it
+    half changed. Changes stay pending if the write fails.
+    """
+
+    def __init__(self, write, delay=None, max_pending=None, lock=None):
+        self.write = write
+        self.delay = delay
+        self.max_pending = max_pending
+        self.value = None
+        self.pending = 0
+        self.timer = None
+        self.lock = threading.RLock() if lock is None else lock
+        atexit.register(self.flush)
+
+    def notify(self, value):
+        with self.lock:
+            self.value = value
+            self.pending += 1
+            if self.max_pending and self.pending >= self.max_pending:
+                self.flush()
+            elif self.delay is not None and self.timer is None:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.pending:
+                self.write(self.value)
+                self.pending = 0
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            atexit.unregister(self.flush)
+
+
+def create_autoyaml(
+    name,
+    get_load=True,
+    get_save=False,
+    additional=None,
+    serializer="yaml",
+    delay=None,
+    max_pending=None,
+    journal=False,
+    fsync="always",
+):
+    """Returns an object whose `data` attribute is written to the file on every change.
+
+    By default every change rewrites the file. With `delay` (seconds) and/or `max_pending`
+    changes are coalesced by `DebouncedWriter`, `auto.flush()` writes pending changes at once
+    and `auto.close()` writes them and stops writing at exit.
+    With `journal=True` only the changes are appended to `<name>.log` (see `JournalBackend`),
+    assigning the whole `data` compacts the log, changes `journal_dumps` can not encode raise
+    TypeError and leave the data as it was. Every change is appended at once, so `delay` and
+    `max_pending` can not be combined with it, `fsync` is passed to `JournalBackend`.
+    Files are always replaced atomically.
+    Changes and writes hold the same lock, so a delayed write never sees half a change.
+
+    >>> auto, load = create_autoyaml("data.yml", delay=0.5, max_pending=1000)
+    """
+    serializer = serializer_get(serializer)
+    backend = None
+    if journal:
+        if delay is not None or max_pending:
+            raise Exception("delay and max_pending can not be used with journal=True")
+        backend = JournalBackend(
+            name, fsync=fsync, serializer=serializer, apply=observer_apply
+        )
+
+    def read():
+        if backend is not None:
+            return backend.load()
+        with open(name, "rb") as f:
+            return serializer_loads(f.read())
+
+    def write(value):
+        if backend is not None:
+            backend.save(value)
+            return
+        atomic_write(name, serializer.dumps(value))
+
+    # held by the changes and by the writes, a background flush never sees half a change
+    lock = threading.RLock()
+    writer = None
+    if backend is None and (delay is not None or max_pending):
+        writer = DebouncedWriter(write, delay, max_pending, lock)
 
-def create_autoyaml(name, get_load=True, get_save=False, additional=None):
     def action(self, instance, value):
         if additional:
             additional(self, instance, value)
-        with open(name, "w") as f:
-            yaml.dump(value, f, Dumper=Dumper)
+        if writer is not None:
+            writer.notify(value)
+        elif backend is None:
+            write(value)
+
+    def check(self, instance, change):
+        # a change the journal can not hold is rejected before the data is touched
+        if change.path or change.operation != "set":
+            journal_dumps([list(change.path), change.operation, change.new])
+
+    def change(self, instance, change):
+        if not change.path and change.operation == "set":
+            write(change.new)
+        else:
+            entry = [list(change.path), change.operation, change.new]
+            backend.write(auto.data.value, [entry])
 
     class AutoYaml(object):
-        data = Observer("", action)
+        if backend is not None:
+            data = Observer("", action, change, check, lock)
+        else:
+            data = Observer("", action, lock=lock)
+
+        def flush(self):
+            if writer is not None:
+                writer.flush()
+
+        def close(self):
+            if writer is not None:
+                writer.close()
+            if backend is not None:
+                backend.close()
 
     auto = AutoYaml()
     try:
-        with open(name, "r") as f:
-            auto.data = yaml.load(f, Loader=Loader)
+        auto.data = read()
     except FileNotFoundError:
         auto.data = {}
 
@@ -197,15 +632,16 @@ def create_autoyaml(name, get_load=True, get_save=False, additional=None):
     if get_load:
 
         def load():
-            with open(name, "r") as f:
-                auto.data = yaml.load(f, Loader=Loader)
+            auto.data = read()
 
         returned.append(load)
     if get_save:
 
         def save():
-            with open(name, "w") as f:
-                yaml.dump(dict(auto.data.value), f, Dumper=Dumper)
+            with lock:
+                write(dict(auto.data.value))
+                if writer is not None:
+                    writer.pending = 0
 
         returned.append(save)
     return returned
@@ -238,8 +674,6 @@ class ColumnAttribute:
             additional += " AUTOINCREMENT"
         if self.unique:
             additional += " UNIQUE"
-        if self.index:
-            additional += " INDEX"
         return "{} {} {}".format(self.name, self.type, additional)
 
     @classmethod
@@ -346,49 +780,362 @@ class Columns:
 
 
 class Table:
-    def __init__(self, cursor, name):
-        self.cursor = cursor
+    def __init__(self, base, name):
+        self.base = base
         self.name = name
+        self.statements = {}
+
+    @property
+    def cursor(self):
+        return self.base.cursor
 
     def insert(self, *data):
-        """
+        """Inserts the rows and commits, inside `SimpleBase.transaction` it commits with it
+
         insert({"name": "Alex", "age": 25, "city": "Moscow", "rate": 5.5, "description": "Lorem ipsum", "uuid": "123456789"})
         """
-        columns = ", ".join(data[0].keys())
-        values = ", ".join(["?"] * len(data[0]))
-        sql = "INSERT INTO {} ({}) VALUES ({})".format(self.name, columns, values)
-        self.cursor.execute(sql, [data[0][key] for key in data[0].keys()])
+        with self.base.transaction(savepoint=len(data) > 1):
+            for row in data:
+                columns = ", ".join(row.keys())
+                values = ", ".join(["?"] * len(row))
+                sql = "INSERT INTO {} ({}) VALUES ({})".format(
+                    self.name, columns, values
+                )
+                self.cursor.execute(sql, list(row.values()))
         return self.cursor.lastrowid
 
-    def get(self, order=None, limit=None, offset=None, **kwargs):
-        additional = ""
+    def insert_many(self, rows, chunk_size=1000):
+        """Inserts rows with `executemany` in a single transaction. All rows must have the same keys
+
+        insert_many([{"name": "Alex", "age": 25}, {"name": "Bob", "age": 30}])
+        """
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return 0
+        columns = list(first.keys())
+        sql = "INSERT INTO {} ({}) VALUES ({})".format(
+            self.name, ", ".join(columns), ", ".join(["?"] * len(columns))
+        )
+        values = (
+            [row[column] for column in columns]
+            for row in itertools.chain([first], rows)
+        )
+        count = 0
+        with self.base.transaction():
+            while chunk := list(itertools.islice(values, chunk_size)):
+                self.cursor.executemany(sql, chunk)
+                count += len(chunk)
+        return count
+
+    operators = {
+        "eq": "{} = ?",
+        "ne": "{} != ?",
+        "gt": "{} > ?",
+        "gte": "{} >= ?",
+        "lt": "{} < ?",
+        "lte": "{} <= ?",
+        "contains": "instr({}, ?) > 0",
+    }
+
+    def _select(self, order=None, limit=None, offset=None, desc=True, **filters):
+        """Returns the SELECT statement and its parameters
+
+        Filters are `column=value` or `column__operator=value` (operators from `operators` and "in").
+        Statements are cached by the query shape, so SQLite reuses prepared statements.
+        """
+        shape = [order, desc, limit is not None, offset is not None]
+        parameters = []
+        for key, value in filters.items():
+            column, _, operator = key.partition("__")
+            operator = operator or "eq"
+            if operator == "in":
+                value = list(value)
+                shape.append((column, operator, len(value)))
+                parameters.extend(value)
+            else:
+                if operator in ("eq", "ne") and value is None:
+                    operator = "is" if operator == "eq" else "is not"
+                shape.append((column, operator))
+                parameters.append(value)
+        if limit is not None or offset is not None:
+            parameters.append(-1 if limit is None else limit)
+        if offset is not None:
+            parameters.append(offset)
+        shape = tuple(shape)
+        if shape not in self.statements:
+            self.statements[shape] = self._select_sql(shape)
+        return self.statements[shape], parameters
+
+    def _select_sql(self, shape):
+        order, desc, limit, offset, *filters = shape
+        conditions = []
+        for column, operator, *size in filters:
+            if not column.isidentifier():
+                raise Exception("Invalid column name '{}'".format(column))
+            if operator == "in":
+                conditions.append(
+                    "{} IN ({})".format(column, ", ".join(["?"] * size[0]))
+                )
+            elif operator in ("is", "is not"):
+                conditions.append("{} {} ?".format(column, operator.upper()))
+            elif operator in self.operators:
+                conditions.append(self.operators[operator].format(column))
+            else:
+                raise Exception("Operator '{}' does not exist".format(operator))
+        sql = "SELECT * FROM {}".format(self.name)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
         if order:
-            additional += "ORDER BY {} DESC".format(order)
-        if limit:
-            additional += " LIMIT {}".format(limit)
+            if not order.isidentifier():
+                raise Exception("Invalid column name '{}'".format(order))
+            sql += " ORDER BY {} {}".format(order, "DESC" if desc else "ASC")
+        if limit or offset:
+            sql += " LIMIT ?"
         if offset:
-            additional += " OFFSET {}".format(offset)
-        sql = "SELECT * FROM {} {}".format(self.name, additional)
-        self.cursor.execute(sql)
+            sql += " OFFSET ?"
+        return sql
+
+    def get(self, order=None, limit=None, offset=None, desc=True, **filters):
+        """
+        get(order="age", limit=10, city="Moscow", age__gte=18)
+        """
+        self.cursor.execute(*self._select(order, limit, offset, desc, **filters))
         return self.cursor.fetchall()
 
+    def iter(
+        self, order=None, limit=None, offset=None, desc=True, batch_size=1000, **filters
+    ):
+        """Like `get`, but yields rows fetching `batch_size` rows at a time"""
+        cursor = self.cursor.connection.cursor()
+        try:
+            cursor.execute(*self._select(order, limit, offset, desc, **filters))
+            while rows := cursor.fetchmany(batch_size):
+                yield from rows
+        finally:
+            cursor.close()
+
+    def explain(self, order=None, limit=None, offset=None, desc=True, **filters):
+        """Returns SQLite's query plan of the same `get` call"""
+        sql, parameters = self._select(order, limit, offset, desc, **filters)
+        self.cursor.execute("EXPLAIN QUERY PLAN " + sql, parameters)
+        return self.cursor.fetchall()
+
+
+sqlite_profiles = {
+    "default": {},
+    # concurrent readers with a single writer, durable on commit up to the last checkpoint
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+    },
+    # bulk loading, the database may be lost on a power failure
+    "bulk": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "cache_size": -262144,
+        "mmap_size": 1073741824,
+        "temp_store": "MEMORY",
+    },
+}
+
+
+class ThreadConnection:
+    """Connection and cursor of one thread, kept in the pool's thread-local storage"""
+
+    __slots__ = ("connection", "cursor", "__weakref__")
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = None
+
+
+class ConnectionPool:
+    """Opens one connection per thread, configured with the PRAGMA values.
+
+    A thread's connection is closed when the thread ends.
+    In-memory databases are private to a connection, so ":memory:" shares a single connection,
+    transactions of different threads on it take turns holding `shared_lock`.
+    """
+
+    def __init__(self, name, pragmas=None, timeout=30.0, cached_statements=256):
+        self.name = name
+        self.pragmas = pragmas or {}
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        self.shared = None
+        self.shared_lock = None
+        if name == ":memory:":
+            self.shared = self._connect()
+            self.shared_lock = threading.RLock()
+
+    def _connect(self):
+        # connections are used by their own thread only, but `close` may run in any thread
+        connection = sqlite3.connect(
+            self.name,
+            timeout=self.timeout,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        for pragma, value in self.pragmas.items():
+            connection.execute("PRAGMA {} = {}".format(pragma, value))
+        with self.lock:
+            self.connections.append(connection)
+        return connection
+
+    def _thread(self):
+        thread = getattr(self.local, "thread", None)
+        if thread is None:
+            if self.shared is not None:
+                thread = self.local.thread = ThreadConnection(self.shared)
+            else:
+                thread = self.local.thread = ThreadConnection(self._connect())
+                # thread-local values are dropped when the thread ends
+                weakref.finalize(
+                    thread,
+                    self._release,
+                    self.lock,
+                    self.connections,
+                    thread.connection,
+                )
+        return thread
+
+    @staticmethod
+    def _release(lock, connections, connection):
+        with lock:
+            if connection in connections:
+                connections.remove(connection)
+        connection.close()
+
+    def connection(self):
+        if self.shared is not None:
+            return self.shared
+        return self._thread().connection
+
+    def cursor(self):
+        """Cursor of the current thread's connection"""
+        thread = self._thread()
+        if thread.cursor is None:
+            thread.cursor = thread.connection.cursor()
+        return thread.cursor
+
+    def close(self):
+        with self.lock:
+            connections = list(self.connections)
+            self.connections.clear()
+        for connection in connections:
+            connection.close()
+
 
 class SimpleBase:
-    def __init__(self, name):
+    """SQLite database. Every thread works through its own connection.
+
+    Args:
+        profile: name of the PRAGMA set from `sqlite_profiles`
+        **pragmas: PRAGMA values overriding the profile, e.g. `cache_size=-16384`
+    """
+
+    def __init__(self, name, profile="default", **pragmas):
+        if profile not in sqlite_profiles:
+            raise Exception("Profile '{}' does not exist".format(profile))
         self.name = name
-        self.connection = sqlite3.connect(self.name)
-        self.cursor = self.connection.cursor()
+        self.pragmas = dict(sqlite_profiles[profile])
+        self.pragmas.update(pragmas)
+        self.pool = ConnectionPool(self.name, self.pragmas)
+        # connection -> depth of its open `transaction` blocks
+        self.depths = {}
 
     def __del__(self):
-        self.connection.close()
+        if hasattr(self, "pool"):
+            self.pool.close()
+
+    @property
+    def connection(self):
+        return self.pool.connection()
+
+    @property
+    def cursor(self):
+        return self.pool.cursor()
+
+    def snapshot(self, target, pages=1024, sleep=0.0):
+        """Copies the database to the file `target` with SQLite's online backup API.
+
+        The copy is made `pages` pages at a time, between the steps other connections can write
+        (if they do, the backup restarts so the copy is consistent). With the "wal" profile
+        `pages=-1` copies everything in one step without blocking writers at all.
+        Uncommitted changes of the current thread's connection must be committed first.
+        """
+        destination = sqlite3.connect(target)
+        try:
+            self.connection.backup(destination, pages=pages, sleep=sleep)
+        finally:
+            destination.close()
+
+    @contextmanager
+    def transaction(self, savepoint=True):
+        """Runs the block in a transaction of the current thread's connection.
+
+        The outermost block commits when it exits and rolls back if it raises. A nested block
+        is a savepoint, if it raises only its own changes are rolled back. With `savepoint=False`
+        a nested block just joins the enclosing transaction. Outside of a transaction every
+        `Table` method commits on its own.
+
+        >>> with base.transaction():
+        ...     users.insert({"name": "Alex"})
+        ...     orders.insert({"user": "Alex"})
+        """
+        # threads sharing the ":memory:" connection would nest into each other's transaction
+        with self.pool.shared_lock or nullcontext():
+            connection = self.connection
+            depth = self.depths.get(connection, 0)
+            if depth and not savepoint:
+                yield self
+                return
+            name = "level{}".format(depth)
+            if depth:
+                connection.execute("SAVEPOINT " + name)
+            elif not connection.in_transaction:
+                connection.execute("BEGIN")
+            self.depths[connection] = depth + 1
+            try:
+                yield self
+                if depth:
+                    connection.execute("RELEASE " + name)
+                else:
+                    connection.commit()
+            except BaseException:
+                if depth:
+                    connection.execute("ROLLBACK TO " + name)
+                    connection.execute("RELEASE " + name)
+                else:
+                    connection.rollback()
+                raise
+            finally:
+                if depth:
+                    self.depths[connection] = depth
+                else:
+                    del self.depths[connection]
 
     def create_table(self, table_name, columns):
-        columns = ", ".join([column.to_sql() for column in columns])
-        self.connection.execute(
-            "CREATE TABLE IF NOT EXISTS {} ({})".format(table_name, columns)
-        )
-        self.connection.commit()
-        return Table(self.cursor, table_name)
+        sql = ", ".join([column.to_sql() for column in columns])
+        with self.transaction():
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS {} ({})".format(table_name, sql)
+            )
+            for column in columns:
+                if column.index:
+                    self.connection.execute(
+                        "CREATE INDEX IF NOT EXISTS {0}_{1}_index ON {0} ({1})".format(
+                            table_name, column.name
+                        )
+                    )
+        return Table(self, table_name)
 
 
 ##################
@@ -412,9 +1159,32 @@ class StorageColumnAttribute:
             if attribute.name == self.name:
                 raise Exception("Attribute {} already exists".format(self.name))
 
+    def check_table(self, storage, name, columns):
+        """Raises if the attribute does not fit the table with the serialized columns"""
+
+    def prepare(self, table, column):
+        """Called once when the table is opened, before any insert"""
+        self.table = table
+        self.column = column
+
+    def on_insert(self, table, value, id):
+        """Called when the record passed validation and is about to be stored with the id"""
+
+    def on_discard(self, table, value, id):
+        """Reverts `on_insert` when the rest of the batch fails validation"""
+
     def callback_universal(self, table, type, value):
         raise Exception("Not implemented (type: {})".format(type))
 
+    @classmethod
+    def supports(cls, column_type):
+        """Whether the attribute can check values of the column type"""
+        base = StorageColumnAttribute
+        callback = "callback_" + column_type.lower()
+        return cls.callback_universal is not base.callback_universal or getattr(
+            cls, callback
+        ) is not getattr(base, callback)
+
     def callback_int(self, table, value):
         self.callback_universal(table, "INTEGER", value)
 
@@ -466,18 +1236,18 @@ class StorageColumn:
 
         # TYPES:   ✅❌    | INT   FLOAT    STR    BOOL  DICT     LIST    SET
         # ATTRIBUTES:       |----------------------------------------------------
-        # UNIQUE            | ❌     ❌     ❌     ❌     ❌     ❌     ❌
-        # LIMIT (int) (int) | ❌     ❌     ❌     ❌     ❌     ❌     ❌
-        # LINK (table name) | ❌     ❌     ❌     ❌     ❌     ❌     ❌
+        # UNIQUE            | ✅     ✅     ✅     ✅     ✅     ✅     ✅
+        # LIMIT (int) (int) | ✅     ✅     ✅     ❌     ✅     ✅     ✅
+        # LINK (table name) | ✅     ✅     ✅     ✅     ✅     ✅     ✅
         # AUTOINCREMENT     | ❌     ❌     ❌     ❌     ❌     ❌     ❌
         # DEFAULT (value)   | ❌     ❌     ❌     ❌     ❌     ❌     ❌
         # REQUIRED          | ❌     ❌     ❌     ❌     ❌     ❌     ❌
 
         # TYPES:   ✅❌    | UUID  DATE  TIMEDELTA  TIMESTAMP  BLOB   NULL    ANY
         # ATTRIBUTES:       |-----------------------------------------------------
-        # UNIQUE            | ❌     ❌     ❌         ❌     ❌     ❌     ❌
-        # LIMIT (int) (int) | ❌     ❌     ❌         ❌     ❌     ❌     ❌
-        # LINK (table name) | ❌     ❌     ❌         ❌     ❌     ❌     ❌
+        # UNIQUE            | ✅     ✅     ✅         ✅     ✅     ✅     ✅
+        # LIMIT (int) (int) | ❌     ❌     ❌         ❌     ✅     ❌     ❌
+        # LINK (table name) | ✅     ✅     ✅         ✅     ✅     ✅     ✅
         # AUTOINCREMENT     | ❌     ❌     ❌         ❌     ❌     ❌     ❌
         # DEFAULT (value)   | ❌     ❌     ❌         ❌     ❌     ❌     ❌
         # REQUIRED          | ❌     ❌     ❌         ❌     ❌     ❌     ❌
@@ -491,26 +1261,31 @@ class StorageColumn:
         # DEFAULT (value)   | ❌     ❌     ❌     ❌         🟦     ❌
         # REQUIRED          | ❌     ❌     ❌     ❌         ❌     🟦
 
+    def check(self, storage):
+        """Parses the attributes, raises if the type or an attribute does not fit the column"""
+        if self.type not in storage_types:
+            raise Exception("Type '{}' does not exist".format(self.type))
+        attributes = [storage.get_attribute(attribute) for attribute in self.attributes]
+        for attribute in attributes:
+            if not attribute.supports(self.type):
+                raise Exception(
+                    "Attribute {} of column '{}' does not support type {}".format(
+                        attribute.name, self.name, self.type
+                    )
+                )
+        return attributes
+
+    def bind(self, storage, table):
+        """Parses the attributes once and resolves their callbacks for the column type"""
+        self.bound = self.check(storage)
+        self.callbacks = []
+        for attribute in self.bound:
+            attribute.prepare(table, self)
+            self.callbacks.append(getattr(attribute, "callback_" + self.type.lower()))
+
     def process_insert(self, storage, table, value):
-        callbacks = {
-            "INT": lambda attr: attr.callback_int,
-            "FLOAT": lambda attr: attr.callback_float,
-            "STR": lambda attr: attr.callback_str,
-            "BOOL": lambda attr: attr.callback_bool,
-            "DICT": lambda attr: attr.callback_dict,
-            "LIST": lambda attr: attr.callback_list,
-            "SET": lambda attr: attr.callback_set,
-            "UUID": lambda attr: attr.callback_uuid,
-            "DATE": lambda attr: attr.callback_date,
-            "TIMEDELTA": lambda attr: attr.callback_timedelta,
-            "TIMESTAMP": lambda attr: attr.callback_timestamp,
-            "BLOB": lambda attr: attr.callback_blob,
-            "NULL": lambda attr: attr.callback_null,
-            "ANY": lambda attr: attr.callback_any,
-        }
-        for attribute in self.attributes:
-            attribute = storage.get_attribute(attribute)
-            callbacks[self.type](attribute)(table, value)
+        for callback in self.callbacks:
+            callback(table, value)
         return value
 
     def serialize(self):
@@ -546,67 +1321,479 @@ class StorageColumns:
         return cls(*columns)
 
 
+def _type_error(column, type, value):
+    return Exception("Column '{}' expects {}, got {!r}".format(column, type, value))
+
+
+def _type_int(column, value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    raise _type_error(column, "INT", value)
+
+
+def _type_float(column, value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    raise _type_error(column, "FLOAT", value)
+
+
+def _type_str(column, value):
+    if isinstance(value, str):
+        return value
+    raise _type_error(column, "STR", value)
+
+
+def _type_bool(column, value):
+    raise _type_error(column, "BOOL", value)
+
+
+def _type_dict(column, value):
+    if isinstance(value, dict):
+        return value
+    raise _type_error(column, "DICT", value)
+
+
+def _type_list(column, value):
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    raise _type_error(column, "LIST", value)
+
+
+def _type_set(column, value):
+    # stored as a list of unique values, sets can not be serialized
+    if isinstance(value, (set, frozenset, list, tuple)):
+        return list(dict.fromkeys(value))
+    raise _type_error(column, "SET", value)
+
+
+def _type_uuid(column, value):
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    try:
+        return str(uuid.UUID(value))
+    except (TypeError, ValueError, AttributeError):
+        raise _type_error(column, "UUID", value) from None
+
+
+def _type_date(column, value):
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        return value.isoformat()
+    try:
+        return datetime.date.fromisoformat(value).isoformat()
+    except (TypeError, ValueError):
+        raise _type_error(column, "DATE", value) from None
+
+
+def _type_timedelta(column, value):
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    raise _type_error(column, "TIMEDELTA", value)
+
+
+def _type_timestamp(column, value):
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    raise _type_error(column, "TIMESTAMP", value)
+
+
+def _type_blob(column, value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    raise _type_error(column, "BLOB", value)
+
+
+def _type_null(column, value):
+    raise _type_error(column, "NULL", value)
+
+
+# type -> (type accepted as is, converter called for any other value). None is always allowed
+storage_types = {
+    "INT": (int, _type_int),
+    "FLOAT": (float, _type_float),
+    "STR": (str, _type_str),
+    "BOOL": (bool, _type_bool),
+    "DICT": (dict, _type_dict),
+    "LIST": (list, _type_list),
+    "SET": (None, _type_set),
+    "UUID": (None, _type_uuid),
+    "DATE": (None, _type_date),
+    "TIMEDELTA": (float, _type_timedelta),
+    "TIMESTAMP": (float, _type_timestamp),
+    "BLOB": (bytes, _type_blob),
+    "NULL": (None, _type_null),
+    "ANY": (None, None),
+}
+
+
 class StorageTable:
+    """Table of `StorageManager`.
+
+    When the table is opened its columns are compiled into a single `validate(record)` function:
+    it checks the column set, checks and converts the types and runs the attribute callbacks,
+    so inserting does not look anything up by name.
+    """
+
     def __init__(self, storage, name):
         self.storage = storage
         self.name = name
 
         columns = self.storage.data[self.name]["__COLUMNS__"]
-        print(columns)
         self.columns = StorageColumns().deserialize(columns)
+        self.column_names = [column.name for column in self.columns.get_columns()]
+        self.hooks = []
+        self.keys = {}
+        self.links = {}
+        for column in self.columns.get_columns():
+            column.bind(self.storage, self)
+            for attribute in column.bound:
+                if type(attribute).on_insert is not StorageColumnAttribute.on_insert:
+                    self.hooks.append((column.name, attribute))
+                if isinstance(attribute, AttributeUnique):
+                    self.keys[column.name] = attribute.values
+                elif isinstance(attribute, AttributeLink):
+                    self.links[column.name] = attribute
+        self.validate = self.compile()
 
     @property
     def data(self):
         return self.storage.data[self.name]["__DATA__"]
 
-    def insert(self, **data):
-        for column in self.columns.get_columns():
-            if column.name not in data:
-                raise Exception(
-                    "Column '{}' is required. Use 'None' to skip".format(column.name)
+    def compile(self):
+        """Builds `validate(record) -> record` checking and converting a record of the table"""
+        namespace = {"table": self, "columns": set(self.column_names)}
+        lines = [
+            "def validate(record):",
+            "    if len(record) != {}:".format(len(self.column_names)),
+            "        for key in record:",
+            "            if key not in columns:",
+            "                raise Exception(\"Column '{}' does not exist\".format(key))",
+            "    try:",
+        ]
+        for i, column in enumerate(self.columns.get_columns()):
+            lines.append("        v{} = record[{!r}]".format(i, column.name))
+        lines += [
+            "    except KeyError as e:",
+            "        raise Exception(",
+            "            \"Column '{}' is required. Use 'None' to skip\".format(e.args[0])",
+            "        ) from None",
+        ]
+        for i, column in enumerate(self.columns.get_columns()):
+            accepted, converter = storage_types[column.type]
+            if converter is not None:
+                namespace["t{}".format(i)] = converter
+                condition = "v{} is not None".format(i)
+                if accepted is not None:
+                    namespace["a{}".format(i)] = accepted
+                    condition += " and type(v{0}) is not a{0}".format(i)
+                lines.append("    if {}:".format(condition))
+                lines.append("        v{0} = t{0}({1!r}, v{0})".format(i, column.name))
+            for j, callback in enumerate(column.callbacks):
+                namespace["c{}_{}".format(i, j)] = callback
+                lines.append("    c{}_{}(table, v{})".format(i, j, i))
+        lines.append(
+            "    return {{{}}}".format(
+                ", ".join(
+                    "{!r}: v{}".format(name, i)
+                    for i, name in enumerate(self.column_names)
                 )
-        for key in data:
-            if key not in [column.name for column in self.columns.get_columns()]:
-                raise Exception("Column '{}' does not exist".format(key))
-        payload = {}
-        for column in self.columns.get_columns():
-            column.process_insert(self.storage, self, data[column.name])
-            payload[column.name] = data[column.name]
-        self.storage.data[self.name]["__DATA__"].append(payload)
-        self.storage.save()
-        print(self.storage.data)
+            )
+        )
+        exec("\n".join(lines), namespace)
+        return namespace["validate"]
+
+    def key_index(self, column):
+        """Returns the `value -> id` index of a UNIQUE column"""
+        if column not in self.keys:
+            raise Exception(
+                "Column '{}' of table '{}' is not UNIQUE".format(column, self.name)
+            )
+        return self.keys[column]
+
+    def join(self, other, on):
+        """Inner hash join, yields `(record, other record)` pairs.
+
+        `on` is a LINK column of one of the tables pointing to the other, its key index
+        or reverse index is used. Otherwise `on` is a pair of columns `(column, other column)`,
+        then the other column is hashed unless it is UNIQUE.
+
+        >>> for order, user in orders.join(users, on="user"): ...
+        """
+        data, other_data = self.data, other.data
+        if isinstance(on, str):
+            link = self.links.get(on)
+            if link is not None and link.target_name == other.name:
+                for record in data:
+                    id = None if record[on] is None else link.target_id(record[on])
+                    if id is not None:
+                        yield record, other_data[id]
+                return
+            link = other.links.get(on)
+            if link is not None and link.target_name == self.name:
+                column = link.target_column
+                for id, record in enumerate(data):
+                    key = id if column is None else record[column]
+                    if key is None:
+                        continue
+                    for other_id in link.reverse.get(_hashable(key), ()):
+                        yield record, other_data[other_id]
+                return
+            raise Exception(
+                "Column '{}' does not link '{}' and '{}'".format(
+                    on, self.name, other.name
+                )
+            )
+        column, other_column = on
+        if other_column in other.keys:
+            index = {key: [id] for key, id in other.keys[other_column].items()}
+        else:
+            index = {}
+            for id, record in enumerate(other_data):
+                if record[other_column] is not None:
+                    index.setdefault(_hashable(record[other_column]), []).append(id)
+        for record in data:
+            if record[column] is None:
+                continue
+            for other_id in index.get(_hashable(record[column]), ()):
+                yield record, other_data[other_id]
+
+    def discard(self, payloads, start):
+        """Drops the records appended from `start` and reverts their `on_insert`"""
+        del self.data[start:]
+        for id, payload in enumerate(payloads, start):
+            for name, attribute in self.hooks:
+                attribute.on_discard(self, payload[name], id)
+
+    def insert(self, **data):
+        """Validates and appends the record, returns its id.
+
+        Nothing is kept if the record can not be persisted.
+        """
+        payload = self.validate(data)
+        id = len(self.data)
+        for name, attribute in self.hooks:
+            attribute.on_insert(self, payload[name], id)
+        try:
+            self.storage.observer.data[self.name]["__DATA__"].append(payload)
+        except BaseException:
+            self.discard([payload], id)
+            raise
+        return id
+
+    def insert_many(self, records):
+        """Validates the whole batch first and appends it as a single change.
+
+        Nothing is stored if any record is invalid or the batch can not be persisted.
+        Returns the ids of the records.
+        """
+        validate = self.validate
+        payloads = []
+        start = len(self.data)
+        try:
+            for record in records:
+                payload = validate(record)
+                for name, attribute in self.hooks:
+                    attribute.on_insert(self, payload[name], start + len(payloads))
+                payloads.append(payload)
+            if payloads:
+                self.storage.observer.data[self.name]["__DATA__"].extend(payloads)
+        except BaseException:
+            self.discard(payloads, start)
+            raise
+        return range(start, start + len(payloads))
+
+
+# marks the keys of unhashable values, so they never equal a stored value
+_unhashable = object()
+
+
+def _hashable(value):
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return (_unhashable, type(value).__name__, repr(value))
 
 
 class AttributeUnique(StorageColumnAttribute):
+    """UNIQUE - no two records share a value, None is not counted.
+
+    Keeps a `value -> id` dict, which is also the key index used by LINK and `StorageTable.join`
+    """
+
     incompatabilities = []
     name = "UNIQUE"
 
-    def callback_universal(self, table, type, value):
-        print(
-            f"Таблица {table.name} получила значение {value} ({type}) для атрибута {self.name}. Аргументы: {self.args}"
-        )
+    def prepare(self, table, column):
+        super().prepare(table, column)
+        self.values = {}
+        for id, record in enumerate(table.data):
+            self.on_insert(table, record[column.name], id)
 
+    def on_insert(self, table, value, id):
+        if value is not None:
+            self.values[_hashable(value)] = id
 
-class AttributeLimit(StorageColumnAttribute):
-    incompatabilities = []
-    name = "LIMIT"
+    def on_discard(self, table, value, id):
+        if value is not None:
+            self.values.pop(_hashable(value), None)
 
     def callback_universal(self, table, type, value):
-        print(
-            f"Таблица {table.name} получила значение {value} ({type}) для атрибута {self.name}. Аргументы: {self.args}"
-        )
+        if value is not None and _hashable(value) in self.values:
+            raise Exception(
+                "Value {!r} of column '{}' in table '{}' is not unique".format(
+                    value, self.column.name, table.name
+                )
+            )
+
+
+class AttributeLink(StorageColumnAttribute):
+    """LINK table [column] - the value must be a key of a record of the other table.
+
+    With a column the key is its value (the column must be UNIQUE), without it is the record id.
+    Keeps a reverse index `key -> [ids of the records pointing to it]` used by `StorageTable.join`
+    """
+
+    incompatabilities = []
+    name = "LINK"
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        if len(args) not in (1, 2):
+            raise Exception(
+                "LINK requires a table and optionally a column: LINK table id"
+            )
+        self.target_name = args[0]
+        self.target_column = args[1] if len(args) == 2 else None
+
+    def check_table(self, storage, name, columns):
+        """The linked table must exist, the linked column must be UNIQUE"""
+        if self.target_name == name:
+            target_columns = columns
+        elif storage.table_exists(self.target_name):
+            target_columns = storage.data[self.target_name]["__COLUMNS__"]
+        else:
+            raise Exception(
+                "LINK of table '{}' points to table '{}' which does not exist".format(
+                    name, self.target_name
+                )
+            )
+        if self.target_column is None:
+            return
+        for column in target_columns:
+            if column["name"] == self.target_column:
+                if not any(
+                    shlex.split(attribute)[0] == "UNIQUE"
+                    for attribute in column["attributes"]
+                ):
+                    raise Exception(
+                        "Column '{}' of table '{}' is not UNIQUE".format(
+                            self.target_column, self.target_name
+                        )
+                    )
+                return
+        raise Exception(
+            "LINK of table '{}' points to missing column '{}' of table '{}'".format(
+                name, self.target_column, self.target_name
+            )
+        )
+
+    def prepare(self, table, column):
+        super().prepare(table, column)
+        self.check_table(
+            table.storage, table.name, table.storage.data[table.name]["__COLUMNS__"]
+        )
+        self.reverse = {}
+        for id, record in enumerate(table.data):
+            self.on_insert(table, record[column.name], id)
+
+    def target(self):
+        if self.target_name == self.table.name:
+            return self.table
+        return self.table.storage.table_get(self.target_name)
+
+    def target_id(self, value):
+        """Returns the id of the linked record, None if there is no such record"""
+        target = self.target()
+        if self.target_column is None:
+            if type(value) is int and 0 <= value < len(target.data):
+                return value
+            return None
+        return target.key_index(self.target_column).get(_hashable(value))
+
+    def on_insert(self, table, value, id):
+        if value is not None:
+            self.reverse.setdefault(_hashable(value), []).append(id)
+
+    def on_discard(self, table, value, id):
+        if value is not None:
+            self.reverse[_hashable(value)].remove(id)
+
+    def callback_universal(self, table, type, value):
+        if value is not None and self.target_id(value) is None:
+            raise Exception(
+                "Value {!r} of column '{}' in table '{}' does not link to '{}'".format(
+                    value, self.column.name, table.name, self.target_name
+                )
+            )
+
+
+class AttributeLimit(StorageColumnAttribute):
+    """LIMIT low high - numbers must be within the range, strings and collections their length"""
+
+    incompatabilities = []
+    name = "LIMIT"
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        if len(args) != 2:
+            raise Exception("LIMIT requires two arguments: LIMIT low high")
+        self.low, self.high = float(args[0]), float(args[1])
+
+    def check(self, table, value, measured):
+        if not self.low <= measured <= self.high:
+            raise Exception(
+                "Value {!r} of column '{}' in table '{}' is out of LIMIT {} {}".format(
+                    value, self.column.name, table.name, *self.args
+                )
+            )
+
+    def callback_int(self, table, value):
+        if value is not None:
+            self.check(table, value, value)
+
+    callback_float = callback_int
+
+    def callback_str(self, table, value):
+        if value is not None:
+            self.check(table, value, len(value))
+
+    callback_dict = callback_list = callback_set = callback_blob = callback_str
 
 
 class StorageManager:
-    def __init__(self, name, log=False):
-        self.observer, self.load, self.save = create_autoyaml(
-            "t",
+    """Tables with typed columns and attributes, persisted to the file `name`.
+
+    Only the changes are appended to the journal (`create_autoyaml(journal=True)`),
+    column attributes are parsed once when a table is opened. Every insert is fsynced,
+    `fsync=N` fsyncs every N changes instead (see `JournalBackend`).
+    """
+
+    def __init__(self, name, log=False, fsync="always"):
+        self.observer, self._load, self.save = create_autoyaml(
+            name,
             get_save=True,
             additional=(lambda s, i, v: print("LOG:", v)) if log else None,
+            journal=True,
+            fsync=fsync,
         )
         self.name = name
         self.attributes = {}
-        attributes = [AttributeUnique, AttributeLimit]
+        self.tables = {}
+        attributes = [AttributeUnique, AttributeLimit, AttributeLink]
 
         for attribute in attributes:
             self.add_attribute(attribute)
@@ -618,6 +1805,12 @@ class StorageManager:
     @data.setter
     def data(self, value):
         self.observer.data = value
+        self.tables = {}
+
+    def load(self):
+        """Rereads the file, tables opened before are dropped with their indexes"""
+        self._load()
+        self.tables = {}
 
     def add_attribute(self, attribute):
         self.attributes[attribute.name] = attribute
@@ -636,9 +1829,12 @@ class StorageManager:
         else:
             raise TypeError("Columns must be list or StorageColumns")
 
-        if self.table_exists(self.name) and not force:
+        if self.table_exists(name) and not force:
             raise Exception("Table already exists")
         else:
+            for column in columns.get_columns():
+                for attribute in column.check(self):
+                    attribute.check_table(self, name, columns.serialize())
             self.observer.data.update(
                 {
                     name: {
@@ -647,71 +1843,1063 @@ class StorageManager:
                     }
                 }
             )
-            return StorageTable(self, name)
+            self.tables.pop(name, None)
+            return self.table_get(name)
+
+    def table_get(self, name):
+        if not self.table_exists(name):
+            raise Exception("Table does not exist")
+        if name not in self.tables:
+            self.tables[name] = StorageTable(self, name)
+        return self.tables[name]
 
     def table_exists(self, name):
         return name in self.data
 
 
+class StorageRow(collections.abc.MutableMapping):
+    """Record of a typed `SimpleStorage` table, a dict-like object keeping its fields in `__slots__`.
+
+    Classes are generated per set of fields by `storage_row_class`. Fields can be read and
+    changed but not added or removed. Serializers store rows as plain dicts.
+    """
+
+    __slots__ = ()
+    fields = ()
+    slots = {}
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self.slots[key])
+        except KeyError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, self.slots[key], value)
+        except KeyError:
+            raise KeyError(key) from None
+
+    def __delitem__(self, key):
+        raise TypeError("Fields of a typed record can not be removed")
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __repr__(self):
+        return repr(self.toDict())
+
+    def __reduce__(self):
+        return dict, (self.toDict(),)
+
+    def get(self, key, default=None):
+        slot = self.slots.get(key)
+        return default if slot is None else getattr(self, slot)
+
+    def copy(self):
+        return type(self)(self)
+
+    def toDict(self):
+        """Returns the record as a dict, also used by ujson"""
+        return {field: getattr(self, slot) for field, slot in self.slots.items()}
+
+
+Dumper.add_multi_representer(
+    StorageRow, lambda dumper, row: dumper.represent_dict(row.toDict())
+)
+
+_row_classes = {}
+
+
+def storage_row_class(fields):
+    """Returns the `StorageRow` class for the fields, `cls(record)` copies the fields of a dict"""
+    fields = tuple(fields)
+    if fields not in _row_classes:
+        slots = tuple("f{}".format(i) for i in range(len(fields)))
+        lines = ["def __init__(self, record):"]
+        for field, slot in zip(fields, slots):
+            lines.append("    self.{} = record[{!r}]".format(slot, field))
+        lines.append("    return None")
+        namespace = {}
+        exec("\n".join(lines), namespace)
+        _row_classes[fields] = type(
+            "StorageRow",
+            (StorageRow,),
+            {
+                "__slots__": slots,
+                "__init__": namespace["__init__"],
+                "fields": fields,
+                "slots": dict(zip(fields, slots)),
+            },
+        )
+    return _row_classes[fields]
+
+
+def storage_apply(data, entry):
+    """Applies one journal entry to `SimpleStorage` data.
+
+    Entries are plain lists, so they can be written as JSON lines:
+        ["table", name, table | None]       - create/replace or drop a table
+        ["add", name, id, record]           - put a record at position `id`
+        ["update", name, id, changes]       - replace a record with an updated copy
+        ["remove", name, id]                - replace a record with a tombstone (None)
+        ["compact", name]                   - drop tombstones, renumbering the records
+        ["index", name, fields]             - declare an index on the fields
+
+    Removed records leave a tombstone, so ids of the other records never change until
+    the table is compacted.
+    """
+    kind, name, *args = entry
+    if kind == "table":
+        (table,) = args
+        if table is None:
+            data.pop(name, None)
+        else:
+            data[name] = table
+    elif kind == "add":
+        id, record = args
+        records = data[name]["__DATA__"]
+        if id < len(records):
+            records[id] = record
+        else:
+            records.append(record)
+    elif kind == "update":
+        # the record is replaced, not changed, so snapshots sharing it stay intact
+        id, changes = args
+        records = data[name]["__DATA__"]
+        record = records[id].copy()
+        record.update(changes)
+        records[id] = record
+    elif kind == "remove":
+        (id,) = args
+        data[name]["__DATA__"][id] = None
+    elif kind == "compact":
+        records = data[name]["__DATA__"]
+        records[:] = [record for record in records if record is not None]
+    elif kind == "index":
+        (fields,) = args
+        indexes = data[name].setdefault("__INDEXES__", [])
+        if list(fields) not in indexes:
+            indexes.append(list(fields))
+    else:
+        raise Exception("Unknown journal entry '{}'".format(kind))
+
+
+def atomic_write(name, content):
+    """Writes the file through a temporary file and a rename, so readers never see half of it"""
+    directory = os.path.dirname(os.path.abspath(name))
+    mode = "wb" if isinstance(content, bytes) else "w"
+    fd, temp_name = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        try:
+            os.chmod(temp_name, os.stat(name).st_mode)
+        except FileNotFoundError:
+            os.chmod(temp_name, 0o644)
+        with os.fdopen(fd, mode) as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_name, name)
+    except BaseException:
+        os.unlink(temp_name)
+        raise
+
+
+class StorageLock:
+    """Advisory lock and generation counter kept in the sidecar file `<name>.lock`.
+
+    Writers hold the `fcntl.flock` lock while they write and increment the generation,
+    so any process can tell whether its copy of the data is stale with a single 8 byte read.
+    The lock is reentrant and also serializes threads of the process. Open a separate
+    `StorageLock` in every process, flock locks are shared by forked file descriptors.
+    """
+
+    def __init__(self, name):
+        self.name = name + ".lock"
+        self.fd = os.open(self.name, os.O_RDWR | os.O_CREAT, 0o644)
+        self.depth = 0
+        self.thread_lock = threading.RLock()
+
+    def generation(self):
+        content = os.pread(self.fd, 8, 0)
+        return int.from_bytes(content, "little") if len(content) == 8 else 0
+
+    def increment(self):
+        """Increments the generation, the lock must be held"""
+        generation = self.generation() + 1
+        os.pwrite(self.fd, generation.to_bytes(8, "little"), 0)
+        return generation
+
+    def acquire(self):
+        self.thread_lock.acquire()
+        if self.depth == 0 and fcntl is not None:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            except BaseException:
+                self.thread_lock.release()
+                raise
+        self.depth += 1
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0 and fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+_json_types = (str, int, float, bool, type(None))
+
+# type -> (tag, encode, decode) for values JSON has no type for
+journal_types = {
+    tuple: ("tuple", list, tuple),
+    set: ("set", list, set),
+    frozenset: ("frozenset", list, frozenset),
+    bytes: ("bytes", lambda v: base64.b64encode(v).decode(), base64.b64decode),
+    bytearray: (
+        "bytearray",
+        lambda v: base64.b64encode(v).decode(),
+        lambda v: bytearray(base64.b64decode(v)),
+    ),
+    datetime.datetime: (
+        "datetime",
+        datetime.datetime.isoformat,
+        datetime.datetime.fromisoformat,
+    ),
+    datetime.date: ("date", datetime.date.isoformat, datetime.date.fromisoformat),
+    datetime.time: ("time", datetime.time.isoformat, datetime.time.fromisoformat),
+    datetime.timedelta: (
+        "timedelta",
+        lambda v: [v.days, v.seconds, v.microseconds],
+        lambda v: datetime.timedelta(*v),
+    ),
+    uuid.UUID: ("uuid", str, uuid.UUID),
+}
+_journal_tags = {tag: decode for tag, _, decode in journal_types.values()}
+_journal_tags["dict"] = lambda items: {key: value for key, value in items}
+
+
+def _journal_encode(value):
+    kind = type(value)
+    if kind in _json_types:
+        return value
+    if kind is list:
+        return [_journal_encode(item) for item in value]
+    if kind is dict or isinstance(value, collections.abc.Mapping):
+        if "__type__" not in value and all(type(key) is str for key in value):
+            return {key: _journal_encode(item) for key, item in value.items()}
+        items = [[_journal_encode(k), _journal_encode(v)] for k, v in value.items()]
+        return {"__type__": "dict", "value": items}
+    if kind not in journal_types:
+        for base in kind.__mro__[1:]:
+            if base in journal_types or base in _json_types:
+                kind = base
+                break
+        else:
+            raise TypeError("{!r} can not be written to the journal".format(value))
+        if kind in _json_types:
+            return kind(value)
+    tag, encode, _ = journal_types[kind]
+    value = encode(value)
+    if type(value) is list:
+        value = [_journal_encode(item) for item in value]
+    return {"__type__": tag, "value": value}
+
+
+def _journal_decode(value):
+    if type(value) is list:
+        return [_journal_decode(item) for item in value]
+    if type(value) is dict:
+        if "__type__" in value:
+            return _journal_tags[value["__type__"]](_journal_decode(value["value"]))
+        return {key: _journal_decode(item) for key, item in value.items()}
+    return value
+
+
+def journal_dumps(entry):
+    """Encodes a journal entry as a JSON line keeping the types JSON lacks.
+
+    Tuples, sets, bytes, dates, times, timedeltas, UUIDs and dicts with non string keys
+    are written as `{"__type__": tag, "value": ...}`. Raises TypeError for any other type,
+    so callers can check an entry before they apply it.
+    """
+    return ujson.dumps(_journal_encode(entry)) + "\n"
+
+
+def journal_loads(line):
+    """Decodes a line written by `journal_dumps`"""
+    entry = ujson.loads(line)
+    if (b'"__type__"' if isinstance(line, bytes) else '"__type__"') in line:
+        entry = _journal_decode(entry)
+    return entry
+
+
+def storage_restore(*names):
+    """Returns data restored from a full `SimpleStorage.backup` and the incremental ones after it
+
+    >>> storage.data = storage_restore("full.log", "1.log", "2.log")
+    >>> storage.save()
+    """
+    data = {}
+    for increment in names:
+        with open(increment, "rb") as f:
+            for line in f:
+                storage_apply(data, journal_loads(line))
+    return data
+
+
+class StorageBackend:
+    """Persists `SimpleStorage` data.
+
+    `save` writes the full state, `write` receives the journal entries of a single mutation.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def load(self):
+        raise NotImplementedError
+
+    def save(self, data):
+        raise NotImplementedError
+
+    def write(self, data, entries):
+        self.save(data)
+
+    def close(self):
+        pass
+
+
+class SnapshotBackend(StorageBackend):
+    """Rewrites the whole file on every mutation.
+
+    The file is written with `serializer` (name or `Serializer`), the format is detected on load.
+    """
+
+    def __init__(self, name, serializer="yaml"):
+        super().__init__(name)
+        self.serializer = serializer_get(serializer)
+
+    def load(self):
+        with open(self.name, "rb") as f:
+            return serializer_loads(f.read()) or {}
+
+    def save(self, data):
+        atomic_write(self.name, self.serializer.dumps(data))
+
+
+class JournalBackend(SnapshotBackend):
+    """Snapshot plus an append-only log `<name>.log` with one JSON line per write.
+
+    Mutations cost one appended line instead of a full rewrite. The entries of a single write
+    (a whole transaction) share one line `{"entries": [...]}`, so a crash keeps all or none
+    of them. `load` replays the log over the snapshot, `save` folds the log back into the
+    snapshot (compaction). The first line `{"snapshot": hash}` names the snapshot the log
+    applies to, so a log left behind by a crash after the snapshot was replaced is skipped.
+
+    Args:
+        fsync: "always" - fsync after every mutation, "never" - leave flushing to the OS,
+            int N - fsync every N entries
+        compact_every: compact automatically once the log holds that many entries (0 - never)
+        apply: function applying an entry to the data, `observer_apply` journals `Observer` changes
+    """
+
+    def __init__(
+        self,
+        name,
+        fsync="always",
+        compact_every=10000,
+        serializer="yaml",
+        apply=storage_apply,
+    ):
+        super().__init__(name, serializer)
+        self.apply = apply
+        self.log_name = name + ".log"
+        self.fsync = fsync
+        self.compact_every = compact_every
+        self.entries = 0
+        self._unsynced = 0
+        self._log = None
+        self._snapshot = None
+        self._log_valid = False
+
+    def load(self):
+        self.close()
+        try:
+            with open(self.name, "rb") as f:
+                content = f.read()
+            data = serializer_loads(content) or {}
+            self._snapshot = hashlib.sha1(content).hexdigest()
+        except FileNotFoundError:
+            if not os.path.exists(self.log_name):
+                raise
+            data = {}
+            self._snapshot = None
+        self.entries = 0
+        # an empty, missing or outdated log is started over by the next write
+        self._log_valid = False
+        try:
+            with open(self.log_name, "rb") as f:
+                offset = 0
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # torn write at the tail, drop it so new entries start on a clean line
+                        os.truncate(self.log_name, offset)
+                        break
+                    entry = journal_loads(line)
+                    if type(entry) is dict and "snapshot" in entry:
+                        if entry["snapshot"] != self._snapshot:
+                            # the snapshot already holds these entries
+                            break
+                    elif type(entry) is dict:
+                        for item in entry["entries"]:
+                            self.apply(data, item)
+                        self.entries += len(entry["entries"])
+                    else:
+                        self.apply(data, entry)
+                        self.entries += 1
+                    self._log_valid = True
+                    offset += len(line)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def save(self, data):
+        self.close()
+        content = self.serializer.dumps(data)
+        if isinstance(content, str):
+            content = content.encode()
+        atomic_write(self.name, content)
+        self._snapshot = hashlib.sha1(content).hexdigest()
+        # a crash before the truncation leaves a log naming the old snapshot, load skips it
+        with open(self.log_name, "w"):
+            pass
+        self._log_valid = False
+        self.entries = 0
+
+    def write(self, data, entries):
+        if self._log is None:
+            # always appended, so other handles on the log never write at a stale offset
+            self._log = open(self.log_name, "a")
+            if not self._log_valid:
+                self._log.truncate(0)
+                self._log.write(journal_dumps({"snapshot": self._snapshot}))
+                self._log_valid = True
+        if len(entries) == 1:
+            line = journal_dumps(entries[0])
+        else:
+            line = journal_dumps({"entries": list(entries)})
+        self._log.write(line)
+        self._log.flush()
+        self.entries += len(entries)
+        self._unsynced += len(entries)
+        if self.fsync == "always" or (
+            isinstance(self.fsync, int) and self._unsynced >= self.fsync
+        ):
+            os.fsync(self._log.fileno())
+            self._unsynced = 0
+        if self.compact_every and self.entries >= self.compact_every:
+            self.save(data)
+
+    def close(self):
+        if self._log is not None:
+            if self._unsynced and self.fsync != "never":
+                os.fsync(self._log.fileno())
+            self._unsynced = 0
+            self._log.close()
+            self._log = None
+
+
+class StorageQuery:
+    """Lazy query over a `SimpleStorage` table.
+
+    Conditions are `field=value` or `field__operator=value` with operators from `operators`.
+    All conditions are compiled into a single function on first iteration, equality conditions
+    are answered by indexes when possible. Iterating yields records (or projections) one by one.
+    """
+
+    operators = {
+        "eq": "r[{field}] == {value}",
+        "ne": "r[{field}] != {value}",
+        "gt": "r[{field}] > {value}",
+        "gte": "r[{field}] >= {value}",
+        "lt": "r[{field}] < {value}",
+        "lte": "r[{field}] <= {value}",
+        "in": "r[{field}] in {value}",
+        "contains": "{value} in r[{field}]",
+    }
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+        self.conditions = []
+        self.fields = None
+        self.ordering = []
+        self.limit_count = None
+        self.offset_count = 0
+        self._predicate = None
+
+    def where(self, **conditions):
+        columns = self.storage.table_columns(self.name)
+        for key, value in conditions.items():
+            field, _, operator = key.partition("__")
+            operator = operator or "eq"
+            if field not in columns:
+                raise Exception("Column '{}' does not exist".format(field))
+            if operator not in self.operators:
+                raise Exception("Operator '{}' does not exist".format(operator))
+            self.conditions.append((field, operator, value))
+        self._predicate = None
+        return self
+
+    def select(self, *fields):
+        self.fields = fields
+        return self
+
+    def order_by(self, *fields):
+        """Orders by the fields, "-field" for descending order"""
+        self.ordering = [
+            (field[1:], True) if field.startswith("-") else (field, False)
+            for field in fields
+        ]
+        return self
+
+    def limit(self, count):
+        self.limit_count = count
+        return self
+
+    def offset(self, count):
+        self.offset_count = count
+        return self
+
+    def compile(self):
+        """Builds a predicate `record -> bool` from the conditions, None if there are none"""
+        if self._predicate is None and self.conditions:
+            namespace = {}
+            parts = []
+            for i, (field, operator, value) in enumerate(self.conditions):
+                namespace["v{}".format(i)] = value
+                parts.append(
+                    self.operators[operator].format(
+                        field=repr(field), value="v{}".format(i)
+                    )
+                )
+            self._predicate = eval("lambda r: " + " and ".join(parts), namespace)
+        return self._predicate
+
+    def _records(self):
+        predicate = self.compile()
+        equal = {}
+        for field, operator, value in self.conditions:
+            if operator == "eq":
+                equal[field] = value
+        records = self.storage.data[self.name]["__DATA__"]
+        for id in self.storage._candidate_ids(self.name, equal):
+            record = records[id]
+            if record is not None and (predicate is None or predicate(record)):
+                yield record
+
+    def __iter__(self):
+        records = self._records()
+        stop = (
+            None if self.limit_count is None else self.offset_count + self.limit_count
+        )
+        if self.ordering:
+            directions = {descending for _, descending in self.ordering}
+            if len(directions) == 1:
+                key = itemgetter(*[field for field, _ in self.ordering])
+                (reverse,) = directions
+                if stop is None:
+                    records = sorted(records, key=key, reverse=reverse)
+                else:
+                    top = heapq.nlargest if reverse else heapq.nsmallest
+                    records = top(stop, records, key=key)
+            else:
+                records = list(records)
+                for field, descending in reversed(self.ordering):
+                    records.sort(key=itemgetter(field), reverse=descending)
+        records = itertools.islice(records, self.offset_count, stop)
+        if self.fields is None:
+            yield from records
+        else:
+            fields = self.fields
+            for record in records:
+                yield {field: record[field] for field in fields}
+
+    def first(self):
+        return next(iter(self), None)
+
+    def count(self):
+        return sum(1 for _ in self)
+
+
 class SimpleStorage:
-    def __init__(self, name, log=False):
+    """Table storage kept in memory and persisted through a `StorageBackend`.
+
+    By default the whole file is rewritten on every mutation (`SnapshotBackend`),
+    pass `backend=JournalBackend(name)` to append mutations to a log instead.
+    `serializer` selects the file format of the default backend: "yaml", "json" or "pickle".
+
+    With `lock=True` several processes may share the file: transactions hold a `StorageLock`
+    and start by reloading the data if another process has written since, `stale()` and
+    `refresh()` let readers check and reload only when needed.
+
+    With `typed=True` records are kept as `StorageRow` objects generated from the default record
+    of the table instead of dicts, they behave like dicts and take a fraction of the memory.
+
+    Removed records leave tombstones until the table is compacted with `table_compact()`,
+    only it renumbers records.
+    """
+
+    def __init__(
+        self,
+        name,
+        log=False,
+        backend=None,
+        serializer="yaml",
+        lock=False,
+        typed=False,
+    ):
         self.name = name
+        self.backend = backend or SnapshotBackend(name, serializer)
+        self.typed = typed
+        self.lock = StorageLock(name) if lock else None
+        self.generation = None
         self.data = {}
+        self.indexes = {}
+        self._pending = None
+        self._undo = None
+        self.mutex = threading.RLock()
+        self.sequence = 0
+        self._history = None
+        self._history_start = 0
         self.load()
 
+    @contextmanager
+    def _locked(self):
+        if self.lock is None:
+            yield
+            return
+        self.lock.acquire()
+        try:
+            yield
+        finally:
+            self.lock.release()
+
+    def _written(self):
+        if self.lock is not None:
+            self.generation = self.lock.increment()
+
     def save(self):
-        with open(self.name, "w") as f:
-            f.write(yaml.dump(self.data, Dumper=Dumper))
+        """Writes the whole data, raises if another process has written since it was loaded"""
+        with self.mutex, self._locked():
+            if self.stale():
+                raise Exception(
+                    "Storage was changed by another process, refresh it first"
+                )
+            self._save()
+
+    def _save(self):
+        self.backend.save(self.data)
+        self._written()
 
     def load(self):
-        try:
-            with open(self.name, "r") as f:
-                self.data = yaml.load(f, Loader=Loader)
-            return True
-        except FileNotFoundError:
-            self.save()
+        with self._locked():
+            try:
+                self.data = self.backend.load()
+                self.indexes = {}
+                # changes made elsewhere are not in the history
+                self._history = None
+                if self.typed:
+                    for table in self.data.values():
+                        self._table_rows(table)
+                if self.lock is not None:
+                    self.generation = self.lock.generation()
+                return True
+            except FileNotFoundError:
+                self._save()
+                self.load()
+                return False
+
+    def snapshot(self):
+        """Returns `(id, data)`: a copy of the data as it was after `id` committed entries.
+
+        Records are never changed in place (updates replace them), so the copy shares them
+        and only the record lists are copied, writers wait for that much. The changes made
+        after the snapshot are recorded for `backup(since=id)`.
+        """
+        with self.mutex:
+            data = {}
+            for name, table in self.data.items():
+                table = dict(table)
+                table["__DATA__"] = list(table["__DATA__"])
+                if "__INDEXES__" in table:
+                    table["__INDEXES__"] = list(table["__INDEXES__"])
+                data[name] = table
+            self._history, self._history_start = [], self.sequence
+            return self.sequence, data
+
+    def backup(self, target, since=None):
+        """Writes a backup to the file `target` without blocking writers, returns its snapshot id.
+
+        Backups are journal entries as JSON lines. Without `since` the backup is full: the data
+        of a `snapshot()`, encoded one record at a time so writers are never held up by a single
+        long serialization. With `since`, the id of the previous backup, only the entries
+        committed after it are written. Restore with `storage_restore(full, *incremental)`.
+
+        >>> id = storage.backup("full.json")
+        >>> id = storage.backup("1.log", since=id)
+        """
+        if since is None:
+            id, data = self.snapshot()
+            lines = []
+            for name, table in data.items():
+                records = table.pop("__DATA__")
+                indexes = table.pop("__INDEXES__", [])
+                lines.append(journal_dumps(["table", name, dict(table, __DATA__=[])]))
+                for fields in indexes:
+                    lines.append(journal_dumps(["index", name, fields]))
+                for i, record in enumerate(records):
+                    lines.append(journal_dumps(["add", name, i, record]))
+            atomic_write(target, "".join(lines))
+            return id
+        with self.mutex:
+            if self._history is None or not (
+                self._history_start <= since <= self.sequence
+            ):
+                raise Exception(
+                    "Changes since {} are not available, make a full backup".format(
+                        since
+                    )
+                )
+            lines = self._history[since - self._history_start :]
+            id = self.sequence
+            del self._history[: id - self._history_start]
+            self._history_start = id
+        atomic_write(target, "".join(lines))
+        return id
+
+    def stale(self):
+        """Whether another process has written since the data was loaded"""
+        return self.lock is not None and self.lock.generation() != self.generation
+
+    def refresh(self):
+        """Reloads the data if it is stale, returns whether it was reloaded"""
+        if self.stale():
             self.load()
-            return False
+            return True
+        return False
 
-    def table_add(self, name, default, raise_exception=False):
+    def compact(self):
+        """Folds the journal back into a snapshot, stale data is reloaded first.
+
+        Record ids do not change, tombstones are dropped by `table_compact()` only.
+        """
+        with self.mutex, self._locked():
+            self.refresh()
+            self._save()
+
+    def close(self):
+        self.backend.close()
+        if self.lock is not None:
+            self.lock.close()
+
+    @contextmanager
+    def transaction(self):
+        """Groups mutations into a single write
+
+        Nothing is written until the outermost block exits, then all mutations are persisted at once.
+        If the block raises, the in-memory data is rolled back to the state before the transaction.
+        With a lock the whole block runs under it, on stale data it first reloads.
+
+        >>> with storage.transaction():
+        ...     storage.record_add("test", field="value")
+        ...     storage.record_update("test", ["field", "value"], field2="value")
+        """
+        with self.mutex:
+            if self._pending is not None:
+                yield self
+                return
+            with self._locked():
+                if self.stale():
+                    self.load()
+                self._pending, self._undo = [], []
+                try:
+                    yield self
+                    if self._pending:
+                        # encoded first, so an entry backups can not hold is never written
+                        lines = None
+                        if self._history is not None:
+                            lines = list(map(journal_dumps, self._pending))
+                        self.backend.write(self.data, self._pending)
+                        self._written()
+                        self.sequence += len(self._pending)
+                        if lines is not None:
+                            self._history.extend(lines)
+                except BaseException:
+                    for undo in reversed(self._undo):
+                        undo()
+                    self.indexes = {}
+                    raise
+                finally:
+                    self._pending = self._undo = None
+
+    batch = transaction
+
+    def _commit(self, *entries):
+        with self.transaction():
+            for entry in entries:
+                self._undo.append(self._undo_entry(entry))
+                self._apply(entry)
+                self._pending.append(entry)
+
+    def _undo_entry(self, entry):
+        """Returns a function reverting the entry"""
+        kind, name, *args = entry
+        if kind == "table":
+            table = self.data.get(name)
+            if table is None:
+                return lambda: self.data.pop(name, None)
+            return lambda: self.data.__setitem__(name, table)
+        elif kind == "index":
+            indexes = self.data[name].get("__INDEXES__")
+            if indexes is None:
+                return lambda: self.data[name].pop("__INDEXES__", None)
+            return lambda length=len(indexes): indexes.__delitem__(slice(length, None))
+        records = self.data[name]["__DATA__"]
+        if kind == "add":
+            id, record = args
+            if id < len(records):
+                return lambda old=records[id]: records.__setitem__(id, old)
+            return records.pop
+        elif kind in ("update", "remove"):
+            id = args[0]
+            return lambda record=records[id]: records.__setitem__(id, record)
+        elif kind == "compact":
+            return lambda old=list(records): records.__setitem__(slice(None), old)
+        return lambda: None
+
+    @staticmethod
+    def _table_rows(table):
+        """Converts records of the table to `StorageRow` objects in place"""
+        cls = storage_row_class(table["__DEFAULT__"])
+        table["__DATA__"] = [
+            record if record is None or type(record) is cls else cls(record)
+            for record in table["__DATA__"]
+        ]
+        return table
+
+    def _apply(self, entry):
+        """Applies the entry to the data keeping the indexes up to date"""
+        kind, name, *args = entry
+        if self.typed and kind == "add":
+            cls = storage_row_class(self.data[name]["__DEFAULT__"])
+            entry = [kind, name, args[0], cls(args[1])]
+            args = entry[2:]
+        elif self.typed and kind == "table" and args[0] is not None:
+            entry = [kind, name, self._table_rows(dict(args[0]))]
+        indexes = self.indexes.get(name)
+        if indexes is None:
+            storage_apply(self.data, entry)
+        elif kind == "add":
+            storage_apply(self.data, entry)
+            id, record = args
+            for fields, index in list(indexes.items()):
+                try:
+                    index.setdefault(self._index_key(record, fields), []).append(id)
+                except TypeError:
+                    del indexes[fields]
+        elif kind == "update":
+            id, changes = args
+            record = self.data[name]["__DATA__"][id]
+            touched = [fields for fields in indexes if changes.keys() & set(fields)]
+            for fields in touched:
+                key = self._index_key(record, fields)
+                indexes[fields][key].remove(id)
+                if not indexes[fields][key]:
+                    del indexes[fields][key]
+            storage_apply(self.data, entry)
+            record = self.data[name]["__DATA__"][id]
+            for fields in touched:
+                try:
+                    key = self._index_key(record, fields)
+                    bisect.insort(indexes[fields].setdefault(key, []), id)
+                except TypeError:
+                    del indexes[fields]
+        elif kind == "remove":
+            (id,) = args
+            record = self.data[name]["__DATA__"][id]
+            for fields, index in indexes.items():
+                key = self._index_key(record, fields)
+                index[key].remove(id)
+                if not index[key]:
+                    del index[key]
+            storage_apply(self.data, entry)
+        else:
+            # compaction renumbers records and table entries replace the table,
+            # its indexes are rebuilt on the next lookup
+            del self.indexes[name]
+            storage_apply(self.data, entry)
+
+    @staticmethod
+    def _index_key(record, fields):
+        return tuple(record[field] for field in fields)
+
+    def _table_indexes(self, name):
+        """Builds the indexes of the table.
+
+        An index is dropped as soon as one of its values can not be hashed (lists, dicts),
+        lookups on its fields then scan the table.
+        """
+        if name not in self.indexes:
+            records = self.data[name]["__DATA__"]
+            indexes = {}
+            for fields in self.data[name].get("__INDEXES__", []):
+                fields = tuple(fields)
+                index = {}
+                try:
+                    for id, record in enumerate(records):
+                        if record is None:
+                            continue
+                        key = self._index_key(record, fields)
+                        index.setdefault(key, []).append(id)
+                except TypeError:
+                    continue
+                indexes[fields] = index
+            self.indexes[name] = indexes
+        return self.indexes[name]
+
+    def _candidate_ids(self, name, conditions):
+        """Returns ids which may match the `{field: value}` equality conditions in ascending order"""
+        if conditions:
+            indexes = self._table_indexes(name)
+            # the index covering the most fields is the most selective one
+            for fields in sorted(indexes, key=len, reverse=True):
+                if all(field in conditions for field in fields):
+                    try:
+                        key = tuple(conditions[field] for field in fields)
+                        return indexes[fields].get(key, ())
+                    except TypeError:
+                        continue
+        return range(len(self.data[name]["__DATA__"]))
+
+    def _where_ids(self, name, where):
+        """Yields ids of the records matching all `[field, value]` pairs in ascending order"""
+        if not self.table_exists(name):
+            raise Exception("Table does not exist")
+        records = self.data[name]["__DATA__"]
+        for i in self._candidate_ids(name, dict(where)):
+            record = records[i]
+            if record is None:
+                continue
+            for field, value in where:
+                if record[field] != value:
+                    break
+            else:
+                yield i
+
+    def query(self, name):
+        """Starts a query over the table
+
+        >>> query("test").where(age__gt=20, city="Moscow").select("name").order_by("age").limit(100)
+        """
+        if not self.table_exists(name):
+            raise Exception("Table does not exist")
+        return StorageQuery(self, name)
+
+    def index_create(self, name, *fields):
+        """Declares a hash index used by equality lookups on these fields
+
+        >>> index_create("test", "field", "field2")
+        """
+        with self.transaction():
+            if not self.table_exists(name):
+                raise Exception("Table does not exist")
+            if not fields:
+                raise Exception("Index requires at least one field")
+            for field in fields:
+                if field not in self.table_columns(name):
+                    raise Exception("Column '{}' does not exist".format(field))
+            self.indexes.pop(name, None)
+            self._commit(["index", name, list(fields)])
+
+    def table_indexes(self, name):
         if self.table_exists(name):
-            if raise_exception:
-                raise Exception("Table already exists")
+            return [tuple(fields) for fields in self.data[name].get("__INDEXES__", [])]
+        else:
+            raise Exception("Table does not exist")
+
+    def table_add(self, name, default, raise_exception=False):
+        with self.transaction():
+            if self.table_exists(name):
+                if raise_exception:
+                    raise Exception("Table already exists")
+                else:
+                    return self.table_get(name)
             else:
+                self._commit(["table", name, {"__DEFAULT__": default, "__DATA__": []}])
                 return self.table_get(name)
-        else:
-            self.observer.data.update(
-                {
-                    name: {
-                        "__DEFAULT__": default,
-                        "__DATA__": [],
-                    }
-                }
-            )
 
     def table_exists(self, name):
         return name in self.data
 
     def table_get(self, name):
-        return self.data[name]
+        """Returns a read-only view of the table, its `__DATA__` is a tuple of the records
+        without the tombstones of removed ones. Change the table with the storage methods.
+        """
+        table = self.data[name]
+        return types.MappingProxyType(
+            dict(
+                table,
+                __DATA__=tuple(
+                    record for record in table["__DATA__"] if record is not None
+                ),
+            )
+        )
 
     def table_list(self):
         return self.data.keys()
 
     def table_remove(self, name):
-        if self.table_exists(name):
-            del self.data[name]
-            self.save()
-        else:
-            raise Exception("Table does not exist")
+        with self.transaction():
+            if self.table_exists(name):
+                self._commit(["table", name, None])
+            else:
+                raise Exception("Table does not exist")
 
     def table_rename(self, name, new_name):
-        if self.table_exists(name):
-            self.data[new_name] = self.data[name]
-            del self.data[name]
-            self.save()
-        else:
-            raise Exception("Table does not exist")
+        with self.transaction():
+            if self.table_exists(name):
+                self._commit(
+                    ["table", new_name, self.data[name]], ["table", name, None]
+                )
+            else:
+                raise Exception("Table does not exist")
+
+    def table_compact(self, name):
+        """Drops tombstones of removed records. Ids of the remaining records change!"""
+        with self.transaction():
+            if self.table_exists(name):
+                self._commit(["compact", name])
+            else:
+                raise Exception("Table does not exist")
 
     def table_default_record(self, name):
         if self.table_exists(name):
@@ -721,7 +2909,7 @@ class SimpleStorage:
 
     def table_columns(self, name):
         if self.table_exists(name):
-            return self.data[name]["__COLUMNS__"].keys()
+            return self.data[name]["__DEFAULT__"].keys()
         else:
             raise Exception("Table does not exist")
 
@@ -745,13 +2933,40 @@ class SimpleStorage:
             raise Exception("Table does not exist")
 
     def record_add(self, name, **data):
-        if not self.table_exists(name):
-            raise Exception("Table does not exist")
-        if self.record_validate(name, **data):
-            self.data[name]["__DATA__"].append(data)
-            self.save()
+        with self.transaction():
+            if not self.table_exists(name):
+                raise Exception("Table does not exist")
+            default = self.table_default_record(name)
+            if data.keys() <= default.keys() or self.record_validate(name, **data):
+                record = dict(default)
+                record.update(data)
+                self._commit(["add", name, len(self.data[name]["__DATA__"]), record])
+
+    def record_add_many(self, name, rows):
+        """Validates all rows first and appends them with a single write
+
+        >>> record_add_many("test", [{"field": "value"}, {"field": "value2"}])
+        """
+        with self.transaction():
+            if not self.table_exists(name):
+                raise Exception("Table does not exist")
+            default = self.table_default_record(name)
+            columns = default.keys()
+            records = []
+            for row in rows:
+                for key in row:
+                    if key not in columns:
+                        raise Exception("Column '{}' does not exist".format(key))
+                record = dict(default)
+                record.update(row)
+                records.append(record)
+            start = len(self.data[name]["__DATA__"])
+            self._commit(
+                *(["add", name, id, record] for id, record in enumerate(records, start))
+            )
 
     def record_get_by_id(self, name, id):
+        """Returns the record, None if it was removed"""
         if not self.table_exists(name):
             raise Exception("Table does not exist")
         return self.data[name]["__DATA__"][id]
@@ -761,15 +2976,8 @@ class SimpleStorage:
         >>> record_get("test", ["field", "value"], ["field2", "value"])
         {"field": "value", "field2": "value", "other": "other"}
         """
-        if not self.table_exists(name):
-            raise Exception("Table does not exist")
-        records = self.data[name]["__DATA__"]
-        for i, record in enumerate(records):
-            for field, value in where:
-                if record[field] != value:
-                    break
-            else:
-                return record
+        for id in self._where_ids(name, where):
+            return self.data[name]["__DATA__"][id]
         return None
 
     def record_gets(self, name, *where):
@@ -777,69 +2985,41 @@ class SimpleStorage:
         >>> record_gets("test", ["field", "value"], ["field2", "value"])
         [{"field": "value", "field2": "value", "other": "other"}]
         """
-        if not self.table_exists(name):
-            raise Exception("Table does not exist")
+        ids = list(self._where_ids(name, where))
         records = self.data[name]["__DATA__"]
-        result = []
-        for i, record in enumerate(records):
-            for field, value in where:
-                if record[field] != value:
-                    break
-            else:
-                result.append(record)
-        return result
+        return [records[id] for id in ids]
 
     def record_get_id(self, name, *where):
         """
         >>> record_get_id("test", ["field", "value"], ["field2", "value"])
         0
         """
-        if not self.table_exists(name):
-            raise Exception("Table does not exist")
-        records = self.data[name]["__DATA__"]
-        for i, record in enumerate(records):
-            for field, value in where:
-                if record[field] != value:
-                    break
-            else:
-                return i
-        return None
+        return next(self._where_ids(name, where), None)
 
     def record_remove(self, name, *where):
-        if not self.table_exists(name):
-            raise Exception("Table does not exist")
-        records = self.data[name]["__DATA__"]
-        for i, record in enumerate(records):
-            for field, value in where:
-                if record[field] != value:
-                    break
-            else:
-                del records[i]
-        self.save()
+        with self.transaction():
+            id = self.record_get_id(name, *where)
+            if id is not None:
+                self._commit(["remove", name, id])
 
     def record_remove_by_id(self, name, id):
-        if not self.table_exists(name):
-            raise Exception("Table does not exist")
-        del self.data[name]["__DATA__"][id]
-        self.save()
+        with self.transaction():
+            if self.record_get_by_id(name, id) is None:
+                raise Exception("Record does not exist")
+            self._commit(["remove", name, id])
 
     def record_removes(self, name, *where):
-        if not self.table_exists(name):
-            raise Exception("Table does not exist")
-        records = self.data[name]["__DATA__"]
-        while record := self.record_get(name, *where):
-            self.record_remove(name, *where)
-        self.save()
+        with self.transaction():
+            ids = list(self._where_ids(name, where))
+            if ids:
+                self._commit(*(["remove", name, id] for id in ids))
 
     def record_update(self, name, *where, **data):
-        if not self.table_exists(name):
-            raise Exception("Table does not exist")
-        records = self.data[name]["__DATA__"]
-        for i, record in enumerate(records):
-            for field, value in where:
-                if record[field] != value:
-                    break
-            else:
-                for key, value in data.items():
-                    record[key] = value
-        self.save()
+        with self.transaction():
+            if not self.table_exists(name):
+                raise Exception("Table does not exist")
+            entries = [
+                ["update", name, id, data] for id in self._where_ids(name, where)
+            ]
+            if entries:
+                self._commit(*entries)
@@ -1,19 +1,56 @@
 from kotazutils.storage import (
     SimpleBase,
+    Table,
     ColumnAttribute,
     StorageManager,
     StorageColumn,
+    SimpleStorage,
+    JournalBackend,
+    Observer,
+    create_autoyaml,
+    storage_convert,
+    storage_restore,
 )
+from kotazutils.columnar import ColumnarStorage, columnar_save
+from kotazutils.asyncstorage import AsyncSimpleBase
+from kotazutils.kotazy import (
+    KotazyBudgetExceeded,
+    KotazyParser,
+    KotazyPool,
+    KotazyProcessor,
+    KotazyRunner,
+    KotazyTransformer,
+    kotazy_grammar,
+    kotazy_parser,
+)
+from lark import Lark
 
+import asyncio
+import contextlib
+import datetime
+import gc
+import io
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import uuid
+import unittest.mock
 
 
 class TestSimpleBase(unittest.TestCase):
     def setUp(self) -> None:
-        self.base = SimpleBase("test.db")
+        self.directory = tempfile.TemporaryDirectory()
+        self.base = SimpleBase(os.path.join(self.directory.name, "test.db"))
         return super().setUp()
 
     def tearDown(self) -> None:
+        self.base.pool.close()
+        self.directory.cleanup()
         return super().tearDown()
 
     def test_1(self):
@@ -74,12 +111,14 @@ class TestSimpleBase(unittest.TestCase):
         ]
 
 
-class TestSimpleBase(unittest.TestCase):
+class TestStorageManager(unittest.TestCase):
     def setUp(self) -> None:
-        storage = StorageManager("test.yml")
+        self.directory = tempfile.TemporaryDirectory()
+        self.storage = StorageManager(os.path.join(self.directory.name, "test.yml"))
         return super().setUp()
 
     def tearDown(self) -> None:
+        self.directory.cleanup()
         return super().tearDown()
 
     def test_storage_master(self):
@@ -100,6 +139,1176 @@ class TestSimpleBase(unittest.TestCase):
             rate=3.5,
         )
 
+    def test_constraints(self):
+        table = self.storage.table_add(
+            "test",
+            [
+                StorageColumn("name", "STR", ["UNIQUE"]),
+                StorageColumn("rate", "FLOAT", ["LIMIT 1 5"]),
+            ],
+        )
+        table.insert(name="Alex", rate=3.5)
+        with self.assertRaises(Exception):
+            table.insert(name="Alex", rate=2)
+        with self.assertRaises(Exception):
+            table.insert(name="Bob", rate=6)
+        table.insert(name="Bob", rate=5)
+        assert len(table.data) == 2
+
+        storage = StorageManager(self.storage.name)
+        table = storage.table_get("test")
+        assert table.data == [
+            {"name": "Alex", "rate": 3.5},
+            {"name": "Bob", "rate": 5},
+        ]
+        with self.assertRaises(Exception):
+            table.insert(name="Bob", rate=1)
+
+        # tables opened before a reload do not keep stale indexes
+        self.storage.table_get("test").insert(name="Carl", rate=1)
+        storage.load()
+        with self.assertRaises(Exception):
+            storage.table_get("test").insert(name="Carl", rate=2)
+
+        for column_type in ["BOOL", "UUID", "DATE", "TIMESTAMP", "NULL", "ANY"]:
+            with self.assertRaisesRegex(Exception, "'flag' does not support"):
+                storage.table_add(
+                    "flags", [StorageColumn("flag", column_type, ["LIMIT 0 1"])]
+                )
+        assert not storage.table_exists("flags")
+        storage.table_add("flags", [StorageColumn("flag", "BOOL", ["UNIQUE"])])
+
+    def test_insert_many(self):
+        table = self.storage.table_add(
+            "test",
+            [
+                StorageColumn("id", "UUID", ["UNIQUE"]),
+                StorageColumn("age", "INT", []),
+                StorageColumn("born", "DATE", []),
+            ],
+        )
+        first = uuid.uuid4()
+        ids = table.insert_many(
+            [
+                {"id": first, "age": 25, "born": datetime.date(2000, 1, 2)},
+                {"id": None, "age": None, "born": "2001-02-03"},
+            ]
+        )
+        assert list(ids) == [0, 1]
+        assert table.data[0] == {"id": str(first), "age": 25, "born": "2000-01-02"}
+        with self.assertRaises(Exception):
+            table.insert(id=None, age="25", born=None)
+        with self.assertRaises(Exception):
+            table.insert(id=None, age=25, born=None, city="Moscow")
+        second = uuid.uuid4()
+        with self.assertRaises(Exception):
+            table.insert_many(
+                [
+                    {"id": second, "age": 1, "born": None},
+                    {"id": str(second), "age": 2, "born": None},
+                ]
+            )
+        assert len(table.data) == 2
+        table.insert(id=second, age=1, born=None)
+        assert len(table.data) == 3
+
+        # inserts are fsynced one by one unless a batch size is given
+        for fsync, calls in [("always", 3), (100, 0)]:
+            table = StorageManager(self.storage.name, fsync=fsync).table_get("test")
+            with unittest.mock.patch("os.fsync") as mock:
+                for age in range(3):
+                    table.insert(id=None, age=age, born=None)
+            assert mock.call_count == calls
+        table = StorageManager(self.storage.name).table_get("test")
+        assert len(table.data) == 9
+
+    def test_insert_not_persisted(self):
+        table = self.storage.table_add(
+            "test",
+            [
+                StorageColumn("name", "STR", ["UNIQUE"]),
+                StorageColumn("avatar", "BLOB", []),
+                StorageColumn("extra", "ANY", []),
+            ],
+        )
+        table.insert(name="Alex", avatar=b"\x00\xff", extra=(1, 2))
+        with self.assertRaises(TypeError):
+            table.insert(name="Bob", avatar=None, extra=object())
+        with self.assertRaises(TypeError):
+            table.insert_many(
+                [
+                    {"name": "Bob", "avatar": None, "extra": None},
+                    {"name": "Carl", "avatar": None, "extra": object()},
+                ]
+            )
+        with unittest.mock.patch.object(JournalBackend, "write", side_effect=OSError):
+            with self.assertRaises(OSError):
+                table.insert(name="Bob", avatar=None, extra=None)
+        assert len(table.data) == 1
+        assert table.key_index("name") == {"Alex": 0}
+        table.insert(name="Bob", avatar=b"", extra=None)
+
+        storage = StorageManager(self.storage.name)
+        table = storage.table_get("test")
+        assert table.data == [
+            {"name": "Alex", "avatar": b"\x00\xff", "extra": (1, 2)},
+            {"name": "Bob", "avatar": b"", "extra": None},
+        ]
+        with self.assertRaises(Exception):
+            table.insert(name="Bob", avatar=None, extra=None)
+
+    def test_unique_unhashable(self):
+        table = self.storage.table_add(
+            "test", [StorageColumn("value", "ANY", ["UNIQUE"])]
+        )
+        table.insert(value=["a"])
+        table.insert(value="['a']")
+        with self.assertRaises(Exception):
+            table.insert(value=["a"])
+        assert len(table.data) == 2
+
+    def test_link(self):
+        users = self.storage.table_add(
+            "users",
+            [
+                StorageColumn("login", "STR", ["UNIQUE"]),
+                StorageColumn("city", "STR", []),
+            ],
+        )
+        orders = self.storage.table_add(
+            "orders",
+            [
+                StorageColumn("user", "STR", ["LINK users login"]),
+                StorageColumn("item", "STR", []),
+            ],
+        )
+        users.insert_many(
+            [{"login": "alex", "city": "Moscow"}, {"login": "bob", "city": "Kazan"}]
+        )
+        orders.insert_many(
+            [
+                {"user": "alex", "item": "book"},
+                {"user": "bob", "item": "pen"},
+                {"user": "alex", "item": "cup"},
+                {"user": None, "item": "gift"},
+            ]
+        )
+        with self.assertRaises(Exception):
+            orders.insert(user="carl", item="hat")
+
+        pairs = [(o["item"], u["login"]) for o, u in orders.join(users, on="user")]
+        assert pairs == [("book", "alex"), ("pen", "bob"), ("cup", "alex")]
+        pairs = [(u["login"], o["item"]) for u, o in users.join(orders, on="user")]
+        assert pairs == [("alex", "book"), ("alex", "cup"), ("bob", "pen")]
+        pairs = list(orders.join(users, on=("user", "login")))
+        assert len(pairs) == 3
+
+        storage = StorageManager(self.storage.name)
+        orders = storage.table_get("orders")
+        with self.assertRaises(Exception):
+            orders.insert(user="carl", item="hat")
+        orders.insert(user="bob", item="hat")
+        assert orders.links["user"].reverse["bob"] == [1, 4]
+
+        # a bad target is rejected when the table is added or opened
+        for link, error in [
+            ("LINK user login", "'user' which does not exist"),
+            ("LINK users name", "missing column 'name' of table 'users'"),
+            ("LINK users city", "'city' of table 'users' is not UNIQUE"),
+        ]:
+            with self.assertRaisesRegex(Exception, error):
+                storage.table_add("bad", [StorageColumn("user", "STR", [link])])
+            assert not storage.table_exists("bad")
+        storage.table_add("tree", [StorageColumn("parent", "INT", ["LINK tree"])])
+        storage.data["users"]["__COLUMNS__"][0]["attributes"] = []
+        storage.tables.clear()
+        with self.assertRaisesRegex(
+            Exception, "'login' of table 'users' is not UNIQUE"
+        ):
+            storage.table_get("orders")
+
+
+class TestTable(unittest.TestCase):
+    def setUp(self) -> None:
+        self.base = SimpleBase(":memory:")
+        self.table = self.base.create_table(
+            "test",
+            [
+                ColumnAttribute("name", "TEXT", primary_key=True),
+                ColumnAttribute("age", "INTEGER"),
+            ],
+        )
+        return super().setUp()
+
+    def test_bulk(self):
+        rows = ({"name": str(i), "age": i} for i in range(2500))
+        assert self.table.insert_many(rows, chunk_size=1000) == 2500
+        assert len(self.table.get()) == 2500
+        assert sum(1 for _ in self.table.iter(batch_size=100)) == 2500
+        assert next(self.table.iter(order="age")) == ("2499", 2499)
+        self.table.insert({"name": "a", "age": -1}, {"name": "b", "age": -2})
+        assert len(self.table.get()) == 2502
+
+    def test_snapshot(self):
+        self.table.insert_many({"name": str(i), "age": i} for i in range(3000))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "backup.db")
+            self.base.snapshot(path, pages=4)
+            base = SimpleBase(path)
+            assert len(Table(base, "test").get()) == 3000
+            base.pool.close()
+
+    def test_filters(self):
+        table = self.base.create_table(
+            "people",
+            [
+                ColumnAttribute("name", "TEXT"),
+                ColumnAttribute("age", "INTEGER", index=True),
+                ColumnAttribute("city", "TEXT"),
+            ],
+        )
+        table.insert_many(
+            [
+                {"name": "Alex", "age": 25, "city": "Moscow"},
+                {"name": "Bob", "age": 30, "city": None},
+                {"name": "Eve", "age": 35, "city": "Moscow"},
+            ]
+        )
+        assert table.get(city="Moscow", age__gt=25) == [("Eve", 35, "Moscow")]
+        assert table.get(city=None) == [("Bob", 30, None)]
+        assert table.get(order="age", desc=False, limit=1, offset=1) == [
+            ("Bob", 30, None)
+        ]
+        assert len(table.get(name__in=["Alex", "Eve", "Zed"])) == 2
+        assert len(table.statements) == 4
+        table.get(city="Kazan", age__gt=0)
+        assert len(table.statements) == 4
+        plan = " ".join(row[-1] for row in table.explain(age=30))
+        assert "people_age_index" in plan
+        with self.assertRaises(Exception):
+            table.get(age__like=1)
+
+    def test_pool(self):
+        with tempfile.TemporaryDirectory() as directory:
+            base = SimpleBase(os.path.join(directory, "test.db"), profile="wal")
+            table = base.create_table("test", [ColumnAttribute("age", "INTEGER")])
+            table.insert_many({"age": i} for i in range(100))
+            mode = base.connection.execute("PRAGMA journal_mode").fetchone()
+            assert mode == ("wal",)
+
+            results = []
+            threads = [
+                threading.Thread(
+                    target=lambda: results.append((base.connection, len(table.get())))
+                )
+                for _ in range(4)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert [count for _, count in results] == [100] * 4
+            assert len({id(connection) for connection, _ in results}) == 4
+
+            # every insert commits, so the other threads are not locked out
+            table.insert({"age": 100})
+            threads = [
+                threading.Thread(target=table.insert, args=({"age": 101 + i},))
+                for i in range(4)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert len(table.get()) == 105
+
+            # connections of finished threads are closed
+            threads = [threading.Thread(target=table.get) for _ in range(50)]
+            for thread in threads:
+                thread.start()
+                thread.join()
+            gc.collect()
+            assert base.pool.connections == [base.connection]
+            with self.assertRaises(sqlite3.ProgrammingError):
+                results[0][0].execute("SELECT 1")
+            base.pool.close()
+
+    def test_transaction(self):
+        with self.base.transaction():
+            self.table.insert({"name": "Alex", "age": 25})
+            with self.assertRaises(Exception):
+                with self.base.transaction():
+                    self.table.insert({"name": "Bob", "age": 30})
+                    self.table.insert({"name": "Alex", "age": 26})
+            self.table.insert({"name": "Eve", "age": 35})
+        assert self.table.get(order="age", desc=False) == [("Alex", 25), ("Eve", 35)]
+        with self.assertRaises(Exception):
+            with self.base.transaction():
+                self.table.insert_many([{"name": "Zed", "age": 1}])
+                raise Exception("rolled back")
+        with self.assertRaises(Exception):
+            self.table.insert({"name": "Carl", "age": 1}, {"name": "Eve", "age": 2})
+        assert len(self.table.get()) == 2
+
+        # threads sharing the ":memory:" connection do not join each other's transaction
+        started, inserted = threading.Event(), threading.Event()
+
+        def insert_other():
+            started.wait()
+            self.table.insert({"name": "Dan", "age": 40})
+            inserted.set()
+
+        thread = threading.Thread(target=insert_other)
+        thread.start()
+        with self.assertRaises(ZeroDivisionError):
+            with self.base.transaction():
+                self.table.insert({"name": "Zed", "age": 1})
+                started.set()
+                inserted.wait(0.2)
+                1 / 0
+        thread.join()
+        assert self.table.get(age=40) == [("Dan", 40)]
+        assert self.table.get(name="Zed") == []
+
+    def test_async(self):
+        async def scenario(path):
+            async with AsyncSimpleBase(path, max_pending=10) as base:
+                table = await base.create_table(
+                    "test",
+                    [
+                        ColumnAttribute("name", "TEXT", unique=True),
+                        ColumnAttribute("age", "INTEGER"),
+                    ],
+                )
+                await asyncio.gather(
+                    *(table.insert({"name": str(i), "age": i}) for i in range(100))
+                )
+                with self.assertRaises(Exception):
+                    await table.insert({"name": "1", "age": 1})
+
+                calls = []
+
+                def insert_once(row):
+                    calls.append(row)
+                    return table.table.insert(row)
+
+                results = await asyncio.gather(
+                    base.write(insert_once, {"name": "a", "age": 100}),
+                    table.insert({"name": "2", "age": 100}),
+                    base.write(insert_once, {"name": "b", "age": 100}),
+                    return_exceptions=True,
+                )
+                assert isinstance(results[1], Exception)
+                assert len(calls) == 2
+                assert len(await table.get(age=100)) == 2
+
+                # a write cancelled while queued is skipped and the writer keeps going
+                release = threading.Event()
+                blocked = asyncio.ensure_future(base.write(release.wait))
+                await asyncio.sleep(0.05)
+                cancelled = asyncio.ensure_future(
+                    base.write(insert_once, {"name": "c", "age": 100})
+                )
+                await asyncio.sleep(0.05)
+                cancelled.cancel()
+                await asyncio.sleep(0.05)
+                release.set()
+                await blocked
+                await asyncio.wait_for(table.insert({"name": "d", "age": 100}), 5)
+                assert len(calls) == 2
+                assert len(await table.get(age=100)) == 3
+                return await table.get(age__lt=10)
+
+        with tempfile.TemporaryDirectory() as directory:
+            rows = asyncio.run(scenario(os.path.join(directory, "test.db")))
+            assert len(rows) == 10
+
+
+def increment_counter(path, journal, count):
+    backend = JournalBackend(path, fsync="never") if journal else None
+    storage = SimpleStorage(path, backend=backend, lock=True)
+    for _ in range(count):
+        with storage.transaction():
+            value = storage.record_get("counter", ["key", "hits"])["value"]
+            storage.record_update("counter", ["key", "hits"], value=value + 1)
+    storage.close()
+
+
+class TestSimpleStorage(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "storage.yml")
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+        return super().tearDown()
+
+    def test_journal(self):
+        storage = SimpleStorage(self.path, backend=JournalBackend(self.path))
+        storage.table_add("users", {"login": "", "age": 0})
+        storage.record_add("users", login="Alex", age=25)
+        storage.record_add("users", login="Bob")
+        storage.record_update("users", ["login", "Bob"], age=30)
+        storage.record_remove("users", ["login", "Alex"])
+        storage.close()
+        with open(self.path + ".log") as f:
+            # the snapshot header, then one line per write
+            assert len(f.readlines()) == 1 + 5
+
+        storage = SimpleStorage(self.path, backend=JournalBackend(self.path))
+        assert storage.record_gets("users") == [{"login": "Bob", "age": 30}]
+        storage.compact()
+        assert os.path.getsize(self.path + ".log") == 0
+        storage = SimpleStorage(self.path, backend=JournalBackend(self.path))
+        assert storage.record_get("users", ["age", 30]) == {"login": "Bob", "age": 30}
+
+    def test_journal_types(self):
+        record = {
+            "born": datetime.date(2000, 1, 2),
+            "seen": datetime.datetime(2020, 5, 6, 7, 8, 9),
+            "pair": (1, "a"),
+            "tags": {"a"},
+            "avatar": b"\x00\xff",
+            "id": uuid.UUID(int=1),
+            "scores": {1: 2.5, (1, 2): None, "__type__": "x"},
+        }
+        storage = SimpleStorage(self.path, backend=JournalBackend(self.path))
+        storage.table_add("users", dict.fromkeys(record))
+        storage.record_add("users", **record)
+        full = os.path.join(self.directory.name, "full.log")
+        storage.backup(full)
+        with self.assertRaises(TypeError):
+            storage.record_add("users", born=object())
+        assert len(storage.record_gets("users")) == 1
+        storage.close()
+
+        storage = SimpleStorage(self.path, backend=JournalBackend(self.path))
+        assert storage.record_gets("users") == [record]
+        assert storage_restore(full)["users"]["__DATA__"] == [record]
+
+    def test_index(self):
+        storage = SimpleStorage(self.path)
+        storage.table_add("users", {"login": "", "age": 0, "city": ""})
+        storage.index_create("users", "city")
+        storage.index_create("users", "city", "age")
+        for i in range(10):
+            storage.record_add("users", login=str(i), age=i % 3, city="Moscow")
+        assert storage.table_indexes("users") == [("city",), ("city", "age")]
+        assert storage.record_get_id("users", ["city", "Moscow"], ["age", 2]) == 2
+        storage.record_update("users", ["login", "2"], city="Kazan")
+        assert storage.record_get_id("users", ["city", "Moscow"], ["age", 2]) == 5
+        assert storage.record_gets("users", ["city", "Kazan"]) == [
+            {"login": "2", "age": 2, "city": "Kazan"}
+        ]
+        storage.record_remove("users", ["login", "0"])
+        assert len(storage.record_gets("users", ["city", "Moscow"])) == 8
+
+        storage = SimpleStorage(self.path)
+        assert storage.table_indexes("users") == [("city",), ("city", "age")]
+        assert storage.record_get("users", ["city", "Kazan"])["login"] == "2"
+
+    def test_index_unhashable(self):
+        storage = SimpleStorage(self.path)
+        storage.table_add("users", {"login": "", "tags": None})
+        storage.record_add("users", login="alex", tags=["admin"])
+        storage.index_create("users", "tags")
+        storage.index_create("users", "login")
+        assert storage.record_get("users", ["tags", ["admin"]])["login"] == "alex"
+        assert storage.record_get_id("users", ["login", "alex"]) == 0
+
+        storage.record_update("users", ["login", "alex"], tags="admin")
+        storage.record_add("users", login="bob", tags="admin")
+        storage.index_create("users", "tags")
+        assert len(storage.record_gets("users", ["tags", "admin"])) == 2
+        storage.record_add("users", login="carl", tags={"root": True})
+        storage.record_update("users", ["login", "bob"], tags=["root"])
+        assert storage.record_gets("users", ["tags", {"root": True}])[0]["login"] == (
+            "carl"
+        )
+        assert storage.record_get_id("users", ["tags", ["root"]]) == 1
+        assert storage.record_get_id("users", ["tags", "admin"]) == 0
+
+    def test_transaction(self):
+        storage = SimpleStorage(self.path, backend=JournalBackend(self.path))
+        storage.table_add("users", {"login": "", "age": 0})
+        storage.index_create("users", "login")
+        size = os.path.getsize(self.path + ".log")
+        with storage.transaction():
+            storage.record_add_many("users", [{"login": str(i)} for i in range(100)])
+            storage.record_update("users", ["login", "5"], age=5)
+            assert os.path.getsize(self.path + ".log") == size
+        with open(self.path + ".log") as f:
+            assert len(f.readlines()) == 1 + 2 + 1
+
+        with self.assertRaises(ZeroDivisionError):
+            with storage.batch():
+                storage.record_add("users", login="lost")
+                storage.record_update("users", ["login", "5"], age=6)
+                storage.table_rename("users", "people")
+                1 / 0
+        assert storage.table_list() == {"users"}
+        assert len(storage.record_gets("users")) == 100
+        assert storage.record_get("users", ["login", "5"])["age"] == 5
+        assert storage.record_get("users", ["login", "lost"]) is None
+
+        with self.assertRaises(Exception):
+            storage.record_add_many("users", [{"login": "a"}, {"unknown": 1}])
+        storage.close()
+        storage = SimpleStorage(self.path, backend=JournalBackend(self.path))
+        assert len(storage.record_gets("users")) == 100
+
+        # a crash in the middle of writing a transaction keeps none of it
+        with storage.transaction():
+            storage.record_update("users", ["login", "1"], age=-10)
+            storage.record_update("users", ["login", "2"], age=10)
+        storage.close()
+        os.truncate(self.path + ".log", os.path.getsize(self.path + ".log") - 10)
+        storage = SimpleStorage(self.path, backend=JournalBackend(self.path))
+        assert storage.record_get("users", ["login", "1"])["age"] == 0
+        assert storage.record_get("users", ["login", "2"])["age"] == 0
+        storage.close()
+
+    def test_serializers(self):
+        for serializer in ["yaml", "json", "pickle"]:
+            path = "{}.{}".format(self.path, serializer)
+            storage = SimpleStorage(path, serializer=serializer)
+            storage.table_add("users", {"login": "", "age": 0})
+            storage.record_add("users", login="Alex", age=25)
+            # the format is detected on load whatever the backend writes with
+            storage = SimpleStorage(path)
+            assert storage.record_get("users", ["login", "Alex"])["age"] == 25
+
+        storage_convert(self.path + ".yaml", self.path + ".bin", "pickle")
+        with open(self.path + ".bin", "rb") as f:
+            assert f.read(1) == b"\x80"
+        storage = SimpleStorage(self.path + ".bin")
+        assert storage.record_get("users", ["login", "Alex"])["age"] == 25
+
+    def test_tombstones(self):
+        storage = SimpleStorage(self.path, backend=JournalBackend(self.path))
+        storage.table_add("users", {"login": "", "age": 0})
+        storage.index_create("users", "age")
+        storage.record_add_many(
+            "users", [{"login": str(i), "age": i % 2} for i in range(10)]
+        )
+        storage.record_removes("users", ["age", 0])
+        with open(self.path + ".log") as f:
+            # header, table, index, then one line per write holding all of its entries
+            lines = f.readlines()
+            assert len(lines) == 1 + 2 + 1 + 1
+            assert lines[-1].count('"remove"') == 5
+        assert storage.record_get_by_id("users", 0) is None
+        assert storage.record_get_by_id("users", 3) == {"login": "3", "age": 1}
+        assert storage.record_get_id("users", ["login", "7"]) == 7
+        assert storage.record_gets("users", ["age", 0]) == []
+        with self.assertRaises(Exception):
+            storage.record_remove_by_id("users", 0)
+
+        storage.close()
+        storage = SimpleStorage(self.path, backend=JournalBackend(self.path))
+        assert storage.record_get_id("users", ["login", "7"]) == 7
+        storage.table_compact("users")
+        assert storage.record_get_id("users", ["login", "7"]) == 3
+        assert len(storage.record_gets("users", ["age", 1])) == 5
+
+        storage.record_remove("users", ["login", "1"])
+        storage.record_remove("users", ["login", "3"])
+        assert len(storage.table_get("users")["__DATA__"]) == 3
+        storage.save()
+        assert storage.record_get_by_id("users", 1) is None
+        storage.record_remove("users", ["login", "5"])
+        with self.assertRaises(ZeroDivisionError):
+            with storage.transaction():
+                storage.table_compact("users")
+                assert storage.record_get_id("users", ["login", "7"]) == 0
+                1 / 0
+        assert storage.record_get_id("users", ["login", "7"]) == 3
+        assert storage.record_get_by_id("users", 4)["login"] == "9"
+        # saving and folding the journal never renumber records
+        storage.save()
+        storage.compact()
+        assert storage.record_get_id("users", ["login", "7"]) == 3
+        storage.close()
+        storage = SimpleStorage(self.path, backend=JournalBackend(self.path))
+        assert storage.record_get_id("users", ["login", "7"]) == 3
+        storage.table_compact("users")
+        assert storage.record_get_id("users", ["login", "7"]) == 0
+
+        # tables are read-only views whether they hold tombstones or not
+        for table in [storage.table_get("users"), storage.table_add("users", {})]:
+            assert table["__DATA__"] == (
+                {"login": "7", "age": 1},
+                {"login": "9", "age": 1},
+            )
+            with self.assertRaises(TypeError):
+                table["__DATA__"] = []
+        storage.record_remove("users", ["login", "9"])
+        table = storage.table_get("users")
+        assert table["__DATA__"] == ({"login": "7", "age": 1},)
+        with self.assertRaises(AttributeError):
+            table["__DATA__"].append({"login": "10", "age": 0})
+
+    def test_query(self):
+        storage = SimpleStorage(self.path)
+        storage.table_add("users", {"login": "", "age": 0, "city": ""})
+        storage.index_create("users", "city")
+        storage.record_add_many(
+            "users",
+            [
+                {"login": "a", "age": 30, "city": "Moscow"},
+                {"login": "b", "age": 18, "city": "Moscow"},
+                {"login": "c", "age": 40, "city": "Kazan"},
+                {"login": "d", "age": 25, "city": "Moscow"},
+            ],
+        )
+        query = storage.query("users").where(age__gt=20, city="Moscow")
+        assert list(query.select("login").order_by("age")) == [
+            {"login": "d"},
+            {"login": "a"},
+        ]
+        assert list(query.limit(1)) == [{"login": "d"}]
+        assert storage.query("users").order_by("-age").first()["login"] == "c"
+        assert storage.query("users").where(login__in={"a", "c"}).count() == 2
+        with self.assertRaises(Exception):
+            storage.query("users").where(age__like=1)
+
+    def test_typed(self):
+        for serializer in ("yaml", "json", "pickle"):
+            path = os.path.join(self.directory.name, "typed." + serializer)
+            storage = SimpleStorage(path, serializer=serializer, typed=True)
+            storage.table_add("users", {"login": "", "age": 0, "tags": []})
+            storage.index_create("users", "age")
+            storage.record_add("users", login="Alex", age=25)
+            storage.record_add_many("users", [{"login": "Bob", "age": 30}])
+            storage.record_update("users", ["login", "Bob"], age=25)
+            record = storage.record_get("users", ["login", "Alex"])
+            assert not isinstance(record, dict)
+            assert record == {"login": "Alex", "age": 25, "tags": []}
+            assert dict(record) == {"login": "Alex", "age": 25, "tags": []}
+            assert record["age"] == 25 and record.get("city") is None
+            with self.assertRaises(KeyError):
+                storage.record_update("users", ["login", "Alex"], city="Moscow")
+            assert storage.record_get("users", ["login", "Alex"]) == record
+
+            storage = SimpleStorage(path, serializer=serializer, typed=True)
+            assert storage.record_gets("users", ["age", 25]) == [
+                {"login": "Alex", "age": 25, "tags": []},
+                {"login": "Bob", "age": 25, "tags": []},
+            ]
+            assert SimpleStorage(path).record_get("users", ["login", "Bob"]) == {
+                "login": "Bob",
+                "age": 25,
+                "tags": [],
+            }
+
+        storage = SimpleStorage(
+            self.path, backend=JournalBackend(self.path), typed=True
+        )
+        storage.table_add("users", {"login": "", "age": 0})
+        storage.record_add("users", login="Alex", age=25)
+        storage.table_rename("users", "people")
+        storage.close()
+        storage = SimpleStorage(self.path, backend=JournalBackend(self.path))
+        assert storage.record_gets("people") == [{"login": "Alex", "age": 25}]
+
+    def test_backup(self):
+        storage = SimpleStorage(self.path)
+        storage.table_add("users", {"login": "", "age": 0})
+        storage.record_add("users", login="Alex", age=25)
+        full = os.path.join(self.directory.name, "full.log")
+        id, data = storage.snapshot()
+        storage.record_update("users", ["login", "Alex"], age=26)
+        storage.record_add("users", login="Bob")
+        assert data["users"]["__DATA__"] == [{"login": "Alex", "age": 25}]
+
+        id = storage.backup(full)
+        storage.record_update("users", ["login", "Bob"], age=30)
+        storage.record_remove("users", ["login", "Alex"])
+        first = os.path.join(self.directory.name, "1.log")
+        id = storage.backup(first, since=id)
+        storage.table_add("cities", {"name": ""})
+        second = os.path.join(self.directory.name, "2.log")
+        storage.backup(second, since=id)
+        with self.assertRaises(Exception):
+            storage.backup(second, since=0)
+        assert storage_restore(full, first, second) == storage.data
+        assert storage_restore(full)["users"]["__DATA__"] == [
+            {"login": "Alex", "age": 26},
+            {"login": "Bob", "age": 0},
+        ]
+
+    def test_locking(self):
+        context = multiprocessing.get_context("fork")
+        for journal in (False, True):
+            path = os.path.join(self.directory.name, "locked{}.yml".format(journal))
+            backend = JournalBackend(path, fsync="never") if journal else None
+            storage = SimpleStorage(path, backend=backend, lock=True)
+            storage.table_add("counter", {"key": "", "value": 0})
+            storage.record_add("counter", key="hits")
+            processes = [
+                context.Process(target=increment_counter, args=(path, journal, 25))
+                for _ in range(4)
+            ]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+                assert process.exitcode == 0
+            assert storage.stale()
+            assert storage.refresh()
+            assert not storage.refresh()
+            assert storage.record_get("counter", ["key", "hits"])["value"] == 100
+            storage.close()
+
+    def test_locking_stale(self):
+        for journal in (False, True):
+            path = os.path.join(self.directory.name, "stale{}.yml".format(journal))
+            handles = [
+                SimpleStorage(
+                    path,
+                    backend=JournalBackend(path) if journal else None,
+                    lock=True,
+                )
+                for _ in range(2)
+            ]
+            first, second = handles
+            first.table_add("users", {"login": ""})
+            second.refresh()
+            first.record_add("users", login="Alex")
+            # the old generation of the second handle must not overwrite the row
+            with self.assertRaises(Exception):
+                second.save()
+            second.compact()
+            assert second.record_gets("users") == [{"login": "Alex"}]
+            second.save()
+            for handle in handles:
+                handle.close()
+            storage = SimpleStorage(
+                path, backend=JournalBackend(path) if journal else None
+            )
+            assert storage.record_gets("users") == [{"login": "Alex"}]
+            storage.close()
+
+    def test_locking_stale_mutators(self):
+        for journal in (False, True):
+            path = os.path.join(self.directory.name, "mutate{}.yml".format(journal))
+            first, second = [
+                SimpleStorage(
+                    path,
+                    backend=JournalBackend(path) if journal else None,
+                    lock=True,
+                )
+                for _ in range(2)
+            ]
+            first.table_add("users", {"login": "", "age": 0})
+            # every mutator reloads stale data before it works out ids
+            second.record_add("users", login="B1")
+            first.record_add("users", login="A1")
+            second.record_add("users", login="B2")
+            first.record_update("users", ["login", "B2"], age=1)
+            second.record_remove("users", ["login", "A1"])
+            first.record_add_many("users", [{"login": "A2"}])
+            second.record_update("users", ["login", "A2"], age=2)
+            expected = [
+                {"login": "B1", "age": 0},
+                {"login": "B2", "age": 1},
+                {"login": "A2", "age": 2},
+            ]
+            for handle in (first, second):
+                handle.refresh()
+                assert handle.record_gets("users") == expected
+                handle.close()
+            storage = SimpleStorage(
+                path, backend=JournalBackend(path) if journal else None
+            )
+            assert storage.record_gets("users") == expected
+            storage.close()
+
+    def test_columnar(self):
+        storage = SimpleStorage(self.path)
+        storage.table_add("users", {"login": "", "age": 0, "rate": 0.0, "tags": []})
+        storage.index_create("users", "age")
+        storage.record_add_many(
+            "users",
+            [
+                {"login": "Alex", "age": 25, "rate": 1.5, "tags": ["a"]},
+                {"login": "Боб", "age": 30, "rate": 2.5},
+                {"login": "Eve", "age": 25, "rate": 3.5},
+            ],
+        )
+        storage.record_remove("users", ["login", "Eve"])
+        columnar_save(self.path + ".col", storage.data)
+
+        with ColumnarStorage(self.path + ".col") as columnar:
+            assert columnar.table_indexes("users") == [("age",)]
+            assert columnar.record_get("users", ["login", "Боб"]) == {
+                "login": "Боб",
+                "age": 30,
+                "rate": 2.5,
+                "tags": [],
+            }
+            assert columnar.record_gets("users", ["age", 25]) == [
+                storage.record_get_by_id("users", 0)
+            ]
+            assert columnar.record_get_id("users", ["rate", 2.5]) == 1
+            assert columnar.record_get_by_id("users", 2) is None
+
+        # an index over unhashable values falls back to a scan
+        storage.index_create("users", "tags")
+        columnar_save(self.path + ".col", storage.data)
+        with ColumnarStorage(self.path + ".col") as columnar:
+            assert columnar.record_get("users", ["tags", ["a"]])["login"] == "Alex"
+            assert columnar.record_get_id("users", ["tags", []]) == 1
+            assert columnar.record_gets("users", ["age", 30])[0]["login"] == "Боб"
+
+        with self.assertRaisesRegex(Exception, "not a columnar storage"):
+            ColumnarStorage(self.path)
+        other = "big" if sys.byteorder == "little" else "little"
+        with unittest.mock.patch.object(sys, "byteorder", other):
+            columnar_save(self.path + ".col", storage.data)
+        with self.assertRaisesRegex(Exception, "written on another platform"):
+            ColumnarStorage(self.path + ".col")
+
+
+class TestObserver(unittest.TestCase):
+    def test_observer(self):
+        changes = []
+
+        class Holder(object):
+            data = Observer({}, callback=lambda o, i, value: changes.append(value))
+
+        holder = Holder()
+        holder.data = {"users": {"alex": {"tags": []}}}
+        holder.data["users"]["alex"]["age"] = 25
+        holder.data["users"]["alex"]["tags"].append("admin")
+        assert len(changes) == 3
+        assert changes[-1] == {"users": {"alex": {"age": 25, "tags": ["admin"]}}}
+        assert holder.data["users"]["alex"] is holder.data["users"]["alex"]
+        assert holder.data.value is changes[-1]
+
+        holder.data["users"] = {"bob": {}}
+        assert "alex" not in holder.data["users"]
+        assert Holder().data.value == {}
+
+        # cached proxies do not keep removed items alive
+        sessions = holder.data["users"]
+        for i in range(100):
+            sessions[i] = {"id": i}
+            assert sessions[i]["id"].value == i
+            del sessions[i]
+        sessions["a"], sessions["b"], sessions["c"] = {}, {}, {}
+        sessions["a"], sessions["b"], sessions["c"]
+        sessions["a"] = {}
+        sessions.pop("b")
+        assert list(sessions._children) == ["c"]
+        sessions.popitem()
+        assert not sessions._children
+        holder.data["users"]["a"]["tags"] = [[1], [2]]
+        tags = holder.data["users"]["a"]["tags"]
+        tags[0], tags[1]
+        tags.remove([1])
+        assert not tags._children
+
+    def test_autoyaml_debounce(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "auto.yml")
+            writes = []
+            # the initial assignment of {} counts as the first pending change
+            auto, load = create_autoyaml(path, max_pending=100)
+            with unittest.mock.patch(
+                "kotazutils.storage.atomic_write",
+                side_effect=lambda *args: writes.append(args),
+            ):
+                for i in range(250):
+                    auto.data[str(i)] = i
+                assert len(writes) == 2
+                auto.flush()
+                assert len(writes) == 3
+                auto.flush()
+                assert len(writes) == 3
+
+            auto, load = create_autoyaml(path, delay=0.01)
+            auto.data["key"] = "value"
+            auto.data["key2"] = "value"
+            time.sleep(0.2)
+            load()
+            assert auto.data.value == {"key": "value", "key2": "value"}
+            auto.flush()
+
+            auto, load = create_autoyaml(path, max_pending=2)
+            with unittest.mock.patch(
+                "kotazutils.storage.atomic_write", side_effect=OSError
+            ):
+                with self.assertRaises(OSError):
+                    auto.data["key3"] = "value"
+            auto.flush()
+            load()
+            assert auto.data.value["key3"] == "value"
+            with unittest.mock.patch("atexit.unregister") as unregister:
+                auto.close()
+                assert unregister.called
+            with self.assertRaises(Exception):
+                create_autoyaml(path, journal=True, delay=1)
+
+    def test_changes(self):
+        changes = []
+
+        class Holder(object):
+            data = Observer({}, change_callback=lambda o, i, c: changes.append(c))
+
+        holder = Holder()
+        holder.data = {"users": {"alex": {"tags": []}}}
+        holder.data["users"]["alex"]["tags"] += ["admin"]
+        holder.data["users"].setdefault("bob", {})
+        holder.data["users"].setdefault("bob", {"ignored": True})
+        del holder.data["users"]["alex"]
+        assert [(c.path, c.operation) for c in changes] == [
+            ((), "set"),
+            (("users", "alex", "tags"), "extend"),
+            (("users", "bob"), "set"),
+            (("users", "alex"), "delete"),
+        ]
+        assert changes[1].new == [["admin"]]
+        assert changes[3].old == {"tags": ["admin"]}
+
+        # items removed by set.pop and dict.popitem are recorded, not the bare call
+        holder.data["tags"] = {"admin", "root"}
+        tag = holder.data["tags"].pop()
+        key, value = holder.data["users"].popitem()
+        assert changes[-2] == (("tags",), "remove", None, [tag])
+        assert changes[-1] == (("users", key), "delete", value, None)
+
+    def test_autoyaml_journal(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "auto.yml")
+            auto, load = create_autoyaml(path, journal=True)
+            auto.data["users"] = {"alex": {"tags": []}}
+            auto.data["users"]["alex"]["tags"].append("admin")
+            auto.data["users"]["alex"]["tags"] += ["root"]
+            auto.data["users"]["bob"] = 1
+            auto.data["users"].pop("bob")
+            with open(path + ".log") as f:
+                assert len(f.readlines()) == 1 + 5
+
+            auto, load = create_autoyaml(path, journal=True)
+            assert auto.data.value == {"users": {"alex": {"tags": ["admin", "root"]}}}
+            assert os.path.getsize(path + ".log") == 0
+
+            auto.data["tags"] = {"admin"}
+            auto.data["tags"].add("root")
+            auto.data["pair"] = (1, 2)
+            with self.assertRaises(TypeError):
+                auto.data["broken"] = object()
+            with self.assertRaises(TypeError):
+                auto.data["tags"].update([object()])
+            with self.assertRaises(TypeError):
+                auto.data["users"].setdefault("bob", object())
+            assert "broken" not in auto.data
+            assert "bob" not in auto.data["users"]
+            assert auto.data["tags"].value == {"admin", "root"}
+            auto.data["users"]["bob"] = 1
+
+            auto, load = create_autoyaml(path, journal=True)
+            assert auto.data.value == {
+                "users": {"alex": {"tags": ["admin", "root"]}, "bob": 1},
+                "tags": {"admin", "root"},
+                "pair": (1, 2),
+            }
+
+            # a crash between replacing the snapshot and truncating the log
+            auto.data["users"]["alex"]["tags"].append("owner")
+            with open(path + ".log", "rb") as f:
+                log = f.read()
+            auto, load = create_autoyaml(path, journal=True)
+            with open(path + ".log", "wb") as f:
+                f.write(log)
+            auto, load = create_autoyaml(path, journal=True)
+            assert auto.data["users"]["alex"]["tags"].value == [
+                "admin",
+                "root",
+                "owner",
+            ]
+            auto.data["users"]["bob"] = 2
+            auto, load = create_autoyaml(path, journal=True)
+            assert auto.data["users"]["bob"].value == 2
+
+            # set.pop replays the removal of the element that was popped
+            auto.data["roles"] = set(range(100))
+            popped = {auto.data["roles"].pop() for _ in range(50)}
+            auto.data["users"].popitem()
+            expected = auto.data.value
+            auto, load = create_autoyaml(path, journal=True)
+            assert auto.data.value == expected
+            assert not popped & auto.data["roles"].value
+
+
+def kotazy_rep(_proc, count, block):
+    for _ in range(int(_proc.ast_load(count))):
+        _proc.ast_load(block)
+
+
+def kotazy_runner():
+    runner = KotazyRunner()
+    runner.processor.install_environments({"rep": kotazy_rep})
+    return runner
+
+
+class TestKotazy(unittest.TestCase):
+    def setUp(self) -> None:
+        self.runner = KotazyRunner()
+        return super().setUp()
+
+    def test_compiler(self):
+        def twice(_proc, block):
+            return _proc.ast_load(block) + _proc.ast_load(block)
+
+        self.runner.processor.install_environments({"twice": twice})
+        code = """{
+            set(a, 2); def(f, {out("f", a); ret(a)});
+            set(b, twice({f()})); out(f); ret(b, ecl("a*3"))
+        }"""
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            compiled = self.runner.run(code)
+            tree = self.runner.transform(self.runner.parse(code))
+            interpreted = self.runner.processor.run(tree)
+        assert compiled == interpreted == [4.0, 6.0]
+        assert output.getvalue() == "f 2.0\nf 2.0\n<function f>\n" * 2
+
+        # a builtin replaced at runtime is called through the environment
+        tree = self.runner.transform(self.runner.parse("{ret(1); ret(2)}"))
+        compiled = self.runner.compile(tree)
+        assert compiled() == 2.0
+        self.runner.processor.install_environments({"ret": lambda v: "replaced"})
+        assert compiled() == "replaced"
+
+        # compiled code belongs to the runner, not to the tree
+        runner, other = KotazyRunner(), KotazyRunner()
+        tree = runner.transform(runner.parse("{set(x, 1); ret(x)}"))
+        assert runner.execute(tree) == other.execute(tree) == 1.0
+        assert other.processor.environment["x"] == 1.0
+        processor = KotazyProcessor()
+        runner.set_processor(processor)
+        assert runner.execute(tree) == 1.0
+        assert processor.environment["x"] == 1.0
+        assert not any(callable(value) for value in tree.values())
+        code = other.compiler.code
+        size = len(code)
+        del tree
+        gc.collect()
+        assert len(code) < size
+
+    def test_parser(self):
+        assert kotazy_parser(KotazyTransformer) is kotazy_parser(KotazyTransformer)
+        assert self.runner.parser.parser.options.parser == "lalr"
+        earley = Lark(kotazy_grammar, start="codeblock")
+        sources = [
+            "{}",
+            "{out()}",
+            '{/* a */ out(-1.5, "a \\"b\\"", x) /* b */; out(1)}',
+            "{ret({ret({ret(1); ret(2)})}); def(f, a, {ret(a)})}",
+        ]
+        for source in sources:
+            expected = KotazyTransformer().transform(earley.parse(source))
+            assert self.runner.transform(self.runner.parse(source)) == expected
+            tree = self.runner.load(source)
+            assert tree == expected and self.runner.load(source) is tree
+        with self.assertRaises(Exception):
+            self.runner.load("{out(1);}")
+
+        runner = KotazyRunner(cache_size=2)
+        first = runner.load(sources[0])
+        runner.load(sources[1])
+        runner.load(sources[2])
+        assert sources[0] not in runner.cache and runner.load(sources[0]) is not first
+        runner.set_parser(KotazyParser(KotazyTransformer))
+        assert not runner.cache
+
+        class UpperTransformer(KotazyTransformer):
+            def string(self, d):
+                return {"type": "string", "val": super().string(d)["val"].upper()}
+
+        runner.load(sources[0])
+        runner.set_transformer(UpperTransformer())
+        assert not runner.cache
+        assert runner.run('{ret("abc")}') == "ABC"
+        runner.set_transformer(KotazyTransformer())
+        assert runner.run('{ret("abc")}') == "abc"
+
+    def test_scopes(self):
+        code = """{
+            set(x, 1); set(s, 0); set(l, ret(1, 2));
+            def(add, a, b, {set(s, ecl("a + b + x")); ret(s)});
+            def(outer, a, {def(inner, b, {ret(a, b)}); ret(inner(2))});
+            ret(add(1, 2), outer(5), s, l)
+        }"""
+        assert self.runner.run(code) == [4.0, [5.0, 2.0], 0.0, [1.0, 2.0]]
+        with self.assertRaises(KeyError):
+            self.runner.run("{ret(a)}")
+        with self.assertRaises(Exception):
+            self.runner.run("{add(1)}")
+
+        # functions without parameters assign where their variables are read from
+        assert self.runner.run("{def(init, {set(y, 1)}); init(); ret(y)}") == 1.0
+        code = """{
+            def(count, n, {set(c, n); def(step, {set(c, ecl("c + 1"))}); step(); ret(c)});
+            ret(count(5))
+        }"""
+        assert self.runner.run(code) == 6.0
+        assert "c" not in self.runner.processor.environment
+
+    def test_budget(self):
+        def rep(_proc, count, block):
+            for _ in range(int(_proc.ast_load(count))):
+                _proc.ast_load(block)
+
+        self.runner.processor.install_environments({"rep": rep})
+        loop = "{rep(1000000000, {set(a, 1)})}"
+        cases = [
+            (loop, {"steps": 1000}, "steps"),
+            (loop, {"timeout": 0.05}, "timeout"),
+            ("{def(f, {f()}); f()}", {"depth": 50}, "depth"),
+            ('{set(a, "ab"); ecl("a * 100000000")}', {"size": 1000}, "size"),
+        ]
+        for code, limits, budget in cases:
+            with self.assertRaises(KotazyBudgetExceeded) as error:
+                self.runner.run(code, **limits)
+            assert error.exception.budget == budget
+        # without a depth limit the interpreter's own error is kept
+        with self.assertRaises(RecursionError):
+            self.runner.run("{def(f, {f()}); f()}", steps=10**9)
+        # limits are dropped after the run
+        assert self.runner.run("{rep(2000, {set(a, 2)}); ret(a)}", steps=3000) == 2.0
+        assert self.runner.run('{set(a, "ab"); ret(ecl("a * 1000"))}') == "ab" * 1000
+
+        with KotazyPool(1) as pool:
+            assert pool.run("{ret(1, 2)}") == [1.0, 2.0]
+            with self.assertRaises(KotazyBudgetExceeded):
+                pool.run('{clc("9 ** 9 ** 9")}', timeout=0.05)
+            with self.assertRaises(KeyError):
+                pool.run("{ret(a)}")
+            assert pool.run("{ret(3)}") == 3.0
+
+    def test_run_many(self):
+        self.runner = kotazy_runner()
+        scripts = ["{ret(1)}", "{set(a, 2); ret(a)}", "{ret(a)}", "{ret(1)}", "{bad"]
+        scripts.append("{rep(1000000000, {ret(1)})}")
+        for workers in (0, 2):
+            results = self.runner.run_many(
+                scripts, workers=workers, setup=kotazy_runner, timeout=0.05
+            )
+            assert results[:2] == [1.0, 2.0] and results[3] == 1.0
+            assert isinstance(results[2], KeyError)
+            assert isinstance(results[4], Exception)
+            assert isinstance(results[5], KotazyBudgetExceeded)
+        # the pool kills a worker stuck in a single call
+        results = self.runner.run_many(
+            ['{clc("9 ** 9 ** 9")}', "{ret(1)}"], timeout=0.05
+        )
+        assert isinstance(results[0], KotazyBudgetExceeded) and results[1] == 1.0
+        self.runner.close()
+
 
 if __name__ == "__main__":
     unittest.main()